@@ -25,8 +25,9 @@ from rpl import rpl, helper
 from time import time
 
 # Imports specific to the GUI.
-import difflib, glob, webbrowser
+import difflib, glob, webbrowser, Queue
 from subprocess import Popen
+from multiprocessing.pool import ThreadPool
 try:
 	import ttk, tkFileDialog, tkFont
 	import Tkinter as Tk
@@ -134,6 +135,21 @@ def main():
 		" current folder.",
 		default = "."
 	)
+	parser.add_argument("--cache",
+		help    = "Folder to cache compiled RPLs in. By default this is"
+		" RPL_CACHE_PATH from the environment, if set.",
+		default = None
+	)
+	parser.add_argument("--manifest",
+		help    = "File to record imports and exports in. When doing so again,"
+		" structs whose resources and ROM data haven't changed are skipped.",
+		default = None
+	)
+	parser.add_argument("--jobs", "-j", #"/j",
+		help    = "Number of processes to export independent structs with.",
+		type    = int,
+		default = 1
+	)
 	parser.add_argument("--debug",
 		help    = argparse.SUPPRESS,
 		action  = "store_true"
@@ -191,6 +207,7 @@ def main():
 		print(thing.template(structs))
 	elif args.run:
 		thing = rpl.RPL()
+		if args.cache: thing.cacheFolder = args.cache
 
 		thing.parse(args.run[0])
 
@@ -210,6 +227,8 @@ def main():
 		elif args.export:   romfile, rplfile = tuple(args.export)
 		elif args.makefile: romfile, rplfile = tuple(args.makefile)
 
+		if args.cache: thing.cacheFolder = args.cache
+		if args.manifest: thing.manifest = args.manifest
 		thing.parse(rplfile)
 
 		if not args.romless and not args.makefile:
@@ -240,7 +259,7 @@ def main():
 			helper.prntc("Finished %s." % ("blank import" if args.blank else "importing"))
 			romstream.close()
 		elif args.export:
-			thing.exportData(romstream, args.folder, args.args, args.blank)
+			thing.exportData(romstream, args.folder, args.args, args.blank, args.jobs)
 			helper.prntc("Finished %s." % ("blank export" if args.blank else "exporting"))
 			romstream.close()
 		elif args.makefile:
@@ -256,12 +275,118 @@ def main():
 			helper.prntc("Finished %s." % ("build test" if args.blank else "building"))
 		#endif
 		print("Time taken: %.3fs" % (time() - start))
+		if debug: print("Key cache: %(hits)i hits, %(misses)i misses" % thing.keyStats)
 	else:
 		return GUI().run(args)
 	#endif
 	return 0
 #enddef
 
+class ROMScanner(object):
+	"""
+	Looks for the file that best passes the validation of some ROM structs,
+	using a pool of threads. Files are opened read-only and are only
+	checksummed if their size, ID, and name fit, see ROM.plausible.
+	Results are posted to queue for the Tk loop to pick up, see GUI.pollScan.
+	"""
+	# Results by (path, mtime, size), kept between scans.
+	cache = {}
+
+	def __init__(self, roms, files, threads=4):
+		self.roms, self.files = roms, files
+		self.queue = Queue.Queue()
+		self.pool = ThreadPool(threads)
+
+		# Best candidate so far, as (successes, fails, index).
+		self.best, self.checked = None, 0
+		# Results that arrived ahead of an earlier file's, by index, and the
+		# index of the next file to consider. Files are considered in order,
+		# so the choice doesn't depend on which thread finishes first.
+		self.arrived, self.next = {}, 0
+
+		# Resolve keys here, so the threads only read them.
+		for r in roms:
+			for k in ["id", "name", "text", "crc32"]: r[k]
+		#endfor
+	#enddef
+
+	def start(self):
+		for i, x in enumerate(self.files):
+			self.pool.apply_async(self.check, (i, x), callback=self.queue.put)
+		#endfor
+		self.pool.close()
+	#enddef
+
+	def stop(self):
+		self.pool.terminate()
+	#enddef
+
+	def check(self, idx, path):
+		"""
+		Return (index, successes, fails) for the file at path.
+		"""
+		try:
+			stat = os.stat(path)
+			key = (os.path.realpath(path), stat.st_mtime, stat.st_size)
+		except OSError: return idx, 0, 0
+
+		try: return (idx,) + ROMScanner.cache[key]
+		except KeyError: pass
+
+		succs, fails = 0, 0
+		try: stream = helper.MappedStream(path, "rb")
+		except (EnvironmentError, ValueError): return idx, 0, 0
+		try:
+			for r in self.roms:
+				if r.plausible(stream): s, f = r.validate(stream)
+				else:
+					# Count the rest as one failure rather than checking it.
+					s, f = r.validateHeader(stream)
+					f = f + ["plausible"]
+				#endif
+				succs += s
+				fails += len(f)
+			#endfor
+		# Any file may be found, so whatever it makes validation raise, it just
+		# isn't the ROM. Every file must post a result, see results.
+		except Exception: succs, fails = 0, 0
+		finally: stream.close()
+
+		ROMScanner.cache[key] = (succs, fails)
+		return idx, succs, fails
+	#enddef
+
+	def results(self):
+		"""
+		Take in the posted results. Returns True once finished, which is when
+		all files are checked or the earliest file to pass everything is found.
+		"""
+		while True:
+			try: idx, succs, fails = self.queue.get_nowait()
+			except Queue.Empty: break
+			self.checked += 1
+			self.arrived[idx] = (succs, fails)
+		#endwhile
+
+		while self.next in self.arrived:
+			succs, fails = self.arrived.pop(self.next)
+			# Prefer more successes, then the earlier file.
+			if succs > (self.best[0] if self.best else 0): self.best = (succs, fails, self.next)
+			self.next += 1
+
+			if self.best and self.best[1] == 0:
+				self.stop()
+				return True
+			#endif
+		#endwhile
+		return self.next == len(self.files)
+	#enddef
+
+	def romfile(self):
+		return self.files[self.best[2]] if self.best else ""
+	#enddef
+#endclass
+
 class GUI(object):
 	def cliFiles(self, romfile, rplfile, folder):
 		if self.args.folder != ".": folder = self.args.folder
@@ -321,24 +446,10 @@ class GUI(object):
 			# Is there a ROM struct we can use for verification?
 			rom = self.rpl.childrenByType("ROM")
 			if rom:
-				successes, curfails = 0, 0
-
-				# Check files against ROM struct validation.
-				for x in searches:
-					stream = helper.stream(x)
-					succs, fails = 0, 0
-					for r in rom:
-						s, f = r.validate(stream)
-						succs += s
-						fails += len(f)
-					#endfor
-
-					if succs > successes:
-						romfile, successes, curfails = x, succs, fails
-						if fails == 0: break
-					#endif
-				#endfor
-				if romfile and curfails: romnote = u"There were %i ROM validation failures." % curfails
+				# Check files against ROM struct validation in the
+				# background, see pollScan.
+				self.scanner = ROMScanner(rom, searches)
+				self.scanner.start()
 			else:
 				# Filter out some known extensions, like archives...
 				searches = [x for x in searches if (
@@ -425,6 +536,7 @@ class GUI(object):
 			return 1
 		#endif
 		self.args, self.what, self.defs, self.rpl = args, [], dict(args.define), rpl.RPL()
+		self.scanner = None
 		romfile, rplfile, folder = "", "", ""
 		romnote, rplnote = u"", u""
 
@@ -519,7 +631,32 @@ class GUI(object):
 		ccframe.grid_rowconfigure(0, weight=1)
 
 		# All done, show it.
+		if self.scanner: self.pollScan(root)
 		root.mainloop()
+		if self.scanner: self.scanner.stop()
+	#enddef
+
+	def pollScan(self, root):
+		"""
+		Show the progress of the ROM scan started by guessFiles, and fill in
+		the ROM file when it's done, unless one was chosen already.
+		"""
+		scanner = self.scanner
+		if not scanner.results():
+			self.romsec.note(u"Looking for the ROM... (%i/%i)" % (scanner.checked, len(scanner.files)))
+			root.after(100, self.pollScan, root)
+			return
+		#endif
+
+		self.scanner = None
+		romfile = scanner.romfile()
+		if self.romsec.get() or not romfile: self.romsec.note(u"")
+		else:
+			self.romsec.entry.set(romfile)
+			fails = scanner.best[1]
+			if fails: self.romsec.note(u"There were %i ROM validation failures." % fails)
+			else: self.romsec.note(u"")
+		#endif
 	#enddef
 
 	def validate(self, romfile, cont=None):
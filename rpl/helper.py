@@ -18,8 +18,9 @@
 # along with Imperial Exchange.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import re, codecs, os
+import re, codecs, os, mmap
 from sys import stderr, stdout
+from zlib import crc32
 from textwrap import dedent
 
 class RPLInternal(Exception): pass
@@ -60,16 +61,64 @@ def readFrom(etc):
 def writeTo(etc, data):
 	"""
 	Helper class to write to a file or stream
+	data may also be an iterable of strings, which are written as they come,
+	in batches of about writeBatch characters.
 	"""
 	try:
 		if type(etc) in [str, unicode]:
 			makeParents(etc)
-			x = codecs.open(etc, encoding="utf-8", mode="w")
-			ret = x.write(data)
-			x.close()
-			return ret
-		else: return etc.write(data)
-	except IOError as err: raise RPLInternal("Error writing to file: " + err.strerror)
+			if isinstance(data, basestring):
+				x = codecs.open(etc, encoding="utf-8", mode="w")
+				try: return x.write(data)
+				finally: x.close()
+			#endif
+
+			# Generating the data can fail partway, so write it next to the
+			# file and only replace the file once it's all there.
+			tmp = "%s.%i.tmp" % (etc, os.getpid())
+			x = codecs.open(tmp, encoding="utf-8", mode="w")
+			try:
+				try: writeChunks(x, data)
+				finally: x.close()
+				replaceFile(tmp, etc)
+			except:
+				try: os.unlink(tmp)
+				except OSError: pass
+				raise
+			#endtry
+		elif isinstance(data, basestring): return etc.write(data)
+		else: return writeChunks(etc, data)
+	except (IOError, OSError) as err: raise RPLInternal("Error writing to file: " + err.strerror)
+#enddef
+
+def replaceFile(src, dest):
+	"""
+	Move src to dest, replacing dest if it exists.
+	"""
+	try: os.rename(src, dest)
+	except OSError:
+		# Windows won't rename over an existing file.
+		if not os.path.exists(dest): raise
+		os.remove(dest)
+		os.rename(src, dest)
+	#endtry
+#enddef
+
+writeBatch = 0x10000
+def writeChunks(stream, chunks):
+	"""
+	Write an iterable of strings to stream without joining them all first.
+	"""
+	batch, size = [], 0
+	for x in chunks:
+		batch.append(x)
+		size += len(x)
+		if size >= writeBatch:
+			stream.write(u"".join(batch))
+			batch, size = [], 0
+		#endif
+	#endfor
+	if batch: stream.write(u"".join(batch))
 #enddef
 
 def stream(etc):
@@ -78,11 +127,11 @@ def stream(etc):
 	"""
 	if type(etc) in [str, unicode]:
 		makeParents(etc)
-		try: etc = OverSeek(etc, "r+b")
+		try: etc = MappedStream(etc, "r+b")
 		except IOError:
 			tmp = open(etc, "w")
 			tmp.close()
-			etc = OverSeek(etc, "r+b")
+			etc = MappedStream(etc, "r+b")
 		#endtry
 	#endif
 	return etc
@@ -270,6 +319,116 @@ class OverSeek(file):
 	#enddef
 #endclass
 
+class MappedStream(object):
+	"""
+	A file stream backed by mmap. This has the same seek/read/write/tell
+	surface as a file, but does not make a system call for every access.
+	Use view to get a slice of the file without copying or seeking.
+	Like OverSeek, it can be seeked beyond the end of the file, and writing
+	there will grow the file, filling any gap with null bytes.
+	"""
+	# Least number of bytes to grow the mapping by.
+	growBy = 0x10000
+
+	def __init__(self, name, mode="rb"):
+		self.name, self.mode = name, mode
+		self.writable = "+" in mode or "w" in mode or "a" in mode
+		self.file = open(name, mode)
+		self.file.seek(0, 2)
+		self.size, self.pos, self.map = self.file.tell(), 0, None
+		# The mapping grows ahead of the size of the file, which it's cut
+		# back down to when closed.
+		self.capacity = self.size
+		# Whether or not this has been written to, see fileCRC.
+		self.dirty = False
+		# mmap cannot map an empty file, so this waits for the first write.
+		if self.size: self.remap()
+	#enddef
+
+	def remap(self):
+		self.map = mmap.mmap(self.file.fileno(), self.capacity,
+			access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+		)
+	#enddef
+
+	def grow(self, size):
+		"""
+		Extend the file to size bytes. The mapping is grown geometrically, so
+		writing a file piece by piece only resizes it a few times.
+		"""
+		if size > self.capacity:
+			self.capacity = max(size, self.capacity * 2, self.growBy)
+			if self.map: self.map.resize(self.capacity)
+			else:
+				self.file.truncate(self.capacity)
+				self.remap()
+			#endif
+		#endif
+		self.size = size
+	#enddef
+
+	def seek(self, offset, whence=0):
+		if whence == 1: offset += self.pos
+		elif whence == 2: offset += self.size
+		if offset < 0: raise IOError(22, "Invalid argument")
+		self.pos = offset
+	#enddef
+
+	def tell(self): return self.pos
+
+	def read(self, size=-1):
+		if not self.map: return ""
+		end = self.size if size < 0 else min(self.pos + size, self.size)
+		data = self.map[self.pos:end]
+		self.pos += len(data)
+		return data
+	#enddef
+
+	def write(self, data):
+		self.dirty = True
+		end = self.pos + len(data)
+		if end > self.size: self.grow(end)
+		if data: self.map[self.pos:end] = data
+		self.pos = end
+	#enddef
+
+	def view(self, offset, length=None):
+		"""
+		Return a read-only buffer into the file, without copying or seeking.
+		Like read, this is cut short at the end of the file, and reads to the
+		end if length is None.
+		"""
+		if not self.map: return ""
+		end = self.size if length is None else min(offset + length, self.size)
+		return buffer(self.map, offset, max(0, end - offset))
+	#enddef
+
+	def flush(self):
+		if self.map and self.writable: self.map.flush()
+	#enddef
+
+	def close(self):
+		if self.file.closed: return
+		if self.map:
+			self.flush()
+			self.map.close()
+			self.map = None
+		#endif
+		if self.capacity != self.size: self.file.truncate(self.size)
+		self.file.close()
+	#enddef
+
+	def __del__(self):
+		# Streams that were never closed must still be cut down to size.
+		if hasattr(self, "map"): self.close()
+	#enddef
+
+	@property
+	def closed(self): return self.file.closed
+
+	def fileno(self): return self.file.fileno()
+#endclass
+
 class FakeStream(object):
 	def __init__(self):
 		self.pos = 0
@@ -285,6 +444,14 @@ class FakeStream(object):
 	# Maybe this should be randoms :3c
 	def read(self, size): return "\0" * size
 
+	def view(self, offset, length=None):
+		"""
+		Like MappedStream.view, reads to the end if length is None. This has
+		no data, so that's nothing.
+		"""
+		return "" if length is None else "\0" * length
+	#enddef
+
 	def readline(self, size): return ""
 
 	def readlines(self, size): return []
@@ -295,6 +462,161 @@ class FakeStream(object):
 	def flush(self): pass
 #endclass
 
+# Checksums work on runs of addresses: (start, step, count) meaning start,
+# start + step, ... for count addresses. Lists of runs may also contain
+# strings, which are skipped. Addresses outside of the stream are skipped.
+
+# Most bytes to read at a time when checksumming.
+crcChunkSize = 0x10000
+
+# Whole file CRC32s by path, see fileCRC.
+fileCRCs = {}
+
+def streamSize(stream):
+	stream.seek(0, 2)
+	return stream.tell()
+#enddef
+
+def readAt(stream, offset, length):
+	"""
+	Read from stream without copying if it can make a view.
+	"""
+	try: return stream.view(offset, length)
+	except AttributeError:
+		stream.seek(offset)
+		return stream.read(length)
+	#endtry
+#enddef
+
+def clipRun(start, step, count, size):
+	"""
+	Return the run cut down to the addresses inside a stream of size bytes.
+	"""
+	if step == 0:
+		return start, 0, (count if count > 0 and 0 <= start < size else 0)
+	#endif
+	dist = abs(step)
+	if step > 0: lo, hi = (-(start // dist) if start < 0 else 0), (size - 1 - start) // dist
+	else: lo, hi = (-((size - 1 - start) // dist) if start >= size else 0), start // dist
+	return start + step * lo, step, max(0, min(count - 1, hi) - lo + 1)
+#enddef
+
+def crcRun(stream, size, crc, start, step, count):
+	"""
+	Continue crc over one run. Reverse runs are read forward in chunks and
+	only each chunk is reversed.
+	"""
+	start, step, count = clipRun(start, step, count, size)
+	if count <= 0: return crc
+
+	if step == 0:
+		byte = str(readAt(stream, start, 1))
+		for i in range(0, count, crcChunkSize):
+			crc = crc32(byte * min(crcChunkSize, count - i), crc)
+		#endfor
+		return crc & 0xFFFFFFFF
+	#endif
+
+	dist = abs(step)
+	per = max(1, crcChunkSize // dist)
+	while count > 0:
+		num = min(per, count)
+		span = dist * (num - 1) + 1
+		if step == 1: crc = crc32(readAt(stream, start, span), crc)
+		elif step > 0: crc = crc32(readAt(stream, start, span)[::dist], crc)
+		else: crc = crc32(readAt(stream, start - span + 1, span)[::-dist], crc)
+		start += step * num
+		count -= num
+	#endwhile
+	return crc & 0xFFFFFFFF
+#enddef
+
+def crcRuns(stream, runs, size=None):
+	"""
+	Return the CRC32 of the bytes at the addresses in a list of runs.
+	"""
+	if size is None: size = streamSize(stream)
+	crc = 0
+	for x in runs:
+		if type(x) is tuple: crc = crcRun(stream, size, crc, *x)
+	#endfor
+	return crc
+#enddef
+
+def crcMany(stream, jobs):
+	"""
+	Return the CRC32s of several lists of runs, see crcRuns. Lists that only
+	move forward through the stream share one pass over it. Others are
+	checksummed on their own.
+	"""
+	size = streamSize(stream)
+	crcs, pieces = [0] * len(jobs), {}
+	for i, runs in enumerate(jobs):
+		# Gather (start, end) pieces, or find out that it can't share.
+		mine, last = [], 0
+		for x in runs:
+			if type(x) is not tuple: continue
+			start, step, count = clipRun(x[0], x[1], x[2], size)
+			if count <= 0: continue
+			elif (step != 1 and count != 1) or start < last:
+				mine = None
+				break
+			#endif
+			last = start + count
+			if mine and mine[-1][1] == start: mine[-1] = (mine[-1][0], last)
+			else: mine.append((start, last))
+		#endfor
+		if mine is None: crcs[i] = crcRuns(stream, runs, size)
+		elif mine: pieces[i] = mine
+	#endfor
+
+	# Walk through the stream once, feeding each chunk to whoever needs it.
+	idxs = dict.fromkeys(pieces, 0)
+	while idxs:
+		start = min(pieces[i][idx][0] for i, idx in idxs.iteritems())
+		end = min(start + crcChunkSize, size)
+		data = readAt(stream, start, end - start)
+		for i, idx in idxs.items():
+			mine = pieces[i]
+			while idx < len(mine) and mine[idx][0] < end:
+				lo, hi = max(mine[idx][0], start), min(mine[idx][1], end)
+				crcs[i] = crc32(buffer(data, lo - start, hi - lo), crcs[i])
+				if mine[idx][1] > end: break
+				idx += 1
+			#endwhile
+			if idx == len(mine): del idxs[i]
+			else:
+				idxs[i] = idx
+				# Pick up where this chunk ended.
+				if mine[idx][0] < end: mine[idx] = (end, mine[idx][1])
+			#endif
+		#endfor
+	#endwhile
+	return [x & 0xFFFFFFFF for x in crcs]
+#enddef
+
+def fileCRC(stream):
+	"""
+	Return the CRC32 of the entire stream. This is remembered for files that
+	haven't been written to, by path, size, and modification time, so checking
+	the same file again doesn't read it again.
+	"""
+	name = getattr(stream, "name", None)
+	if not isinstance(name, basestring) or getattr(stream, "dirty", True):
+		return crcRuns(stream, [(0, 1, streamSize(stream))])
+	#endif
+
+	path, stat = os.path.realpath(name), os.stat(name)
+	key = (stat.st_size, stat.st_mtime)
+	try:
+		cached, crc = fileCRCs[path]
+		if cached == key: return crc
+	except KeyError: pass
+	crc = crcRuns(stream, [(0, 1, streamSize(stream))])
+	fileCRCs[path] = (key, crc)
+	return crc
+#enddef
+
 # Python 2.7/3.x compatibility
 try: range(0).next
 except AttributeError:
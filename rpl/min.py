@@ -19,6 +19,10 @@
 #
 
 import re, rpl, helper, std.graphic, std.readdir
+from string import maketrans
+from itertools import izip
+from binascii import hexlify, unhexlify
+from operator import add, and_
 
 def register(rpl):
 	# Like a forced lib entry. std must be loaded for color type.
@@ -58,18 +62,180 @@ def printHelp(moreInfo=[]):
 	)
 #enddef
 
-def splitBits(byte):
-	# Used for dismantling graphics.
-	return (
-		(byte & 0x80) >> 7,
-		(byte & 0x40) >> 6,
-		(byte & 0x20) >> 5,
-		(byte & 0x10) >> 4,
-		(byte & 0x08) >> 3,
-		(byte & 0x04) >> 2,
-		(byte & 0x02) >> 1,
-		(byte & 0x01),
-	)
+# rowTables[value][r] translates a byte, which is one column of a tile, to its
+# pixel in row r. That is value if bit r is set, otherwise 0.
+rowTables = dict([(value, [
+	"".join([chr(value if b >> r & 1 else 0) for b in helper.range(256)])
+	for r in helper.range(8)
+]) for value in (1, 2, 4)])
+
+def tileRows(bytes, value=1):
+	"""
+	Decode a whole bank of tiles at once. Returns eight strings, one per row,
+	where ret[r][o:o + 8] is row r of the tile at byte offset o.
+	"""
+	bytes = str(bytes)
+	return [bytes.translate(x) for x in rowTables[value]]
+#enddef
+
+def combineRows(op, rows1, rows2):
+	"""
+	Combine two results of tileRows pixel by pixel with op, by treating each
+	row as one big number. Pixels are small enough that adding or anding them
+	this way never carries into the next pixel.
+	"""
+	ret = []
+	for x, y in izip(rows1, rows2):
+		size = min(len(x), len(y))
+		big = op(int(hexlify(x[:size]), 16), int(hexlify(y[:size]), 16))
+		ret.append(unhexlify("%0*x" % (size * 2, big)))
+	#endfor
+	return ret
+#enddef
+
+def gatherCells(rows, cells, layout, fills={}):
+	"""
+	Compose a grid of cells from decoded tile rows, returning every pixel's
+	palette index in image order.
+	cells:  Rows of the byte offset of each cell, or a key of fills.
+	layout: For each row of pixels in a cell, the tile row to take it from
+	        and the offset of each eight pixel span from the cell's offset.
+	fills:  Eight pixels to use for each span of cells that aren't tiles.
+	"""
+	ret = []
+	for line in cells:
+		for r, spans in layout:
+			row = rows[r]
+			ret += [
+				fills[o] if o in fills else row[o + s:o + s + 8]
+				for o in line for s in spans
+			]
+		#endfor
+	#endfor
+	return "".join(ret)
+#enddef
+
+def mapEntries(struct, size):
+	"""
+	Yield (x, y, offset) for each cell of struct's map in map order, where each
+	cell is size bytes long. Blank cells are "x" and ignored ones are "i".
+	"""
+	tilemap = struct["map"].list()
+	for i, x, y in struct["dir"].rect(*struct.list("dimensions", "number")):
+		if i >= len(tilemap): break
+		t = tilemap[i].get()
+		yield x, y, t if t in ("x", "i") else t * size
+	#endfor
+#enddef
+
+def mapCells(struct, size):
+	"""
+	Return the grid of cells for gatherCells described by struct's map.
+	"""
+	width, height = tuple(struct.list("dimensions", "number"))
+	cells = [["i"] * width for y in helper.range(height)]
+	for x, y, o in mapEntries(struct, size): cells[y][x] = o
+	return cells
+#enddef
+
+def putCells(struct, rows, cells):
+	"""
+	Draw decoded tile rows onto struct's image in one go.
+	"""
+	# Ignored cells keep what Graphic.prepareImage filled the image with.
+	palette = struct.getPalette()
+	palette += [struct["blank"].tuple(), struct.image.getpixel((0, 0))]
+	n = len(palette)
+	indexes = gatherCells(rows, cells, struct.cellLayout, {
+		"x": chr(n - 2) * 8, "i": chr(n - 1) * 8,
+	})
+	struct.image.putdata(map(palette.__getitem__, bytearray(indexes)))
+#enddef
+
+def codeTable(bit):
+	"""
+	Return a table translating each pixel's code to bit(index, dither), see
+	importCells.
+	"""
+	return "".join([chr(int(bit(c >> 1, c & 1))) for c in helper.range(256)])
+#enddef
+
+def scatterCells(pixels, width, entries, layout, rows, shift=0):
+	"""
+	The reverse of gatherCells. Copy each cell out of pixels, which is an
+	image width pixels wide, into rows at the cell's offset plus shift.
+	entries: (x, y, offset) of each cell, see mapEntries. Later cells
+	         overwrite earlier ones at the same offset.
+	rows:    Eight bytearrays, filled in like the result of tileRows.
+	"""
+	height, cellWidth = len(layout), 8 * len(layout[0][1])
+	for cx, cy, o in entries:
+		o += shift
+		for y, (r, spans) in enumerate(layout):
+			row, x = rows[r], (cy * height + y) * width + cx * cellWidth
+			for s in spans:
+				row[o + s:o + s + 8] = pixels[x:x + 8]
+				x += 8
+			#endfor
+		#endfor
+	#endfor
+#enddef
+
+def packRows(rows):
+	"""
+	The reverse of tileRows for pixels that are 0 or 1, returning the bytes.
+	"""
+	big = 0
+	for r, row in enumerate(rows):
+		big |= int(hexlify(row), 16) << r
+	#endfor
+	return unhexlify("%0*x" % (len(rows[0]) * 2, big))
+#enddef
+
+def importCells(struct, rom, entries, size):
+	"""
+	The reverse of putCells. Encode every cell of struct's image at once,
+	then write each contiguous run of cells with one write.
+	Each pixel is encoded by its code, which is 2 * palette index + dither,
+	where dither alternates in a checkerboard starting from 1 in the top
+	left. struct.encoding then lists, for each of struct.bankKeys, the
+	tables (see codeTable) to translate codes to bits with, and the offset
+	from each cell those bits are written to.
+	"""
+	entries = [x for x in entries if x[2] not in ("x", "i")]
+	if not entries: return
+	offsets = sorted(set([o for x, y, o in entries]))
+
+	struct.definePalette(struct.getPalette())
+	table = std.graphic.PixelTable(struct.indexOf)
+	width, height = struct.image.size
+	pixels = str(bytearray(map(table.__getitem__, struct.image.getdata())))
+	checker = "\x01\x00" * (width // 2 + 1)
+	checker = "".join([checker[y & 1:(y & 1) + width] for y in helper.range(height)])
+	# Indexes are small enough that this never carries into the next pixel.
+	codes = unhexlify("%0*x" % (len(pixels) * 2,
+		(int(hexlify(pixels), 16) << 1) + int(hexlify(checker), 16)
+	))
+
+	# Gather runs of neighboring cells.
+	runs = []
+	for o in offsets:
+		if runs and runs[-1][1] == o: runs[-1][1] += size
+		else: runs.append([o, o + size])
+	#endfor
+
+	bankSize = offsets[-1] + size
+	for key, planes in izip(struct.bankKeys, struct.encoding):
+		rows = [bytearray(bankSize) for r in helper.range(8)]
+		for bits, shift in planes:
+			scatterCells(codes.translate(bits), width, entries, struct.cellLayout, rows, shift)
+		#endfor
+		bank, base = packRows(rows), struct[key].number()
+		for start, end in runs:
+			rom.seek(base + start)
+			rom.write(bank[start:end])
+		#endfor
+	#endfor
 #enddef
 
 ################################################################################
@@ -92,6 +258,12 @@ class Tile(std.graphic.Graphic):
 	"""
 	typeName = "tile"
 
+	# Each row of pixels in a tile is one tile row, see gatherCells.
+	cellLayout = [(r, (0,)) for r in helper.range(8)]
+	# How the image is written back, see importCells.
+	bankKeys = ["base"]
+	encoding = [[(codeTable(lambda i, d: i), 0)]]
+
 	def __init__(self, top, name, parent=None):
 		std.graphic.Graphic.__init__(self, top, name, parent)
 
@@ -128,43 +300,31 @@ class Tile(std.graphic.Graphic):
 		)
 	#enddef
 
-	def importTile(self, rom, data):
-		pixel, shift, pixels = 0, 7, r""
-		for i, x, y in std.readdir.ReadDir("DULR").rect(8, 8):
-			pixel |= self.indexOf(data[x, y]) << shift
-			if shift: shift -= 1
-			else:
-				pixels += chr(pixel)
-				shift, pixel = 7, 0
-			#endif
-		#endfor
-		rom.write(pixels)
+	def importData(self, rom, folder):
+		importCells(self, rom, [(0, 0, 0)], 8)
 	#enddef
 
-	def importData(self, rom, folder):
-		self.definePalette(self.getPalette())
-		rom.seek(self["base"].number())
-		self.importTile(rom, self.image.load())
+	@staticmethod
+	def decodeTiles(bytes):
+		"""
+		Decode a bank of tiles to palette indexes, see tileRows.
+		"""
+		return tileRows(bytes)
 	#enddef
 
 	@staticmethod
 	def prepareTile(bytes, palette):
-		pixels, x, p = [0] * 64, 56, 0
-		for byte in bytes:
-			p = x
-			for pixel in splitBits(ord(byte)):
-				pixels[p] = palette[pixel]
-				p -= 8
-			#endfor
-			x += 1
-		#endfor
-		return pixels
+		indexes = gatherCells(Tile.decodeTiles(bytes), [[0]], Tile.cellLayout)
+		return map(palette.__getitem__, bytearray(indexes))
+	#enddef
+
+	def readBank(self, size):
+		return Tile.decodeTiles(self.rpl.rom.view(self["base"].number(), size))
 	#enddef
 
 	def prepareImage(self):
 		std.graphic.Graphic.prepareImage(self)
-		self.rpl.rom.seek(self["base"].number())
-		self.image.putdata(Tile.prepareTile(self.rpl.rom.read(8), self.getPalette()))
+		putCells(self, self.readBank(8), [[0]])
 	#enddef
 #endclass
 
@@ -210,42 +370,14 @@ class Tilemap(Tile):
 	#enddef
 
 	def importData(self, rom, folder):
-		tilemap, base = self["map"].list(), self["base"].number()
-		#rom.seek(base)
-		self.definePalette(self.getPalette())
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			t = tilemap[i]
-			if isinstance(t, rpl.Number):
-				t, x, y = t.get(), x * 8, y * 8
-				rom.seek(base + t * 8)
-				self.importTile(rom,
-					self.image.crop((x, y, x + 8, y + 8)).load()
-				)
-			#endif
-		#endfor
+		# Encode every tile the map uses at once.
+		importCells(self, rom, mapEntries(self, 8), 8)
 	#enddef
 
 	def prepareImage(self):
 		std.graphic.Graphic.prepareImage(self)
-		tilemap, blank = self["map"].list(), self["blank"].tuple()
-
-		# Loop through map and export each tile.
-		self.rpl.rom.seek(self["base"].number())
-		bytes = self.rpl.rom.read(self.mapSize())
-		palette = self.getPalette()
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			t = tilemap[i].get()
-			if t != "i":
-				x, y = x * 8, y * 8
-				cut = self.image.crop((x, y, x + 8, y + 8))
-				if t == "x": cut.putdata([blank] * 64)
-				else:
-					t *= 8
-					cut.putdata(Tile.prepareTile(bytes[t:t + 8], palette))
-				#endif
-				self.image.paste(cut, (x, y))
-			#endif
-		#endfor
+		# Decode every tile the map uses at once, then compose the image.
+		putCells(self, self.readBank(self.mapSize()), mapCells(self, 8))
 	#enddef
 #endclass
 
@@ -270,6 +402,13 @@ class Tile3(Tile):
 	"""
 	typeName = "tile3"
 
+	# Gray is dithered between the two tiles.
+	bankKeys = ["base1", "base2"]
+	encoding = [
+		[(codeTable(lambda i, d: i == 1 or (i == 2 and d)), 0)],
+		[(codeTable(lambda i, d: i == 1 or (i == 2 and not d)), 0)],
+	]
+
 	def __init__(self, top, name, parent=None):
 		Tile.__init__(self, top, name, parent)
 	#enddef
@@ -305,59 +444,32 @@ class Tile3(Tile):
 		)
 	#enddef
 
-	def importTile(self, rom, base1, base2, data):
-		pixel1, pixel2, shift, pixels1, pixels2 = 0, 0, 7, r"", r""
-		for i, x, y in std.readdir.ReadDir("DULR").rect(8, 8):
-			tmp = self.indexOf(data[x, y])
-			if tmp == 2:
-				if (x + y + 1) % 2: pixel1 |= 1 << shift
-				else:               pixel2 |= 1 << shift
-			else:
-				pixel1 |= tmp << shift
-				pixel2 |= tmp << shift
-			#endif
-
-			if shift: shift -= 1
-			else:
-				pixels1 += chr(pixel1)
-				pixels2 += chr(pixel2)
-				shift, pixel1, pixel2 = 7, 0, 0
-			#endif
-		#endfor
-		rom.seek(base1)
-		rom.write(pixels1)
-		rom.seek(base2)
-		rom.write(pixels2)
-	#enddef
+	# Translates the sum of both tiles' pixels to a palette index:
+	# neither is white, one is gray, and both are black.
+	sumTable = maketrans("\x00\x01\x02", "\x00\x02\x01")
 
-	def importData(self, rom, folder):
-		self.definePalette(self.getPalette())
-		self.importTile(rom, self["base1"].number(), self["base2"].number(), self.image.load())
+	@staticmethod
+	def decodeTiles(bytes1, bytes2):
+		"""
+		Decode a bank of three-color tiles to palette indexes, see tileRows.
+		"""
+		return [
+			x.translate(Tile3.sumTable)
+			for x in combineRows(add, tileRows(bytes1), tileRows(bytes2))
+		]
 	#enddef
 
 	@staticmethod
 	def prepareTile(bytes1, bytes2, palette):
-		pixels, x = [0] * 64, 56
-		for i in helper.range(8):
-			p = x
-			byte1, byte2 = ord(bytes1[i]), ord(bytes2[i])
-			black, gray = splitBits(byte1 & byte2), splitBits(byte1 ^ byte2)
-			for pixel in helper.range(8):
-				pixels[p] = palette[gray[pixel] << 1 | black[pixel]]
-				p -= 8
-			#endfor
-			x += 1
-		#endfor
-		return pixels
+		indexes = gatherCells(Tile3.decodeTiles(bytes1, bytes2), [[0]], Tile.cellLayout)
+		return map(palette.__getitem__, bytearray(indexes))
 	#enddef
 
-	def prepareImage(self):
-		std.graphic.Graphic.prepareImage(self)
-		self.rpl.rom.seek(self["base1"].number())
-		data1 = self.rpl.rom.read(8)
-		self.rpl.rom.seek(self["base2"].number())
-		data2 = self.rpl.rom.read(8)
-		self.image.putdata(Tile3.prepareTile(data1, data2, self.getPalette()))
+	def readBank(self, size):
+		return Tile3.decodeTiles(
+			self.rpl.rom.view(self["base1"].number(), size),
+			self.rpl.rom.view(self["base2"].number(), size)
+		)
 	#enddef
 #endclass
 
@@ -383,47 +495,6 @@ class Tilemap3(Tile3, Tilemap):
 
 		self.registerStruct(Tile3)
 	#enddef
-
-	def importData(self, rom, folder):
-		tilemap, base1, base2 = self["map"].list(), self["base1"].number(), self["base2"].number()
-		self.definePalette(self.getPalette())
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			if i >= len(tilemap): break
-			t = tilemap[i]
-			if isinstance(t, rpl.Number):
-				t, x, y = t.get() * 8, x * 8, y * 8
-				self.importTile(rom, base1 + t, base2 + t,
-					self.image.crop((x, y, x + 8, y + 8)).load()
-				)
-			#endif
-		#endfor
-	#enddef
-
-	def prepareImage(self):
-		std.graphic.Graphic.prepareImage(self)
-		tilemap, blank = self["map"].list(), self["blank"].tuple()
-
-		# Loop through map and export each tile.
-		mapSize = self.mapSize()
-		self.rpl.rom.seek(self["base1"].number())
-		bytes1 = self.rpl.rom.read(mapSize)
-		self.rpl.rom.seek(self["base2"].number())
-		bytes2 = self.rpl.rom.read(mapSize)
-		palette = self.getPalette()
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			t = tilemap[i].get()
-			if t != "i":
-				x, y = x * 8, y * 8
-				cut = self.image.crop((x, y, x + 8, y + 8))
-				if t == "x": cut.putdata([blank] * 64)
-				else:
-					t *= 8
-					cut.putdata(Tile3.prepareTile(bytes1[t:t + 8], bytes2[t:t + 8], palette))
-				#endif
-				self.image.paste(cut, (x, y))
-			#endif
-		#endfor
-	#enddef
 #endclass
 
 class Sprite(std.graphic.Graphic):
@@ -445,6 +516,12 @@ class Sprite(std.graphic.Graphic):
 	"""
 	typeName = "sprite"
 
+	# Left and right quadrants of each row of pixels, see gatherCells.
+	cellLayout = [(y % 8, (0, 32) if y < 8 else (8, 40)) for y in helper.range(16)]
+	# Masks are at each quadrant's offset, draws are 16 bytes after.
+	bankKeys = ["base"]
+	encoding = [[(codeTable(lambda i, d: i >> 1 & 1), 0), (codeTable(lambda i, d: i & 1), 16)]]
+
 	def __init__(self, top, name, parent=None):
 		std.graphic.Graphic.__init__(self, top, name, parent)
 		self.owm = self.ohm = self.wm = self.hm = 16
@@ -483,65 +560,33 @@ class Sprite(std.graphic.Graphic):
 		)
 	#enddef
 
-	def importSprite(self, rom, data):
-		pixeld, pixelm, shift = 0, 0, 7
-		pixels, draw, mask = r"", r"", r""
-		# UL, BL, UR, BR
-		for q, qx, qy in std.readdir.ReadDir("UDLR").rect(2, 2):
-			# Each quadrant is the same as a tile, but there's also a mask
-			# quadrant to manage.
-			qx *= 8
-			qy *= 8
-			for i, x, y in std.readdir.ReadDir("DULR").rect(8, 8):
-				tmp = self.indexOf(data[qx + x, qy + y])
-				if tmp & 0x02: pixelm |= 1 << shift
-				pixeld |= (tmp & 0x01) << shift
-				if shift: shift -= 1
-				else:
-					draw += chr(pixeld)
-					mask += chr(pixelm)
-					shift, pixeld, pixelm = 7, 0, 0
-				#endif
-			#endfor
-
-			# After finishing a bottom quadrant, commit to pixels
-			if qy == 8:
-				pixels += mask + draw
-				draw, mask = r"", r""
-			#endif
-		#endfer
-		rom.write(pixels)
+	def importData(self, rom, folder):
+		importCells(self, rom, [(0, 0, 0)], 64)
 	#enddef
 
-	def importData(self, rom, folder):
-		self.definePalette(self.getPalette())
-		rom.seek(self["base"].number())
-		self.importSprite(rom, self.image.load())
+	@staticmethod
+	def decodeSprites(bytes):
+		"""
+		Decode a bank of sprites to palette indexes, see tileRows.
+		The rows are only meaningful at the offsets of mask quadrants, where
+		each pixel combines the mask with the draw quadrant 16 bytes after.
+		"""
+		return combineRows(add, tileRows(bytes, 2), [x[16:] for x in tileRows(bytes)])
 	#enddef
 
 	@staticmethod
 	def prepareSprite(bytes, palette):
-		pixels = [0] * 256
-		for q in helper.range(4):
-			x = [112, 240, 120, 248][q]
-			base = [0, 8, 32, 40][q]
-			for i in helper.range(base, base + 8):
-				p = x
-				mask, draw = splitBits(ord(bytes[i])), splitBits(ord(bytes[i + 16]))
-				for pixel in helper.range(8):
-					pixels[p] = palette[mask[pixel] << 1 | draw[pixel]]
-					p -= 16
-				#endfor
-				x += 1
-			#endfor
-		#endfor
-		return pixels
+		indexes = gatherCells(Sprite.decodeSprites(bytes), [[0]], Sprite.cellLayout)
+		return map(palette.__getitem__, bytearray(indexes))
+	#enddef
+
+	def readBank(self, size):
+		return Sprite.decodeSprites(self.rpl.rom.view(self["base"].number(), size))
 	#enddef
 
 	def prepareImage(self):
 		std.graphic.Graphic.prepareImage(self)
-		self.rpl.rom.seek(self["base"].number())
-		self.image.putdata(Sprite.prepareSprite(self.rpl.rom.read(64), self.getPalette()))
+		putCells(self, self.readBank(64), [[0]])
 	#enddef
 #endclass
 
@@ -584,42 +629,14 @@ class Spritemap(Sprite):
 	#enddef
 
 	def importData(self, rom, folder):
-		tilemap, base = self["map"].list(), self["base"].number()
-		self.definePalette(self.getPalette())
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			t = tilemap[i]
-			if isinstance(t, rpl.Number):
-				x, y = x * 16, y * 16
-				rom.seek(base + t.get() * 64)
-				self.importSprite(rom,
-					self.image.crop((x, y, x + 16, y + 16)).load()
-				)
-			#endif
-		#endfor
+		# Encode every sprite the map uses at once.
+		importCells(self, rom, mapEntries(self, 64), 64)
 	#enddef
 
 	def prepareImage(self):
 		std.graphic.Graphic.prepareImage(self)
-		tilemap, blank = self["map"].list(), self["blank"].tuple()
-		secx = [blank] * 256
-
-		# Loop through map and export each sprite.
-		self.rpl.rom.seek(self["base"].number())
-		bytes = self.rpl.rom.read(self.mapSize())
-		palette = self.getPalette()
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			t = tilemap[i].get()
-			if t != "i":
-				x, y = x * 16, y * 16
-				cut = self.image.crop((x, y, x + 16, y + 16))
-				if t == "x": cut.putdata(secx)
-				else:
-					t *= 64
-					cut.putdata(Sprite.prepareSprite(bytes[t:t + 64], palette))
-				#endif
-				self.image.paste(cut, (x, y))
-			#endif
-		#endfor
+		# Decode every sprite the map uses at once, then compose the image.
+		putCells(self, self.readBank(self.mapSize()), mapCells(self, 64))
 	#enddef
 #endclass
 
@@ -639,6 +656,16 @@ class Sprite3(Sprite):
 	"""
 	typeName = "sprite3"
 
+	# Gray is transparent and dithered between the two draws.
+	bankKeys = ["base1", "base2"]
+	encoding = [[
+		(codeTable(lambda i, d: i != 4 and i >> 1 & 1), 0),
+		(codeTable(lambda i, d: d if i == 4 else i & 1), 16),
+	], [
+		(codeTable(lambda i, d: i != 4 and i >> 1 & 1), 0),
+		(codeTable(lambda i, d: (not d) if i == 4 else i & 1), 16),
+	]]
+
 	def __init__(self, top, name, parent=None):
 		Sprite.__init__(self, top, name, parent)
 	#enddef
@@ -675,84 +702,36 @@ class Sprite3(Sprite):
 		)
 	#enddef
 
-	def importSprite(self, rom, base1, base2, data):
-		pixelm, pixeld1, pixeld2, shift = 0, 0, 0, 7
-		pixels1, pixels2, mask, draw1, draw2 = r"", r"", r"", r"", r""
-		# UL, BL, UR, BR
-		for q, qx, qy in std.readdir.ReadDir("UDLR").rect(2, 2):
-			# Each quadrant is the same as a tile, but there's also a mask
-			# quadrant to manage.
-			qx *= 8
-			qy *= 8
-			for i, x, y in std.readdir.ReadDir("DULR").rect(8, 8):
-				tmp = self.indexOf(data[qx + x, qy + y])
-				if tmp == 4:
-					if (i + x % 2) % 2: pixeld1 |= 1 << shift
-					else:               pixeld2 |= 1 << shift
-				else:
-					if tmp & 0x02: pixelm |= 1 << shift
-					tmp = (tmp & 0x01) << shift
-					pixeld1 |= tmp
-					pixeld2 |= tmp
-				#endif
-				if shift: shift -= 1
-				else:
-					mask += chr(pixelm)
-					draw1 += chr(pixeld1)
-					draw2 += chr(pixeld2)
-					shift, pixelm, pixeld1, pixeld2 = 7, 0, 0, 0
-				#endif
-			#endfor
-
-			# After finishing a bottom quadrant, commit to pixels
-			if qy == 8:
-				pixels1 += mask + draw1
-				pixels2 += mask + draw2
-				mask, draw1, draw2  = r"", r"", r""
-			#endif
-		#endfer
-		rom.seek(base1)
-		rom.write(pixels1)
-		rom.seek(base2)
-		rom.write(pixels2)
-	#enddef
+	# Translates 4 * mask + the sum of both draws to a palette index.
+	# Gray is only drawn where the mask is clear, otherwise it's white.
+	sumTable = maketrans("\x00\x01\x02\x04\x05\x06", "\x00\x04\x01\x02\x02\x03")
 
-	def importData(self, rom, folder):
-		self.definePalette(self.getPalette())
-		self.importSprite(rom, self["base1"].number(), self["base2"].number(), self.image.load())
+	@staticmethod
+	def decodeSprites(bytes1, bytes2):
+		"""
+		Decode a bank of three-color sprites to palette indexes, see
+		Sprite.decodeSprites.
+		"""
+		# If one mask is opaque and one is transparent, prefer opaque..
+		mask = combineRows(and_, tileRows(bytes1, 4), tileRows(bytes2, 4))
+		draw = combineRows(add,
+			[x[16:] for x in tileRows(bytes1)],
+			[x[16:] for x in tileRows(bytes2)]
+		)
+		return [x.translate(Sprite3.sumTable) for x in combineRows(add, mask, draw)]
 	#enddef
 
 	@staticmethod
 	def prepareSprite(bytes1, bytes2, palette):
-		pixels = [0] * 256
-		for q in helper.range(4):
-			x = [112, 240, 120, 248][q]
-			base = [0, 8, 32, 40][q]
-			for i in helper.range(base, base + 8):
-				p = x
-				# If one mask is opaque and one is transparent, prefer opaque..
-				mask = splitBits(ord(bytes1[i]) & ord(bytes2[i]))
-				i = i + 16
-				byte1, byte2 = ord(bytes1[i]), ord(bytes2[i])
-				black, gray = splitBits(byte1 & byte2), splitBits(byte1 ^ byte2)
-				for pixel in helper.range(8):
-					if gray[pixel] and not mask[pixel]: pixels[p] = palette[4]
-					else: pixels[p] = palette[mask[pixel] << 1 | black[pixel]]
-					p -= 16
-				#endfor
-				x += 1
-			#endfor
-		#endfor
-		return pixels
+		indexes = gatherCells(Sprite3.decodeSprites(bytes1, bytes2), [[0]], Sprite.cellLayout)
+		return map(palette.__getitem__, bytearray(indexes))
 	#enddef
 
-	def prepareImage(self):
-		std.graphic.Graphic.prepareImage(self)
-		self.rpl.rom.seek(self["base1"].number())
-		data1 = self.rpl.rom.read(64)
-		self.rpl.rom.seek(self["base2"].number())
-		data2 = self.rpl.rom.read(64)
-		self.image.putdata(Sprite3.prepareSprite(data1, data2, self.getPalette()))
+	def readBank(self, size):
+		return Sprite3.decodeSprites(
+			self.rpl.rom.view(self["base1"].number(), size),
+			self.rpl.rom.view(self["base2"].number(), size)
+		)
 	#enddef
 #endclass
 
@@ -780,47 +759,6 @@ class Spritemap3(Sprite3, Spritemap):
 
 		self.registerStruct(Sprite3)
 	#enddef
-
-	def importData(self, rom, folder):
-		tilemap, base1, base2 = self["map"].list(), self["base1"].number(), self["base2"].number()
-		self.definePalette(self.getPalette())
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			t = tilemap[i]
-			if isinstance(t, rpl.Number):
-				t, x, y = t.get() * 64, x * 16, y * 16
-				self.importSprite(rom, base1 + t, base2 + t,
-					self.image.crop((x, y, x + 16, y + 16)).load()
-				)
-			#endif
-		#endfor
-	#enddef
-
-	def prepareImage(self):
-		std.graphic.Graphic.prepareImage(self)
-		tilemap, blank = self["map"].list(), self["blank"].tuple()
-		secx = [blank] * 256
-
-		# Loop through map and export each sprite.
-		mapSize = self.mapSize()
-		self.rpl.rom.seek(self["base1"].number())
-		bytes1 = self.rpl.rom.read(mapSize)
-		self.rpl.rom.seek(self["base2"].number())
-		bytes2 = self.rpl.rom.read(mapSize)
-		palette = self.getPalette()
-		for i, x, y in self["dir"].rect(*self.list("dimensions", "number")):
-			t = tilemap[i].get()
-			if t != "i":
-				x, y = x * 16, y * 16
-				cut = self.image.crop((x, y, x + 16, y + 16))
-				if t == "x": cut.putdata(secx)
-				else:
-					t *= 64
-					cut.putdata(Sprite3.prepareSprite(bytes1[t:t + 64], bytes2[t:t + 64], palette))
-				#endif
-				self.image.paste(cut, (x, y))
-			#endif
-		#endfor
-	#enddef
 #endclass
 
 ################################################################################
@@ -17,11 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with Imperial Exchange.  If not, see <http://www.gnu.org/licenses/>.
 #
-import os, re, copy, codecs
+import os, sys, re, copy, codecs, hashlib, heapq, multiprocessing.pool, operator
+import cPickle as pickle
 import helper
 from math import ceil
-from zlib import crc32
 from collections import OrderedDict as odict
+from itertools import izip, count
+from bisect import bisect_right
+from array import array
+from struct import Struct
+from binascii import hexlify, unhexlify
 
 ################################################################################
 #################################### Helpers ###################################
@@ -154,6 +159,122 @@ class SharedRegistry(Share):
 ##################################### Main #####################################
 ################################################################################
 
+class CopyOnWrite(odict):
+	"""
+	Ordered dict that a clone can borrow from its donor, see RPLObject.cow.
+	Values are shared with the donor until they're read, at which point they
+	are copied for the clone, unless they're immutable data which can be
+	shared forever. Writing replaces a value, so borrowed values must never
+	be changed in place.
+	"""
+	# Types of RPLData.data that are safe to share.
+	immutable = (str, unicode, int, long, float, bool)
+
+	def __init__(self, donor=None, owner=None):
+		odict.__init__(self)
+		# Keys whose values still belong to the donor.
+		self.borrowed = set()
+		self.owner = owner
+		if donor is not None:
+			for k in donor:
+				# Take the donor's value as is, even if it's still borrowed.
+				x = dict.__getitem__(donor, k)
+				odict.__setitem__(self, k, x)
+				if not CopyOnWrite.shareable(x): self.borrowed.add(k)
+			#endfor
+		#endif
+	#enddef
+
+	@staticmethod
+	def shareable(x):
+		"""
+		Whether or not x can be shared between a donor and its clones.
+		Things that can refer to their container must be copied.
+		"""
+		return (isinstance(x, RPLData) and not isinstance(x, (Math, RefString, List))
+			and type(getattr(x, "data", None)) in CopyOnWrite.immutable)
+	#enddef
+
+	def clone(self, owner):
+		return self.__class__(self, owner)
+	#enddef
+
+	def __getitem__(self, key):
+		x = dict.__getitem__(self, key)
+		if key in self.borrowed:
+			self.borrowed.discard(key)
+			x = copy.deepcopy(x, {"parent": self.owner})
+			odict.__setitem__(self, key, x)
+		#endif
+		return x
+	#enddef
+
+	def __setitem__(self, key, value, *args):
+		self.borrowed.discard(key)
+		odict.__setitem__(self, key, value, *args)
+	#enddef
+
+	def __delitem__(self, key, *args):
+		self.borrowed.discard(key)
+		odict.__delitem__(self, key, *args)
+	#enddef
+
+	def clear(self):
+		self.borrowed.clear()
+		odict.clear(self)
+	#enddef
+
+	def __reduce__(self):
+		# Copies of this have no donor or owner.
+		return self.__class__, (), None, None, ((k, self[k]) for k in self)
+	#enddef
+#endclass
+
+class KeyData(CopyOnWrite):
+	"""
+	Ordered key-value pairs of a struct.
+	Any change to these invalidates the struct's resolved value for that key
+	and all resolved keys of those inheriting from it, see RPLStruct.keyStamp.
+	"""
+	# Every generation handed out is unique, so a stamp made of them also
+	# tells which structs it was made through.
+	generations = count(1)
+
+	def __init__(self, donor=None, owner=None):
+		CopyOnWrite.__init__(self, donor, owner)
+		self.generation = next(KeyData.generations)
+	#enddef
+
+	def touch(self, key=None):
+		"""
+		Start a new generation for these and for the donor of their struct,
+		since a struct with clones lists their values.
+		key: The key that changed, or None if it could be any of them.
+		"""
+		self.generation = next(KeyData.generations)
+		owner = self.owner
+		try: owner.forgetKey(key)
+		except AttributeError: pass
+		donor = getattr(owner, "donor", None)
+		if donor is not None: donor.data.touch(key)
+	#enddef
+
+	def __setitem__(self, key, value, *args):
+		self.touch(key)
+		CopyOnWrite.__setitem__(self, key, value, *args)
+	#enddef
+
+	def __delitem__(self, key, *args):
+		self.touch(key)
+		CopyOnWrite.__delitem__(self, key, *args)
+	#enddef
+
+	def clear(self):
+		self.touch()
+		CopyOnWrite.clear(self)
+	#enddef
+#endclass
+
 class RPLObject(object):
 	"""
 	Base class for RPL (file/root) and RPLStruct.
@@ -176,9 +297,11 @@ class RPLObject(object):
 			None is the same as the root.
 		"""
 		# Ordered key-value pairs.
-		self.data = odict()
+		self.data = KeyData(owner=self)
 		# Ordered children, indexed by struct name.
 		self.children = odict()
+		# Names and indexes of children, see childOrder.
+		self.childOrderCache = None
 		# If the name was generated automatically or not.
 		self.gennedName = False
 
@@ -194,7 +317,10 @@ class RPLObject(object):
 		# copy. This is to prevent recursion as well as unnecessary copies.
 		# You may add your own with self.nocopy.append("name") or
 		# self.nocopy += ["name", ...] in the __init__
-		self.nocopy = ["rpl", "parent", "keys", "structs", "virtuals"]
+		self.nocopy = ["rpl", "parent", "keys", "structs", "virtuals", "nocopy", "cow"]
+		# These are CopyOnWrites that deep copies borrow rather than copy.
+		# Add your own the same way as nocopy.
+		self.cow = ["data"]
 	#enddef
 
 	def addChild(self, structType, name):
@@ -251,6 +377,22 @@ class RPLObject(object):
 	def child(self, name): return self.children[name]
 	def recurse(self): return RecurseIter(self.children, self)
 
+	def childOrder(self):
+		"""
+		Return a tuple of the children's names in order and a dict mapping
+		those names to their index. This is rebuilt when children are added.
+		"""
+		cache = self.childOrderCache
+		if cache is None or len(cache[0]) != len(self.children):
+			names = self.children.keys()
+			cache = self.childOrderCache = (names, dict((x, i) for i, x in enumerate(names)))
+		#endif
+		return cache
+	#enddef
+
+	def childIndex(self, name): return self.childOrder()[1][name]
+	def childAt(self, index): return self.children[self.childOrder()[0][index]]
+
 	def childrenByType(self, typeName):
 		"""
 		Return list of children that fit the given typeName.
@@ -271,17 +413,38 @@ class RPLObject(object):
 	def __deepcopy__(self, memo={}):
 		# This allows for much quicker clones.
 		ret = object.__new__(self.__class__)
-		memo["parent"] = ret
+		outer = memo.get("parent")
+		# Further attributes the caller wants shared, for this copy only.
+		shared = memo.pop("shared", ())
 		for k, x in self.__dict__.iteritems():
 			# Point to functions and things listed in nocopy.
-			if k in self.nocopy or callable(x): setattr(ret, k, x)
+			if k in self.nocopy or k in shared or callable(x) or type(x) in CopyOnWrite.immutable:
+				setattr(ret, k, x)
+			# Borrow these until they're used.
+			elif k in self.cow: setattr(ret, k, x.clone(ret))
 			# Copy everything else.
-			else: setattr(ret, k, copy.deepcopy(x, memo))
+			else:
+				# Copying children changes this, so set it for every attribute.
+				memo["parent"] = ret
+				setattr(ret, k, copy.deepcopy(x, memo))
+			#endif
 		#endfor
+		memo["parent"] = outer
 		return ret
 	#enddef
 #enddef
 
+# Structs being exported by worker processes, see RPL.exportParallel.
+# Workers are forked after this is set, so it does not need to be pickled.
+exportQueue = []
+
+def exportWorker(index):
+	# RPL errors are left for the serial export to report properly, with the
+	# context it has. Anything else is a bug, and is raised by pool.map.
+	try: return exportQueue[index].exportWork()
+	except RPLError: return None
+#enddef
+
 class RPL(RPLObject):
 	"""
 	The base type for loading and interpreting RPL files.
@@ -301,8 +464,9 @@ class RPL(RPLObject):
 		 r'((?:\s*@?`[^`]*`\s*(?:#.*)?)+)|'
 		 # Number or range (verify syntactically correct range later)
 		 # That is, any string of numbers, -, *, :, or :c: where c is one
-		 # lowercase letter.
-		 r'(%(r1)s%(r2)s%(r1)s:\-*+~%(r2)s*(?=[,\]\}#\s]|$))|'
+		 # lowercase letter. Or a negative number or hexnum, but not range.
+		 r'(-(?:[0-9]+|\$[0-9a-fA-F]+)(?=[,\]\}#\s]|$)|'
+		 r'%(r1)s%(r2)s%(r1)s:\-*+~%(r2)s*(?=[,\]\}#\s]|$))|'
 		 # Key: Lowercase letters optionally followed by numbers.
 		 # Must be followed by a colon.
 		 r'(%(key)s):([ \t]*)|'
@@ -369,6 +533,18 @@ class RPL(RPLObject):
 		# Defining these here prevents them from being usable by RPL.lib
 		self.alreadyLoaded   = ["helper", "__init__", "rpl"]
 		self.alreadyIncluded = []    # <^ These are used by RPL.load.
+		# Where to cache compiled RPLs, see RPL.compiled.
+		self.cacheFolder = os.environ.get("RPL_CACHE_PATH")
+		# References between structs, see RPLGraph. Built when porting.
+		self.graph = None
+		# Where to keep the incremental import manifest, see RPL.importData.
+		self.manifest = None
+		# Hash of all parsed RPL source, see RPL.fingerprint.
+		self.digest = hashlib.sha1()
+		# Files shared with the current struct, see RPL.share.
+		self.sources = None
+		# Hits and misses of structs' resolved keys, see RPLStruct.__getitem__.
+		self.keyStats = {"hits": 0, "misses": 0}
 		# What to include in the default template.
 		self.defaultTemplateStructs = ["RPL", "ROM"]
 		RPLObject.reset(self)
@@ -452,37 +628,46 @@ class RPL(RPLObject):
 		"""
 		if kwargs.get("string", False): raw = inFile
 		else: raw = helper.readFrom(inFile) # Raw data from file.
+		self.digest.update(raw.encode("utf8") if type(raw) is unicode else raw)
+
+		self.build(self.compiled(raw), onlyCareAboutTypes, **kwargs)
+	#enddef
 
+	def compile(self, raw):
+		"""
+		Tokenize and interpret raw RPL into a list of instructions for
+		RPL.build. No structs or data are instantiated here, so the result
+		depends only on the source and may be cached. The instructions are:
+		("struct", type, name, genned, line, char) - Opens a struct.
+		("end", line, char)                        - Closes the current struct.
+		("key", name, value)                       - Sets a key in the current struct.
+		Where value is of the form (type, data, line, char) and the data of a
+		list is a list of values of the same form.
+		"""
 		# Prelit allows colons to be inside literals.
 		lastLit, prelit = None, "" # Helpers for literal forming.
 		currentKey = None          # What key the next value is for.
-		currentStruct = None       # What struct we are currently parsing.
+		depth = 0                  # How many structs deep we are.
 		counts = {}                # How many of a certain struct type we've enountered.
-		parents = []               # Current hierarchy of structs and lists.
-		notCaring = False          # Used for onlyCaseAboutTypes.
+		parents = []               # Current hierarchy of lists.
+		names = []                 # Names of the structs we're in, for errors.
+		compiled = []
 
-		for token in RPL.specification.finditer(raw):
-			groups = token.groups() # Used later.
+		for kind, groups, line, char in self.tokenize(raw):
 			dstr, sstr, mstr, num, key, afterkey, flow, ref, lit = groups
 
-			sstr = dstr or sstr # Double or single quoted string.
-			# (type, value) to add; error to throw; skip list childs' instantiations.
-			add, error, skipSubInst = None, None, False
-
-			# Find the position (used for ref and errors).
-			pos = token.start()
-			# Line and character numbers are 1-based. (Because gedit is 1-based. o/ )
-			line, char = raw.count("\n",0,pos) + 1, pos - raw.rfind("\n",0,pos) + 1
+			# (type, value) to add; error to throw.
+			add, error = None, None
 
 			try:
-				if lit:
+				if kind == "literal":
 					# Literals can either be the struct head (type and optionally name)
 					# or a string that has no quotes.
 					lit = lit.rstrip()
 					# If the last token was a key or this is inside a list, this
 					# is string data (as a literal type).
 					if currentKey or parents:
-						add = self.parseData(groups)
+						add = self.parseData(groups, kind=kind)
 						if prelit:
 							add = (add[0], prelit + add[1])
 							prelit = ""
@@ -491,7 +676,7 @@ class RPL(RPLObject):
 					else: lastLit = lit
 				elif prelit:
 					error = "Key can only be in a struct."
-				elif flow:
+				elif kind == "flow":
 					if flow == "{":
 						# Open struct
 						structHead = lastLit.split(" ")
@@ -520,66 +705,148 @@ class RPL(RPLObject):
 								raise RPLError("Struct name must not contain periods or at signs.")
 							#endif
 
-							if structName in self.structsByName and not kwargs.get("dupNames", False):
-								raise RPLError('Struct name "%s" is already taken.' % structName)
-							else:
-								# TODO: This will die on substructs.
-								notCaring = onlyCareAboutTypes and structType not in onlyCareAboutTypes
-								self.structsByName[structName] = currentStruct = (
-									currentStruct if currentStruct else self
-								).addChild(structType, structName)
-								currentStruct.gennedName = genned
-							#endif
+							depth += 1
+							names.append(structName)
+							compiled.append(("struct", structType, structName, genned, line, char))
 						#endif
 					elif flow == "}":
 						# Close struct
-						if currentStruct is None: raise RPLError("} without a {.")
+						if not depth: raise RPLError("} without a {.")
 						elif parents: raise RPLError("Unclosed list.")
 						elif currentKey is not None:
 							raise RPLError("Key with no value. (Above here!)")
 						#endif
 
-						if isinstance(currentStruct, StructRPL):
-							self.load(currentStruct, onlyCareAboutTypes)
-						#endif
-						currentStruct = currentStruct.parent
+						depth -= 1
+						names.pop()
+						compiled.append(("end", line, char))
 					elif flow == "[":
 						# Begins list
 						parents.append([])
 					elif flow == "]":
 						# End list
-						if parents:
-							add = ("list", parents.pop())
-							skipSubInst = True
+						if parents: add = ("list", parents.pop())
 						else: raise RPLError("] without a [.")
 					elif flow == ",":
 						# Separator (only really directs the regex)
 						pass
 					#endif
-				elif key:
-					if currentStruct is None or parents:
+				elif kind == "key":
+					if not depth or parents:
 						prelit = key + ":" + afterkey
 					else: currentKey = key
-				elif sstr or mstr or num or ref:
-					add = self.parseData(groups, currentStruct, currentKey, line, char)
-				# This is for whitespace, comments, etc. Things with no return.
-				else: continue
+				else:
+					add = self.parseData(groups, names[-1] if names else None, currentKey, line, char, kind=kind)
+				#endif
 
 				if not lit and lastLit:
 					raise RPLError("Literal with no purpose: %s" % lastLit)
 				#endif
 
 				if add:
-					dtype = add[0]
-					val = self.parseCreate(add, currentStruct, currentKey, line, char, skipSubInst)
-
+					value = add + (line, char)
 					if parents:
-						parents[-1].append(val)
-					elif currentStruct and currentKey:
-						if not notCaring: currentStruct[currentKey] = val
+						parents[-1].append(value)
+					elif depth and currentKey:
+						compiled.append(("key", currentKey, value))
 						currentKey = None
 					else:
-						error = "Unused " + dtype
+						error = "Unused " + add[0]
+					#endif
+				#endif
+			except RPLError as err:
+				if err.positioned: raise
+				raise RPLError(err.args[1], pos=(line, char))
+			#endtry
+		#endfor
+
+		return compiled
+	#enddef
+
+	# Bump this when the compiled form changes in a way the parser's source
+	# doesn't show.
+	compiledVersion = 1
+	# Hash of the parser's source, see parserDigest.
+	parserHash = None
+
+	@staticmethod
+	def parserDigest():
+		"""
+		Return a hash of the source of this module, which compiled RPLs are
+		cached by. If the source can't be read, only the version is used.
+		"""
+		if RPL.parserHash is None:
+			digest = hashlib.sha1("%i:" % RPL.compiledVersion)
+			try:
+				with open(os.path.splitext(__file__)[0] + ".py", "rb") as f: digest.update(f.read())
+			except IOError: pass
+			RPL.parserHash = digest.hexdigest()
+		#endif
+		return RPL.parserHash
+	#enddef
+
+	def compiled(self, raw):
+		"""
+		Return RPL.compile's result for raw, using the cache in cacheFolder
+		if one is set. Cached forms are keyed by a hash of the source and of
+		the parser itself.
+		"""
+		if not self.cacheFolder: return self.compile(raw)
+
+		digest = hashlib.sha1(raw.encode("utf8") if type(raw) is unicode else raw)
+		digest.update(RPL.parserDigest())
+		path = os.path.join(self.cacheFolder, digest.hexdigest() + ".rplc")
+
+		# Anything wrong with a cached form just means compiling it again.
+		try:
+			with open(path, "rb") as f: return pickle.load(f)
+		except Exception: pass
+
+		compiled = self.compile(raw)
+		try:
+			helper.makeParents(path)
+			# Write to a temporary name first so other processes never read
+			# a partially written cache.
+			tmp = "%s.%i" % (path, os.getpid())
+			with open(tmp, "wb") as f: pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+			try: os.rename(tmp, path)
+			except OSError: os.unlink(tmp)
+		except (IOError, OSError, helper.RPLInternal): pass
+		return compiled
+	#enddef
+
+	def build(self, compiled, onlyCareAboutTypes=[], **kwargs):
+		"""
+		Instantiate structs and data from the instructions made by RPL.compile.
+		"""
+		currentStruct = None # What struct we are currently building.
+		notCaring = False    # Used for onlyCaseAboutTypes.
+
+		for op in compiled:
+			try:
+				if op[0] == "struct":
+					structType, structName, genned, line, char = op[1:]
+					if structName in self.structsByName and not kwargs.get("dupNames", False):
+						raise RPLError('Struct name "%s" is already taken.' % structName)
+					#endif
+
+					# TODO: This will die on substructs.
+					notCaring = onlyCareAboutTypes and structType not in onlyCareAboutTypes
+					self.structsByName[structName] = currentStruct = (
+						currentStruct if currentStruct else self
+					).addChild(structType, structName)
+					currentStruct.gennedName = genned
+				elif op[0] == "end":
+					line, char = op[1:]
+					if isinstance(currentStruct, StructRPL):
+						self.load(currentStruct, onlyCareAboutTypes)
+					#endif
+					currentStruct = currentStruct.parent
+				else:
+					key, value = op[1:]
+					line, char = value[2:]
+					if not notCaring:
+						currentStruct[key] = self.buildData(value, currentStruct, key)
 					#endif
 				#endif
 			except RPLError as err:
@@ -589,6 +856,68 @@ class RPL(RPLObject):
 		#endfor
 	#enddef
 
+	def buildData(self, value, currentStruct, currentKey):
+		"""
+		Instantiate a value of the form made by RPL.compile.
+		"""
+		dtype, val, line, char = value
+		if dtype == "list":
+			ret = self.packList("list", [x[0:2] for x in val], currentStruct, currentKey, line, char)
+			if ret is not None: return ret
+			return self.wrap("list", [
+				self.buildData(x, currentStruct, currentKey) for x in val
+			], currentStruct, currentKey, line, char)
+		else: return self.parseCreate((dtype, val), currentStruct, currentKey, line, char)
+	#enddef
+
+	@staticmethod
+	def tokenKind(groups):
+		"""
+		Return the kind of token the given groups of RPL.specification represent.
+		One of: literal, flow, key, reference, string, multi, number, or None for
+		whitespace, comments, and empty strings.
+		"""
+		dstr, sstr, mstr, num, key, afterkey, flow, ref, lit = groups
+		if lit: return "literal"
+		elif flow: return "flow"
+		elif key: return "key"
+		elif ref: return "reference"
+		elif dstr or sstr: return "string"
+		elif mstr: return "multi"
+		elif num: return "number"
+		else: return None
+	#enddef
+
+	@staticmethod
+	def tokenize(raw, start=0):
+		"""
+		Generator that splits raw RPL into typed tokens of the form:
+		(kind, groups, line, char)
+		kind is as returned by RPL.tokenKind and groups are the groups matched
+		by RPL.specification. Whitespace and comments are not returned.
+		Line and character numbers are tracked as it goes, rather than counted
+		from the beginning of the file for every token.
+		"""
+		# Line and character numbers are 1-based. (Because gedit is 1-based. o/ )
+		line, lastNewline, last = 1, -1, 0
+		for token in RPL.specification.finditer(raw, start):
+			groups = token.groups()
+			kind = RPL.tokenKind(groups)
+			if kind is None: continue
+
+			# Find the position (used for ref and errors).
+			pos = token.start()
+			newlines = raw.count("\n", last, pos)
+			if newlines:
+				line += newlines
+				lastNewline = raw.rfind("\n", last, pos)
+			#endif
+			last = pos
+
+			yield kind, groups, line, pos - lastNewline + 1
+		#endfor
+	#enddef
+
 	def parseCreate(self, add, currentStruct, currentKey, line, char, skipSubInst=False):
 		"""
 		Instantiates data. Used by parse and parseData
@@ -605,7 +934,12 @@ class RPL(RPLObject):
 			# So I don't have to have two branches doing the same thing we
 			# regard the data as a list for now, and change it back after.
 			if type(val) is not list: nl, val = True, [add]
-			else: nl = False
+			else:
+				nl = False
+				ret = self.packList(dtype, val, currentStruct, currentKey, line, char)
+				if ret is not None: return ret
+				elif dtype == "range": val = list(Range.expand(val))
+			#endif
 			val = [self.wrap(x[0], x[1], currentStruct, currentKey, line, char) for x in val]
 			if nl: val = val[0]
 			else: val = self.wrap(dtype, val, currentStruct, currentKey, line, char)
@@ -614,6 +948,20 @@ class RPL(RPLObject):
 		return val
 	#enddef
 
+	def packList(self, dtype, items, currentStruct, currentKey, line, char):
+		"""
+		Return a packed list or range of the given (type, value) pairs, or
+		None if they can't be packed. See List.pack.
+		"""
+		if (self.types.get(dtype) in (List, Range)
+			and [self.types.get(x) for x in List.packable] == [Number, HexNum, Literal]
+		):
+			ret = self.types[dtype](None, self, currentStruct, currentKey, line, char)
+			if ret.pack(items): return ret
+		#endif
+		return None
+	#enddef
+
 	@staticmethod
 	def numOrHex(num):
 		# Used by range parsing to make my life easier.
@@ -621,46 +969,54 @@ class RPL(RPLObject):
 		else: return ("number", int(num))
 	#enddef
 
-	def parseData(self, data, currentStruct=None, currentKey=None, line=-1, char=-1, raw=False):
+	def parseData(self, data, currentStruct=None, currentKey=None, line=-1, char=-1, raw=False, kind=None):
 		"""
 		Parse one value from string form. May also take in a preparsed string
 		though this has a different return form.
 		Passing as a tuple of preparsed data returns: (type, data)
 		Passing as a string returns just the wrapped data.
 		You may use raw to return unwrapped data, without type.
+		Preparsed data is the groups of a token from RPL.tokenize. If its kind
+		is known, pass that as well so it needn't be worked out again.
 		"""
 		# pp helps decide the returned form.
 		pp = type(data) is tuple
-		if pp: dstr, sstr, mstr, num, key, afterkey, flow, ref, lit = data
+		if pp:
+			groups = data
+			if kind is None: kind = RPL.tokenKind(groups)
+		elif data == "":
+			groups = (None, None, None, None, None, None, None, None, "")
+			kind = "literal"
 		else:
-			if data == "":
-				dstr, sstr, mstr, num, key, afterkey, flow, ref, lit = (
-					None, None, None, None, None, None, None, None, ""
+			token = RPL.specification.match(data)
+			if token is None:
+				raise RPLError(
+					"Syntax error in data: %s" % data,
+					currentStruct, currentKey, (line, char)
 				)
-			else:
-				try: dstr, sstr, mstr, num, key, afterkey, flow, ref, lit = RPL.specification.match(data).groups()
-				except AttributeError:
-					raise RPLError(
-						"Syntax error in data: %s" % data,
-						currentStruct, currentKey, (line, char)
-					)
-				#endtry
 			#endif
+			groups = token.groups()
+			kind = RPL.tokenKind(groups)
 		#endif
-		sstr = dstr or sstr
+		dstr, sstr, mstr, num, key, afterkey, flow, ref, lit = groups
 
 		add = None
 
-		if ref: add = ("reference", ref)
-		elif sstr: add = ("string", sstr)
-		elif mstr:
+		if kind == "reference": add = ("reference", ref)
+		elif kind == "string": add = ("string", dstr or sstr)
+		elif kind == "multi":
 			# Need to remove all `s and comments
 			add = ("refstr" if mstr[0] == "@" else "string", "".join(RPL.multilineStr.findall(mstr)))
-		elif num:
-			if not RPL.number.match(num):
+		elif kind == "number":
+			if num[0] == "-":
+				# Negative number. Ranges can't be negative, see specification.
+				t, n = RPL.numOrHex(num[1:])
+				add = (t, -n)
+			elif not RPL.number.match(num):
 				raise RPLError("Invalid range formatting.")
 			elif RPL.isRange.search(num):
-				# Range
+				# Range, as segments of (type, start, step, count) so that
+				# nothing is expanded here. See Range.pack.
 				numList = []
 				# Range commands are separated by colons.
 				ranges = num.split(":")
@@ -674,26 +1030,29 @@ class RPL(RPLObject):
 						# Left Type, Left...etc.
 						lt, l = RPL.numOrHex(bounds[0])
 						rt, r = RPL.numOrHex(bounds[1])
-						numList += [(lt, l)] + [("number", x) for x in (
-							list(range(l + 1, r)) if l < r else list(range(l - 1, r, -1))
-						)] + [(rt, r)]
+						step = 1 if l < r else -1
+						numList += [
+							(lt, l, 0, 1),
+							("number", l + step, step, abs(r - l) - 1),
+							(rt, r, 0, 1)
+						]
 					elif len(times) == 2:
 						lt, l = RPL.numOrHex(times[0])
 						rt, r = RPL.numOrHex(times[1])
-						numList += [(lt, x) for x in [l] * r]
+						numList.append((lt, l, 0, r))
 					elif len(inc) == 2:
 						lt, l = RPL.numOrHex(inc[0])
 						rt, r = RPL.numOrHex(inc[1])
-						numList += [(lt, x) for x in list(range(l, l + r))]
+						numList.append((lt, l, 1, r))
 					elif len(dec) == 2:
 						lt, l = RPL.numOrHex(dec[0])
 						rt, r = RPL.numOrHex(dec[1])
-						numList += [(lt, x) for x in list(range(l, l - r, -1))]
+						numList.append((lt, l, -1, r))
 					# Single character literal. Sometimes called a token.
 					elif r in "abcdefghijklmnopqrstuvwxyz":
-						numList.append(("literal", r))
+						numList.append(("literal", r, 0, 1))
 					# Otherwise it has to be a number.
-					else: numList.append(RPL.numOrHex(r))
+					else: numList.append(RPL.numOrHex(r) + (0, 1))
 				#endfor
 
 				add = ("range", numList)
@@ -704,17 +1063,15 @@ class RPL(RPLObject):
 				# Number.
 				add = ("number", int(num))
 			#endif
-		elif lit is not None:
+		elif kind == "literal":
 			add = ("literal", lit.strip())
 		elif not pp and flow == "[":
 			# Only parse lists when a string is passed.
 			# (Otherwise it's just the one token..)
-			tmp = RPL.specification.finditer(data)
-			tmp.next() # Skip the first flow
+			# This continues from after the first flow, rather than starting over.
 			lists = [[]]
-			for token in tmp:
-				token = token.groups()
-				dstr, sstr, mstr, num, key, afterkey, flow, ref, lit = token
+			for tkind, token, tline, tchar in RPL.tokenize(data, token.end()):
+				flow = token[6]
 				if flow == "[":
 					ls = []
 					lists[-1].append(ls)
@@ -723,7 +1080,7 @@ class RPL(RPLObject):
 					try: last = lists.pop()
 					except IndexError: break
 				elif flow == ",": pass
-				else: lists[-1].append(self.parseData(token, currentStruct, currentKey, line, char, raw))
+				else: lists[-1].append(self.parseData(token, currentStruct, currentKey, line, char, raw, tkind))
 			#endfor
 			add = ("list", last)
 		elif pp: raise RPLError("Invalid data.", currentStruct, currentKey, (line, char))
@@ -847,83 +1204,402 @@ class RPL(RPLObject):
 		folder   is the base folder for the project files.
 		what     is a list of names requested for use.
 		nocreate prevents the rom from being written to or created.
+
+		If manifest is set, structs whose files, references, and ROM data
+		are unchanged since the last import are skipped. See RPL.incremental.
 		"""
 		self.rom = rom = helper.stream(helper.FakeStream() if nocreate else rom)
-		self.importing = True
-		self.requested = what
-		lfolder = list(os.path.split(os.path.normpath(folder)))
+		try:
+			self.importing = True
+			self.requested = what
+			lfolder = list(os.path.split(os.path.normpath(folder)))
+
+			# Doing this in a two step process ensures proper ordering when
+			# importing shared data.
+			self.graph = RPLGraph(self)
+			self.graph.check()
+
+			if self.manifest and not nocreate:
+				fingerprint = self.fingerprint(what)
+				records, prepare, commit = self.incremental(fingerprint, rom)
+			else: records, prepare, commit = None, None, None
+
+			# Do preparations.
+			toImport, sources = [], {}
+			for x in self.recurse():
+				if prepare is not None and x not in prepare: continue
+				if x.manage(what):
+					self.sources = sources[x] = set()
+					try: x.importPrepare
+					except AttributeError: pass
+					else: x.importPrepare(rom, lfolder)
+					toImport.append(x)
+				#endif
+			#endfor
+			self.sources = None
+
+			# Now that everything is suspended in python, we can commit imports.
+			# Referenced structs are committed before what references them.
+			if not nocreate:
+				for x in self.graph.order(toImport):
+					if commit is not None and x not in commit: continue
+					try: x.importData
+					except AttributeError: pass
+					else: x.importData(rom, lfolder)
+				#endfor
+			#endif
 
-		# Doing this in a two step process ensures proper ordering when
-		# importing shared data.
+			if records is not None:
+				self.writeManifest(fingerprint, records, sources, rom)
+			#endif
+		finally:
+			# Always close, so the ROM is cut back down to size.
+			rom.close()
+			# Reset this to none, because python might still be running.
+			self.importing = self.rom = None
+			del self.requested
+		#endtry
+	#enddef
 
-		# Do preparations.
-		toImport = []
-		for x in self.recurse():
-			if x.manage(what):
-				try: x.importPrepare
-				except AttributeError: pass
-				else: x.importPrepare(rom, lfolder)
-				toImport.append(x)
+	def fingerprint(self, what):
+		"""
+		Return a hash of everything besides resources that affects an import:
+		the RPL source, its defines, what was requested, and the libraries.
+		"""
+		digest = self.digest.copy()
+		try: defs = self.structsByName["Defs"].data
+		except KeyError: defs = {}
+		digest.update(repr([(k, unicode(v)) for k, v in defs.iteritems()]))
+		digest.update(repr(sorted(what or [])))
+		libs = os.path.dirname(os.path.abspath(__file__))
+		for name, module in sorted(sys.modules.items()):
+			try: filename = os.path.abspath(module.__file__)
+			except AttributeError: continue
+			if filename.startswith(libs):
+				digest.update("%s%r" % (name, os.path.getmtime(filename)))
 			#endif
 		#endfor
+		return digest.hexdigest()
+	#enddef
 
-		# Now that everything is suspended in python, we can commit imports.
-		if not nocreate:
-			for x in toImport:
-				try: x.importData
-				except AttributeError: pass
-				else: x.importData(rom, lfolder)
+	@staticmethod
+	def fileDigest(filename, cache):
+		"""
+		Return the SHA-1 of the file's contents, or None if it can't be read.
+		"""
+		if filename not in cache:
+			try:
+				with open(filename, "rb") as f: cache[filename] = hashlib.sha1(f.read()).hexdigest()
+			except IOError: cache[filename] = None
+		#endif
+		return cache[filename]
+	#enddef
+
+	@staticmethod
+	def extent(struct):
+		"""
+		Return the (base, length) written to by the given struct, or None.
+		"""
+		try: return struct["base"].number(), struct.len()
+		except (RPLError, RPLBadType, AttributeError, TypeError): return None
+	#enddef
+
+	def incremental(self, fingerprint, rom):
+		"""
+		Compare the manifest against the current state of the project for the
+		current direction. Returns the records to keep, the structs to
+		prepare, and the structs to commit. The latter two are None if
+		everything must be ported.
+
+		A struct must be committed if any file it used changed, if its data
+		in the ROM changed (or for structs without a length, if the ROM
+		changed at all), or if anything it references must be committed.
+
+		When importing, so must anything overlapping it in the ROM, so that
+		writes happen in the same order as in a full import, and anything
+		whose base is relative to it.
+
+		When exporting, the base and length are resolved again, so relative
+		bases need no special care. But anything else writing to the same
+		file must be committed, since that file will be rewritten.
+
+		What committed structs reference must be prepared as well.
+		"""
+		try:
+			with open(self.manifest, "rb") as f: manifest = pickle.load(f)[self.importing]
+		except (IOError, EOFError, ValueError, KeyError, pickle.UnpicklingError): manifest = None
+		if not manifest or manifest["fingerprint"] != fingerprint: return {}, None, None
+
+		records, digests, structs = manifest["structs"], {}, {}
+		for name in records:
+			try: structs[name] = self.structsByName[name]
+			except KeyError: return {}, None, None
+		#endfor
+		ordered = sorted(structs.itervalues(), key=self.graph.index.get)
+		extents, forms = {}, {}
+		for x in ordered:
+			if records[x.name]["written"] is not None: extents[x] = records[x.name]["written"][:2]
+			try: forms[x] = x.baseForm()
+			except (AttributeError, RPLError): forms[x] = None
+		#endfor
+
+		# Without an extent, all that can be checked is that the ROM as a whole
+		# hasn't changed since the last time.
+		romChanged = hashlib.sha1(rom.view(0)).hexdigest() != manifest["rom"]
+		dirty = set()
+		for x in ordered:
+			record = records[x.name]
+			if x not in extents:
+				if romChanged and isinstance(x, Serializable): dirty.add(x)
+			elif not self.importing and RPL.extent(x) != extents[x]: dirty.add(x)
+			else:
+				base, length = extents[x]
+				if hashlib.sha1(rom.view(base, length)).hexdigest() != record["written"][2]:
+					dirty.add(x)
+				#endif
+			#endif
+			if x in dirty: continue
+			for filename, digest in record["files"].iteritems():
+				if RPL.fileDigest(filename, digests) != digest:
+					dirty.add(x)
+					break
+				#endif
+			#endfor
+		#endfor
+		if not dirty: return records, set(), set()
+
+		# Spread to everything that must be committed along with what's dirty.
+		stack = list(dirty)
+		if self.importing:
+			# Bases relative to the end of the file may move.
+			for x in ordered:
+				if forms[x] and forms[x][0] == 2 and x not in dirty:
+					dirty.add(x)
+					stack.append(x)
+				#endif
+			#endfor
+		else:
+			writers = {}
+			for x in ordered:
+				for filename in records[x.name]["files"]: writers.setdefault(filename, set()).add(x)
+			#endfor
+		#endif
+		while stack:
+			x = stack.pop()
+			spread = set(self.graph.dependents.get(x, ()))
+			if self.importing:
+				if x in extents:
+					base, length = extents[x]
+					for y, (b, l) in extents.iteritems():
+						if b < base + length and base < b + l: spread.add(y)
+					#endfor
+				#endif
+				index = self.graph.index[x]
+				for y in ordered:
+					if self.graph.index[y] > index and forms[y] and forms[y][0] == 1: spread.add(y)
+				#endfor
+			elif x.name in records:
+				for filename in records[x.name]["files"]: spread.update(writers[filename])
+			#endif
+			for y in spread:
+				if y not in dirty:
+					dirty.add(y)
+					stack.append(y)
+				#endif
+			#endfor
+		#endwhile
+
+		prepare = set(dirty)
+		if self.importing:
+			# Relative bases up to the first dirty struct can't have moved, so
+			# use the recorded ones. Those after it must be resolved by
+			# preparing everything from there on.
+			first = min(dirty, key=self.graph.index.get)
+			start = self.graph.index[first] if first in extents else -1
+			for x in ordered:
+				if not forms[x] or forms[x][0] != 1: continue
+				if self.graph.index[x] <= self.graph.index[first] and x in extents:
+					x["base"] = Number(extents[x][0])
+				elif x in dirty:
+					prepare.update(y for y in ordered if self.graph.index[y] >= start)
+					break
+				#endif
 			#endfor
 		#endif
 
-		rom.close()
-		# Reset this to none, because python might still be running.
-		self.importing = self.rom = None
-		del self.requested
+		# Referenced structs must be prepared for the dirty ones to use.
+		stack = list(prepare)
+		while stack:
+			for y in self.graph.edges.get(stack.pop(), ()):
+				if y not in prepare:
+					prepare.add(y)
+					stack.append(y)
+				#endif
+			#endfor
+		#endwhile
+
+		keep = dict((x.name, records[x.name]) for x in ordered if x not in dirty)
+		return keep, prepare & set(ordered), dirty
+	#enddef
+
+	def writeManifest(self, fingerprint, records, sources, rom):
+		"""
+		Record the files used and data written by the structs just ported
+		into the manifest, alongside the records kept by RPL.incremental.
+		Imports and exports are recorded separately.
+		"""
+		digests = {}
+		for x, files in sources.iteritems():
+			extent = RPL.extent(x)
+			if extent is not None:
+				base, length = extent
+				extent = (base, length, hashlib.sha1(rom.view(base, length)).hexdigest())
+			#endif
+			records[x.name] = {
+				"files": dict((filename, RPL.fileDigest(filename, digests)) for filename in files),
+				"written": extent,
+			}
+		#endfor
+
+		try:
+			with open(self.manifest, "rb") as f: manifest = pickle.load(f)
+		except (IOError, EOFError, ValueError, pickle.UnpicklingError): manifest = {}
+		manifest[self.importing] = {
+			"fingerprint": fingerprint, "structs": records,
+			"rom": hashlib.sha1(rom.view(0)).hexdigest(),
+		}
+
+		try:
+			helper.makeParents(self.manifest)
+			tmp = "%s.%i" % (self.manifest, os.getpid())
+			with open(tmp, "wb") as f: pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+			if os.path.exists(self.manifest): os.unlink(self.manifest)
+			os.rename(tmp, self.manifest)
+		except (IOError, OSError, helper.RPLInternal): pass
 	#enddef
 
-	def exportData(self, rom, folder, what=[], nocreate=False):
+	def exportData(self, rom, folder, what=[], nocreate=False, jobs=1):
 		"""
 		Export data from rom into folder according to what.
 		rom      is the location of the binary ROM file.
 		folder   is the base folder for the project files.
 		what     is a list of names requested for execution.
 		nocreate prevents the rom from being written to or created.
+		jobs     is the number of processes to decode independent structs in.
+
+		If manifest is set, structs whose ROM data, references, and files
+		are unchanged since the last export are skipped. See RPL.incremental.
 		"""
 		self.rom = rom = helper.stream(helper.FakeStream() if nocreate else rom)
-		self.importing = False
-		self.requested = what
-		lfolder = list(os.path.split(os.path.normpath(folder)))
+		try:
+			self.importing = False
+			self.requested = what
+			lfolder = list(os.path.split(os.path.normpath(folder)))
+
+			# Exports are lazily drawn from the ROM, as there is no ordering
+			# necessary since it's all based on fixed positions. Prerequisites are
+			# handled properly this way, such as pulling lengths or pointers from
+			# other blocks.
+			self.graph = RPLGraph(self)
+			self.graph.check()
+
+			if self.manifest and not nocreate:
+				fingerprint = self.fingerprint(what)
+				records, prepare, commit = self.incremental(fingerprint, rom)
+			else: records, prepare, commit = None, None, None
+
+			# Do preparations.
+			toExport, sources = [], {}
+			for x in self.recurse():
+				if prepare is not None and x not in prepare: continue
+				if x.manage(what):
+					try: x.exportPrepare
+					except AttributeError: pass
+					else: x.exportPrepare(rom, lfolder)
+					toExport.append(x)
+				#endif
+			#endfor
+			if commit is not None: toExport = [x for x in toExport if x in commit]
+
+			# Now that everything is suspended in python, we can write exports.
+			if not nocreate:
+				if jobs > 1: self.exportParallel(toExport, jobs)
+				for x in toExport:
+					self.sources = sources[x] = set()
+					try: x.exportData
+					except AttributeError: pass
+					else: x.exportData(rom, lfolder)
+				#endfor
+				self.sources = None
+				for x in self.sharedDataHandlers.itervalues(): x.write()
+			#endif
 
-		# Exports are lazily drawn from the ROM, as there is no ordering
-		# necessary since it's all based on fixed positions. Prerequisites are
-		# handled properly this way, such as pulling lengths or pointers from
-		# other blocks.
+			if records is not None:
+				self.writeManifest(fingerprint, records, sources, rom)
+			#endif
+		finally:
+			# Always close, so the ROM is cut back down to size.
+			rom.close()
+			# Reset this to none, because python might still be running.
+			self.importing = self.rom = None
+			del self.requested
+		#endtry
+	#enddef
 
-		# Do preparations.
-		toExport = []
-		for x in self.recurse():
-			if x.manage(what):
-				try: x.exportPrepare
-				except AttributeError: pass
-				else: x.exportPrepare(rom, lfolder)
-				toExport.append(x)
+	def independentStructs(self, structs):
+		"""
+		Return the structs in the given list that can be exported apart from
+		the rest. These implement exportWork, do not reference or get
+		referenced by another serializable struct, and have no such struct as
+		a child or parent.
+		"""
+		graph, ret = self.graph, []
+		for x in structs:
+			try: x.exportWork
+			except AttributeError: continue
+			# Statics and such don't change while exporting.
+			if x.children or [y for y in graph.edges[x] | graph.dependents[x] if isinstance(y, Serializable)]:
+				continue
 			#endif
+			try: x.parent.exportWork
+			except AttributeError: ret.append(x)
 		#endfor
+		return ret
+	#enddef
 
-		# Now that everything is suspended in python, we can write exports.
-		if not nocreate:
-			for x in toExport:
-				try: x.exportData
-				except AttributeError: pass
-				else: x.exportData(rom, lfolder)
-			for x in self.sharedDataHandlers.itervalues(): x.write()
+	def exportParallel(self, structs, jobs):
+		"""
+		Run exportWork for the independent structs among those given in a pool
+		of jobs processes, then give each struct its result. This way the
+		following exportData calls only have to merge them into the shared
+		data, which happens in the order the RPL defines.
+		"""
+		global exportQueue
+		# Workers must inherit the parsed RPL, which requires forking.
+		if not hasattr(os, "fork"): return
+		exportQueue = self.independentStructs(structs)
+		if len(exportQueue) < 2:
+			exportQueue = []
+			return
 		#endif
 
-		rom.close()
-		# Reset this to none, because python might still be running.
-		self.importing = self.rom = None
-		del self.requested
+		pool = multiprocessing.Pool(jobs)
+		try: results = pool.map(exportWorker, range(len(exportQueue)))
+		except multiprocessing.pool.MaybeEncodingError as err:
+			# A result that can't be sent back is no fault of the RPL, but it
+			# makes the parallel export pointless, so say so.
+			helper.err(RPLError("Could not export in parallel, exporting serially: %s" % err, etype="Warning"))
+			results = []
+		finally:
+			pool.close()
+			pool.join()
+		#endtry
+
+		for x, result in zip(exportQueue, results):
+			# Anything that failed is redone by exportData.
+			if result is not None: x.exportResult(result)
+		#endfor
+		exportQueue = []
 	#enddef
 
 	def run(self, folder, what=[]):
@@ -941,6 +1617,8 @@ class RPL(RPLObject):
 		self.importing = True
 		self.requested = what
 		lfolder = list(os.path.split(os.path.normpath(folder)))
+		self.graph = RPLGraph(self)
+		self.graph.check()
 
 		# Do preparations.
 		toExport = []
@@ -983,6 +1661,15 @@ class RPL(RPLObject):
 		raise RPLError('No type "%s" defined' % typeName)
 	#enddef
 
+	def uses(self, filename):
+		"""
+		Remember that the current struct reads or writes the given file, so
+		that changes to it are noticed by RPL.incremental. Files opened through
+		RPL.share are remembered already.
+		"""
+		if self.sources is not None: self.sources.add(filename)
+	#enddef
+
 	def share(self, share, create, *vargs, **kwargs):
 		"""
 		Return the handle by key (typically filename) of the shared data.
@@ -995,6 +1682,9 @@ class RPL(RPLObject):
 		create:  class used to instantiate the share, if not already created.
 		vargs & kwargs: arguments to pass for instantiation.
 		"""
+		# Remember which files the current struct uses, see RPL.incremental.
+		if isinstance(share, basestring) and share[0:1] != "?": self.uses(share)
+
 		# If it has already been created.
 		if share in self.sharedDataHandlers:
 			# The type for a class is "type".
@@ -1117,6 +1807,7 @@ class RPLTypeCheck(object):
 			raise TypeError("__init__() takes either 1 or 3 arguments (2 given)")
 		# Handle unparsed data
 		else: self.root = self.__parse(rplOrPreparsed, name, syntax)
+		self.root.compile()
 	#enddef
 
 	def __parse(self, rpl, name, syntax):
@@ -1238,47 +1929,74 @@ class RPLTCData(object):
 	"""
 	Helper class for RPLTypeCheck; contains one type.
 	"""
+	# Data types that pass as the given type without being recast.
+	basic = {
+		"string": ("string", "literal", "refstr"),
+		"number": ("number", "hexnum"),
+		"list": ("list", "range"),
+	}
+
 	def __init__(self, rpl, t, discrete=None):
 		self.rpl, self.type, self.discrete = rpl, t, discrete
+		# Type names accepted as is, if this is a simple type. See compile.
+		self.accept = None
 	#enddef
 
 	def verify(self, data, parentList=None):
+		return self.compile()(data, parentList)
+	#enddef
+
+	def compile(self):
+		"""
+		Build the verification function for this type and use it as verify.
+		"""
+		t, discrete = self.type, self.discrete
+
 		# Recursion operator check.
-		if self.type == "^":
-			if parentList is not None:
-				return parentList.verify(data, parentList)
-			else: raise RPLError(u"Attempted to recurse at top-level.")
-		# References are lazily verified.
-		elif data.reference(): return data
-		# If it's a struct, we can only return the struct if it's of type reference.
-		# Otherwise we should check its basic data.
-		elif data.struct():
-			if self.type == "reference": return data
-			else: data = data.basic()
-		# If there is a discrete set of values, verify within that.
-		elif self.discrete and data.get() not in self.discrete:
-			raise RPLError(u'Value "%s" not allowed in discrete set: %s.' % (
-				data.get(), helper.list2english(self.discrete)
-			), data.container, data.mykey, data.pos)
-		# Check if the given data is always valid.
-		elif self.type == "all": return data
-		# Otherwise, check the type
-		else:
-			# If it's a basic type and we want the most basic type, return as is.
-			if (data.typeName in ["string", "literal", "refstr"] and self.type == "string"
-				or data.typeName in ["number", "hexnum"] and self.type == "number"
-				or data.typeName in ["list", "range"] and self.type == "list"
-			): return data
+		if t == "^":
+			def verify(data, parentList=None):
+				if parentList is not None:
+					return parentList.verify(data, parentList)
+				else: raise RPLError(u"Attempted to recurse at top-level.")
+			#enddef
+			self.verify = verify
+			return verify
+		#endif
 
+		accept = frozenset((t,) + RPLTCData.basic.get(t, ()))
+		if not discrete and t != "all": self.accept = accept
+		wrap = self.rpl.wrap
+
+		def verify(data, parentList=None):
+			# References are lazily verified.
+			if data.reference(): return data
+			# If it's a struct, we can only return the struct if it's of type reference.
+			# Otherwise we should check its basic data.
+			elif data.struct():
+				if t == "reference": return data
+				else: data = data.basic()
+			# If there is a discrete set of values, verify within that.
+			elif discrete and data.get() not in discrete:
+				raise RPLError(u'Value "%s" not allowed in discrete set: %s.' % (
+					data.get(), helper.list2english(discrete)
+				), data.container, data.mykey, data.pos)
+			# Check if the given data is always valid.
+			elif t == "all": return data
+			# If it's already this type or a basic form of it, return as is.
+			elif data.typeName in accept: return data
 			# Otherwise, attempt to convert to the desired type.
-			try: return self.rpl.wrap(self.type, data.get())
-			except RPLError as err:
-				raise RPLError(
-					u"Error when recasting subclass: %s" % err.args[1],
-					data.container, data.mykey, data.pos
-				)
-			#endtry
-		#endif
+			else:
+				try: return wrap(t, data.get())
+				except RPLError as err:
+					raise RPLError(
+						u"Error when recasting subclass: %s" % err.args[1],
+						data.container, data.mykey, data.pos
+					)
+				#endtry
+			#endif
+		#enddef
+		self.verify = verify
+		return verify
 	#enddef
 #endclass
 
@@ -1289,77 +2007,106 @@ class RPLTCList(object):
 	"""
 	def __init__(self, l, r="]", num=None):
 		self.list, self.repeat, self.num = l, r, num
+		self.accept = None
 	def rep(self, r, num): self.repeat, self.num = r, num
 
 	def verify(self, data, parentList=None):
-		# Make sure data is a list (if it is 0 or more).
-		try: data.list()
-		except RPLBadType:
-			if self.repeat in "*!~.":
-				if self.num is not None:
-					# Select only the given index to compare.
-					if self.num >= len(self.list):
-						raise RPLError(u"Index not in list.")
-					#endif
-					tmp = self.list[self.num].verify(data)
-					if self.repeat in "*!": return List([tmp])
-					else: return tmp
-				#endif
+		return self.compile()(data, parentList)
+	#enddef
 
-				# This seems like strange form but it's the only logical form
-				# in my mind. This implies [A,B]* is A|B|[A,B]+
-				# Using * on a multipart list is a little odd to begin with.
-				for x in self.list:
-					try:
-						tmp = x.verify(data)
-						if self.repeat in "*!": return List([tmp])
+	def compile(self):
+		"""
+		Build the verification function for this list and use it as verify.
+		"""
+		contents, repeat, num = self.list, self.repeat, self.num
+		checks = [x.compile() for x in contents]
+		count = len(checks)
+
+		# Lists of a single simple type can be checked in bulk.
+		accept = contents[0].accept if count == 1 and repeat in "+*" else None
+
+		def verify(data, parentList=None):
+			# Make sure data is a list (if it is 0 or more).
+			try: data.list()
+			except RPLBadType:
+				if repeat in "*!~.":
+					if num is not None:
+						# Select only the given index to compare.
+						if num >= count:
+							raise RPLError(u"Index not in list.")
+						#endif
+						tmp = checks[num](data)
+						if repeat in "*!": return List([tmp])
 						else: return tmp
-					except RPLError: pass
-				#endfor
-				raise RPLError(
-					u"No permuation of single list data worked.",
-					data.container, data.mykey, data.pos
-				)
-			else: raise RPLError(u"Expected list.", data.container, data.mykey, data.pos)
-		#endif
+					#endif
+
+					# This seems like strange form but it's the only logical form
+					# in my mind. This implies [A,B]* is A|B|[A,B]+
+					# Using * on a multipart list is a little odd to begin with.
+					for check in checks:
+						try:
+							tmp = check(data)
+							if repeat in "*!": return List([tmp])
+							else: return tmp
+						except RPLError: pass
+					#endfor
+					raise RPLError(
+						u"No permuation of single list data worked.",
+						data.container, data.mykey, data.pos
+					)
+				else: raise RPLError(u"Expected list.", data.container, data.mykey, data.pos)
+			#endif
+
+			d = data.get()
+
+			# Bulk check, when everything is already of the type.
+			if accept is not None:
+				for x in d:
+					if x.typeName not in accept: break
+				else: return data
+			#endif
 
-		# Check lengths
-		d = data.get()
-		if self.repeat in "+*":
-			if self.repeat == "+" and self.num is not None:
-				# Number of non-repeating elements
-				diff = len(self.list) - self.num
-				if len(d) < diff or (len(d)-diff) % self.num:
+			# Check lengths
+			length = len(d)
+			if repeat in "+*":
+				if repeat == "+" and num is not None:
+					# Number of non-repeating elements
+					diff = count - num
+					if length < diff or (length - diff) % num:
+						raise RPLError(
+							u"Invalid list length.",
+							data.container, data.mykey, data.pos
+						)
+					#endif
+					order = [checks[i if i < diff else ((i - diff) % num) + diff] for i in helper.range(length)]
+				elif length % count == 0:
+					order = checks * (length // count)
+				else:
 					raise RPLError(
 						u"Invalid list length.",
 						data.container, data.mykey, data.pos
 					)
 				#endif
-				mod = (lambda i: i if i < diff else ((i-diff) % self.num) + diff)
-			elif (len(d) % len(self.list)) == 0:
-				mod = (lambda i: i % len(self.list))
+			elif length == count:
+				order = checks
 			else:
 				raise RPLError(
 					u"Invalid list length.",
 					data.container, data.mykey, data.pos
 				)
 			#endif
-		elif len(d) == len(self.list):
-			mod = (lambda i: i)
-		else:
-			raise RPLError(
-				u"Invalid list length.",
-				data.container, data.mykey, data.pos
-			)
-		#endif
 
-		# Loop through list contents to check them all
-		nd = []
-		for i, x in enumerate(d):
-			nd.append(self.list[mod(i)].verify(d[i], self))
-		#endfor
+			# Loop through list contents to check them all
+			nd = [check(x, self) for check, x in zip(order, d)]
 
-		return List(nd) if d != nd else data
+			# Only compare when something was recast.
+			for x, y in zip(d, nd):
+				if x is not y: return List(nd) if d != nd else data
+			#endfor
+			return data
+		#enddef
+		self.verify = verify
+		return verify
 	#enddef
 #endclass
 
@@ -1368,17 +2115,33 @@ class RPLTCOr(object):
 	"""
 	Helper class for RPLTypeCheck; contains one OR set.
 	"""
-	def __init__(self, orSet): self.orSet = orSet
+	def __init__(self, orSet):
+		self.orSet = orSet
+		self.accept = None
+	#enddef
 
 	def verify(self, data, parentList=None):
-		for x in self.orSet:
-			try: return x.verify(data, parentList)
-			except RPLError: pass
-		#endfor
-		raise RPLError(
-			u"Matched no options.",
-			data.container, data.mykey, data.pos
-		)
+		return self.compile()(data, parentList)
+	#enddef
+
+	def compile(self):
+		"""
+		Build the verification function for this set and use it as verify.
+		"""
+		checks = [x.compile() for x in self.orSet]
+
+		def verify(data, parentList=None):
+			for check in checks:
+				try: return check(data, parentList)
+				except RPLError: pass
+			#endfor
+			raise RPLError(
+				u"Matched no options.",
+				data.container, data.mykey, data.pos
+			)
+		#enddef
+		self.verify = verify
+		return verify
 	#enddef
 #endclass
 
@@ -1400,7 +2163,9 @@ class RPLStruct(RPLObject):
 		# Be sure to call this in your own subclasses!
 		RPLObject.__init__(self, rpl, name, parent)
 		self.clones = []
-		self.nocopy += ["clones"]
+		# Resolved values of keys, see __getitem__.
+		self.keyCache, self.keyGeneration = {}, None
+		self.nocopy += ["clones", "keyCache", "donor"]
 		# data and format structs set this value to false if they are going to
 		# manage it. This prevents the system from calling functions that will
 		# be called manually by those classes.
@@ -1493,10 +2258,58 @@ class RPLStruct(RPLObject):
 		"""
 		if self.clones: return List([x[key] for x in self.clones])
 
+		# Resolving may climb through parents and verify, so remember the
+		# result until it's written or the data of a parent changes.
+		stats, stamp = self.rpl.keyStats, self.keyStamp()
+		if self.keyGeneration == stamp:
+			try:
+				data = self.keyCache[key]
+				stats["hits"] += 1
+				return data
+			except KeyError: pass
+		else: self.keyCache, self.keyGeneration = {}, stamp
+		stats["misses"] += 1
+
+		data = self.keyCache[key] = self.resolveKey(key)
+		return data
+	#enddef
+
+	def keyStamp(self):
+		"""
+		Return the generations of the data of this struct's parents.
+		Resolved keys are good for as long as this stays the same, and the
+		struct's own writes are handled by forgetKey.
+		"""
+		ret, x = [], self.parent
+		while x and x is not self.rpl:
+			ret.append(x.data.generation)
+			x = x.parent
+		#endwhile
+		return ret
+	#enddef
+
+	def forgetKey(self, key=None):
+		"""
+		Drop the resolved value of key, and of its virtuals, from the cache.
+		If key is None, drop everything.
+		"""
+		if key is None: self.keyCache = {}
+		elif self.keyCache:
+			self.keyCache.pop(key, None)
+			for k, x in self.virtuals.iteritems():
+				if x == key: self.keyCache.pop(k, None)
+			#endfor
+		#endif
+	#enddef
+
+	def resolveKey(self, key):
+		"""
+		Find data for key, uncached. See __getitem__.
+		"""
 		# We only want to check virtuals if we have to.
 		if key not in self.data and key not in self.keys and key in self.virtuals: key = self.virtuals[key]
 		if key in self.data or key in self.keys:
-			if key in self.data: data = self.data[key]
+			if key in self.data: data, container = self.data[key], None
 			else:
 				x, data = self.parent, None
 				while x and x != self.rpl:
@@ -1505,21 +2318,26 @@ class RPLStruct(RPLObject):
 						break
 					except RPLKeyError as err: x = x.parent
 				#endwhile
+				# Defaults have no container, but are typed by the ancestor.
+				container = x
 			#endif
 
 			if data is not None:
+				if key not in self.keys: return data
+				if data.container is not None: container = data.container
 				# Verify that typing is the same between this ancestor and itself
 				# This is just a quick check for speed.
-				if (key not in self.keys or (data.container is not None and
-					key in data.container.keys and
-					data.container.keys[key][0].source == self.keys[key][0].source
-				)): return data
+				if (container is not None and key in container.keys and
+					container.keys[key][0].source == self.keys[key][0].source
+				): return data
 
 				# Otherwise, run the verification
 				return self.keys[key][0].verify(data)
+			# Defaults are shared between all structs of this type, and kept
+			# apart from their data so that checks like "base" not in self.data
+			# still mean the key was really set.
 			elif key in self.keys and self.keys[key][1] is not None:
-				self.data[key] = copy.deepcopy(self.keys[key][1], {"parent": self})
-				return self.data[key]
+				return self.keys[key][1]
 			#endif
 		#endif
 		raise RPLKeyError('No key "%s" in "%s"' % (key, self.name))
@@ -1730,17 +2548,26 @@ class RPLStruct(RPLObject):
 	def reference(self): return False
 	def struct(self): return True
 
-	def clone(self):
-		new = copy.deepcopy(self)
+	def clone(self, shared=()):
+		"""
+		Make a copy of this struct that is registered as one of its clones.
+		shared: Attributes to share with the clone rather than copy, for ones
+		        that the caller knows will be left alone.
+		"""
+		new = copy.deepcopy(self, {"shared": shared})
 		new.donor = self
 		# Needs its own clones.
 		new.clones = []
+		new.cloneIndex = len(self.clones)
 		self.clones.append(new)
+		# Things inheriting from this now see the clones.
+		self.data.touch()
 		return new
 	#enddef
 
 	def __deepcopy__(self, memo={}):
 		ret = RPLObject.__deepcopy__(self, memo)
+		ret.keyCache, ret.keyGeneration = {}, None
 		return ret
 	#enddef
 #endclass
@@ -1873,88 +2700,106 @@ class ROM(RPLStruct):
 		"""
 		Return CRC of data in stream referred to by the range of addresses.
 		"""
-		seek, read = None, None
-		direction, crc = 0, 0
-		stream.seek(0, 2)
-		eof = stream.tell()
+		return helper.crcRuns(stream, ROM.addressRuns(stream, rang))
+	#enddef
+
+	@staticmethod
+	def addressRuns(stream, rang):
+		"""
+		Return the addresses in stream referred to by the range as runs of
+		(start, step, count), see helper.crcRuns.
+		"""
+		eof = helper.streamSize(stream)
 		try:
 			# Address to EOF.
-			rang = list(range(rang.number(), eof))
+			start = rang.number()
+			return [(start, 1, eof - start)]
 		except RPLBadType:
-			# Not all were numbers.
-			rang = rang.list("get")
+			# Not all were numbers. Work on runs of addresses rather than
+			# listing them, see Range.spans.
+			runs = rang.spans()
 			try:
-				if rang[-1] == "e":
-					if rang[-2] == "b": r = list(range(0, eof))
-					else: r = list(range(rang[-2], eof))
-					rang = rang[0:-1] + r
-				elif rang[0] == "e":
-					if rang[1] == "b": r = list(range(eof, -1, -1))
-					else: r = list(range(eof, rang[1] - 1, -1))
-					rang = r + rang[1:]
-				elif rang[-1] == "b":
+				first, last = rang.at(0).get(), rang.at(-1).get()
+				if last == "e":
+					x = rang.at(-2).get()
+					if x == "b": runs.append((0, 1, eof))
+					else: runs.append((x, 1, eof - x))
+				elif first == "e":
+					x = rang.at(1).get()
+					if x == "b": runs.insert(0, (eof, -1, eof + 1))
+					else: runs.insert(0, (eof, -1, eof - x + 1))
+				elif last == "b":
 					# By the time it checks b's, e will have already handled b:e and e:b
-					rang = rang[0:-1] + list(range(rang[-2], -1, -1))
-				elif rang[0] == "b":
-					rang = list(range(0, rang[1])) + rang[1:]
+					x = rang.at(-2).get()
+					runs.append((x, -1, x + 1))
+				elif first == "b":
+					runs.insert(0, (0, 1, rang.at(1).get()))
 				#endif
-			except TypeError:
+			except (TypeError, IndexError):
 				raise RPLError("e and b must only be at the beginning or "
 					"end of a CRC32 range check. Do not use other letters."
 				)
 			#endtry
+			return runs
+		#endtry
+	#enddef
+
+	def validate(self, rom):
+		"""
+		Validate contents of ROM file.
+		"""
+		successes, failed = self.validateHeader(rom)
+
+		# Verify text
+		for idx, x in enumerate(self["text"].get()):
+			x = x.get()
+			text = x[0].string()
+			if str(rom.view(x[1].number(), len(text))) != text:
+				failed.append(("text", idx))
+			else: successes += 1
+		#endfor
+
+		# Verify crc32s
+		try:
+			expected = self["crc32"].number()
+			if helper.fileCRC(rom) != expected:
+				failed.append(("crc32", 0))
+			else: successes += 1
+		except RPLBadType:
+			checks = [x.list() for x in self["crc32"].list()]
+			crcs = helper.crcMany(rom, [ROM.addressRuns(rom, x[1]) for x in checks])
+			for idx, x in enumerate(checks):
+				if crcs[idx] != x[0].number():
+					failed.append(("crc32", idx))
+				else: successes += 1
+			#endfor
 		#endtry
+		return successes, failed
+	#enddef
 
-		# Adding "END" here is a bit of a trick to commit the crc creation on
-		# the last iteration.
-		for x in rang + ["END"]:
-			if read:
-				isPos = seek + read == x
-				isNeg = seek - read == x
-			#endif
-			if read and ((isPos and direction != -1) or (isNeg and direction != 1)):
-				read += 1
-				if isPos: direction = 1
-				else: direction = -1
-			else:
-				if read:
-					if direction == -1:
-						stream.seek(seek - read + 1)
-						data = stream.read(read)
-						data = data[::-1]
-					else:
-						stream.seek(seek)
-						data = stream.read(read)
-					#endif
-					crc = crc32(data, crc) & 0xFFFFFFFF
-				#endif
-				if type(x) in [int, long]: seek, read = x, 1
-				else: seek, read = None, None
-			#endif
-		#endfor
-		return crc
+	def headers(self):
+		"""
+		Return the serialized IDs and names to check for.
+		"""
+		return (
+			[x.serialize(**self.id_format) for x in self["id"].list()],
+			[x.serialize(**self.name_format) for x in self["name"].list()],
+		)
 	#enddef
 
-	def validate(self, rom):
+	def validateHeader(self, rom):
 		"""
-		Validate contents of ROM file.
+		Validate only the ID and name of the ROM file.
 		"""
 		successes, failed = 0, []
 		# Create all IDs and names. Grab max lengths
-		ids, names, max_id_len, max_name_len = [], [], 0, 0
-		for x in self["id"].list():
-			ids.append(x.serialize(**self.id_format))
-			max_id_len = max(len(ids[-1]), max_id_len)
-		#endfor
-		for x in self["name"].list():
-			names.append(x.serialize(**self.name_format))
-			max_name_len = max(len(names[-1]), max_name_len)
-		#endfor
+		ids, names = self.headers()
+		max_id_len = max(map(len, ids)) if ids else 0
+		max_name_len = max(map(len, names)) if names else 0
 
 		# Verify ID
 		if ids:
-			rom.seek(self.id_location)
-			tmp = rom.read(max_id_len)
+			tmp = rom.view(self.id_location, max_id_len)
 			ok = False
 			for x in ids:
 				if tmp[0:len(x)] == x:
@@ -1968,8 +2813,7 @@ class ROM(RPLStruct):
 
 		# Verify name
 		if names:
-			rom.seek(self.name_location)
-			tmp = rom.read(max_name_len)
+			tmp = rom.view(self.name_location, max_name_len)
 			ok = False
 			for x in names:
 				if tmp[0:len(x)] == x:
@@ -1981,32 +2825,21 @@ class ROM(RPLStruct):
 			else: failed.append("name")
 		#endif
 
-		# Verify text
-		for idx, x in enumerate(self["text"].get()):
+		return successes, failed
+	#enddef
+
+	def plausible(self, rom):
+		"""
+		Quickly check if the ROM file could pass validation, by its size and
+		its ID and name, without reading anything else.
+		"""
+		# It must at least be big enough to hold the text.
+		size = helper.streamSize(rom)
+		for x in self["text"].get():
 			x = x.get()
-			rom.seek(x[1].number())
-			text = x[0].string()
-			if rom.read(len(text)) != text:
-				failed.append(("text", idx))
-			else: successes += 1
+			if x[1].number() + len(x[0].string()) > size: return False
 		#endfor
-
-		# Verify crc32s
-		try:
-			crc32 = self["crc32"].number()
-			rom.seek(0)
-			if crc32(rom.read()) & 0xFFFFFFFF != crc32:
-				failed.append(("crc32", 0))
-			else: successes += 1
-		except RPLBadType:
-			for idx, x in enumerate(self["crc32"].list()):
-				x = x.list()
-				if getCRC(rom, x[1]) != x[0].number():
-					failed.append(("crc32", idx))
-				else: successes += 1
-			#endfor
-		#endtry
-		return successes, failed
+		return not self.validateHeader(rom)[1]
 	#enddef
 
 	@classmethod
@@ -2132,6 +2965,32 @@ class Serializable(RPLStruct):
 		if port == "requested": return self.rpl.wantPort(self, requested)
 	#enddef
 
+	def baseForm(self):
+		"""
+		Return (rel, offset) if the base is relative, where rel is 0 for the
+		start of the file, 1 for the end of the preceding struct, and 2 for
+		the end of the file. Returns None if it is a fixed address.
+		"""
+		value = RPLStruct.__getitem__(self, "base")
+		try:
+			v = value.list()
+			return {
+				"b": 0, "begin": 0, "s": 0, "start": 0,
+				"c": 1, "cur": 1, "current": 1,
+				"e": 2, "end": 2
+			}[v[0].string()], v[1].number()
+		except (RPLBadType, AttributeError):
+			# Check if it's a RPLData, more or less.
+			try: value.get
+			except AttributeError: pass
+			else: v = value.get()
+			if v in ["b", "s", "begin", "start"]: return 0, 0
+			elif v in ["c", "cur", "current"]: return 1, 0
+			elif v in ["e", "end"]: return 2, 0
+			else: return None
+		#endtry
+	#enddef
+
 	def __getitem__(self, key):
 		if key == "file":
 			# Calculate filename
@@ -2167,39 +3026,23 @@ class Serializable(RPLStruct):
 			return filename
 		elif key == "base":
 			# Handles all the inheritance and defaulting and such.
-			value = RPLStruct.__getitem__(self, "base")
+			form = self.baseForm()
+			if form is None: return RPLStruct.__getitem__(self, "base")
+			rel, base = form
 			rom = self.rpl.rom
 
-			try:
-				v = value.list()
-				rel, base = {
-					"b": 0, "begin": 0, "s": 0, "start": 0,
-					"c": 1, "cur": 1, "current": 1,
-					"e": 2, "end": 2
-				}[v[0].string()], v[1].number()
-			except (RPLBadType, AttributeError):
-				# Check if it's a RPLData, more or less.
-				try: value.get
-				except AttributeError: pass
-				else: v = value.get()
-				if v in ["b", "s", "begin", "start"]: rel, base = 0, 0
-				elif v in ["c", "cur", "current"]: rel, base = 1, 0
-				elif v in ["e", "end"]: rel, base = 2, 0
-				else: return value
-			#endtry
-
 			# Retrieve relative to current.
 			if rel == 1:
 				parent = self.parent
-				try:
-					index = parent.children.values().index(self)
+				if parent.children.get(self.name) is self:
+					index = parent.childIndex(self.name)
 					base = None
 				# If it's not in its parent's children, it must be a clone.
-				except ValueError:
-					index = parent.children.values().index(self.donor)
+				else:
+					index = parent.childIndex(self.donor.name)
 					# Quickly check if the preceding clone can tell it where it is.
 					# Well it should be able to!
-					cloneIndex = self.donor.clones.index(self)
+					cloneIndex = self.cloneIndex
 					if cloneIndex > 0:
 						try:
 							clone = self.donor.clones[cloneIndex - 1]
@@ -2209,19 +3052,19 @@ class Serializable(RPLStruct):
 						except (TypeError, RPLError, AttributeError): pass
 					#endif
 					# Otherwise we can just let the loop run.
-				#endtry
+				#endif
 				# Backs up through all structs in a linear fashion
 				while parent:
 					# For each child in this structure
 					while index > 0:
 						index -= 1
-						previousSibling = parent.children.values()[index]
+						previousSibling = parent.childAt(index)
 
 						# If this sibling has children, start at its last child first.
 						while len(previousSibling.children):
 							index = len(previousSibling.children) - 1
 							parent = previousSibling
-							previousSibling = parent.children.values()[index]
+							previousSibling = parent.childAt(index)
 						#endif
 
 						# This is not relevant to the structure if system isn't managing it.
@@ -2245,7 +3088,7 @@ class Serializable(RPLStruct):
 						#endif
 					#endwhile
 					if base is not None: break
-					if parent.parent: index = parent.parent.children.values().index(parent)
+					if parent.parent: index = parent.parent.childIndex(parent.name)
 					parent = parent.parent
 					if parent and parent != self.parent:
 						# Check the parent, too. Don't check own parent though,
@@ -2562,18 +3405,181 @@ class RPLRef(object):
 	#enddef
 #endclass
 
+class RPLGraph(object):
+	"""
+	Dependency graph of the references made between structs and their keys.
+	Key nodes are (struct, key) pairs, where key is None when the reference
+	is to the struct itself. Struct edges collapse these to the structs
+	involved, where struct -> structs it references.
+	"""
+
+	def __init__(self, rpl, structs=None):
+		"""
+		rpl:     The RPL instance the structs belong to.
+		structs: Structs to graph, in document order. Defaults to all of them.
+		"""
+		self.rpl = rpl
+		self.structs = list(rpl.recurse()) if structs is None else list(structs)
+		self.index = dict((x, i) for i, x in enumerate(self.structs))
+		self.keyEdges, self.edges, self.dependents = {}, {}, {}
+		for x in self.structs:
+			self.edges.setdefault(x, set())
+			self.dependents.setdefault(x, set())
+			for key, value in x.data.iteritems():
+				for ref in RPLGraph.references(value):
+					target = RPLGraph.resolve(ref)
+					if target is None: continue
+					self.keyEdges.setdefault((x, key), set()).add(target)
+					if target[0] is not x:
+						self.edges[x].add(target[0])
+						self.dependents.setdefault(target[0], set()).add(x)
+					#endif
+				#endfor
+			#endfor
+		#endfor
+	#enddef
+
+	@staticmethod
+	def references(value):
+		"""
+		Return a list of all the RPLRefs in the given value, including those
+		inside of lists, RefStrings, and Maths.
+		"""
+		refs, stack = [], [value]
+		while stack:
+			x = stack.pop()
+			if isinstance(x, RPLRef): refs.append(x)
+			elif isinstance(x, RefString): stack.extend(x.data[1::2])
+			elif isinstance(x, List): stack.extend(x.data)
+			elif isinstance(x, Math):
+				ops = [x.data]
+				while ops:
+					op = ops.pop()
+					if type(op) is tuple: ops.extend(op)
+					elif isinstance(op, basestring) and op[0:1] == "@":
+						refs.append(RPLRef(op[1:], x.rpl, x.container, x.mykey, *x.pos))
+					#endif
+				#endwhile
+			#endif
+		#endwhile
+		return refs
+	#enddef
+
+	@staticmethod
+	def resolve(ref):
+		"""
+		Return the (struct, key) node the given reference points to, or None
+		if that can only be known at runtime, as with back references.
+		"""
+		try: struct = ref.pointer()
+		except RPLError: return None
+		return struct, ref.keysets[0][0] if ref.keysets else None
+	#enddef
+
+	def check(self):
+		"""
+		Raise an RPLError if any key depends on itself through its references.
+		"""
+		# 1 is on the current path, 2 is finished.
+		state = {}
+		for start in self.keyEdges:
+			if start in state: continue
+			path, stack = [], [(start, iter(self.keyEdges[start]))]
+			state[start] = 1
+			path.append(start)
+			while stack:
+				node, edges = stack[-1]
+				for target in edges:
+					if state.get(target) == 1:
+						cycle = path[path.index(target):] + [target]
+						raise RPLError("Reference cycle: %s" % " -> ".join([
+							x.name + ("." + key if key else "") for x, key in cycle
+						]), node[0], node[1])
+					elif target not in state:
+						state[target] = 1
+						path.append(target)
+						stack.append((target, iter(self.keyEdges.get(target, ()))))
+						break
+					#endif
+				else:
+					state[node] = 2
+					path.pop()
+					stack.pop()
+				#endfor
+			#endwhile
+		#endfor
+	#enddef
+
+	def order(self, structs=None):
+		"""
+		Return the given structs, by default all of them, sorted so that each
+		comes after the structs it references. Otherwise document order is
+		kept, which is also how structs referencing each other are ordered.
+		"""
+		if structs is None: structs = self.structs
+		wanted = set(structs)
+		waiting, ready, ret = {}, [], []
+		for x in structs:
+			waiting[x] = len(self.edges.get(x, set()) & wanted)
+			if not waiting[x]: heapq.heappush(ready, (self.index[x], x))
+		#endfor
+		while waiting:
+			# Break cycles by taking whichever comes first in the document.
+			if not ready:
+				x = min(waiting, key=self.index.get)
+				heapq.heappush(ready, (self.index[x], x))
+			#endif
+			x = heapq.heappop(ready)[1]
+			if x not in waiting: continue
+			del waiting[x]
+			ret.append(x)
+			for d in self.dependents.get(x, ()):
+				if d in waiting:
+					waiting[d] -= 1
+					if waiting[d] == 0: heapq.heappush(ready, (self.index[d], d))
+				#endif
+			#endfor
+		#endwhile
+		return ret
+	#enddef
+#endclass
+
 ################################################################################
 #################################### RPLData ###################################
 ################################################################################
 
 class RPLData(object):
+	# There are a lot of these, so they don't get a __dict__. Subclasses in
+	# libraries may leave out __slots__, which gives them one as usual.
+	__slots__ = ("rpl", "container", "mykey", "pos", "data")
+
+	# Attributes that should not be copied in a deep copy, see RPLObject.
+	# Add to this in subclasses with nocopy = Parent.nocopy + ("name", ...)
+	nocopy = ("rpl", "container", "pos")
+
 	def __init__(self, data=None, top=None, container=None, mykey=None, line=None, char=None):
 		self.rpl, self.container, self.mykey, self.pos = top, container, mykey, (line, char)
-		self.nocopy = ["rpl", "container"]
 
 		if data is not None: self.set(data)
 	#enddef
 
+	@classmethod
+	def slots(cls):
+		"""
+		Return (name, descriptor) for every slot of this class, including
+		inherited ones. The descriptors access the slots directly.
+		"""
+		try: return cls.__dict__["allSlots"]
+		except KeyError:
+			ret = []
+			for c in reversed(cls.__mro__):
+				for k in c.__dict__.get("__slots__", ()): ret.append((k, c.__dict__[k]))
+			#endfor
+			cls.allSlots = ret
+			return ret
+		#endtry
+	#enddef
+
 	def get(self): return self.data
 	def set(self, data): self.data = data
 	def resolve(self): return self
@@ -2583,6 +3589,16 @@ class RPLData(object):
 	def reference(self): return False
 	def struct(self): return False
 
+	def ending(self):
+		"""
+		Return "#" if the string form of this ends in a comment, "," if it
+		ends in its own comma, or "" otherwise. This lets writers know what
+		may follow it without parsing it. Line breaks should only be written
+		after comments, since writers rely on this too.
+		"""
+		return u""
+	#enddef
+
 	# You must define these in your own types.
 	def defaultSize(self):
 		"""
@@ -2625,9 +3641,20 @@ class RPLData(object):
 
 	def __deepcopy__(self, memo={}):
 		ret = object.__new__(self.__class__)
-		for k, x in self.__dict__.iteritems():
-			if k in self.nocopy or callable(x): setattr(ret, k, x)
-			else: setattr(ret, k, copy.deepcopy(x, memo))
+		attrs = []
+		for k, slot in self.slots():
+			try: attrs.append((k, slot.__get__(self), slot.__set__))
+			except AttributeError: pass
+		#endfor
+		try: attrs += [(k, x, None) for k, x in self.__dict__.iteritems()]
+		except AttributeError: pass
+
+		for k, x, slot in attrs:
+			if not (k in self.nocopy or callable(x) or type(x) in CopyOnWrite.immutable):
+				x = copy.deepcopy(x, memo)
+			#endif
+			if slot: slot(ret, x)
+			else: setattr(ret, k, x)
 		#endfor
 		# Something for clones in references, I suppose adding it here is just completist.
 		ret.container = memo["parent"]
@@ -2639,6 +3666,8 @@ class String(RPLData):
 	"""
 	String basic type.
 	"""
+	__slots__ = ()
+
 	typeName = "string"
 
 	escape = re.compile(r'\$(\$|[0-9a-fA-F]{2})')
@@ -2709,6 +3738,8 @@ class Literal(String):
 	"""
 	Literal interpreted type.
 	"""
+	__slots__ = ()
+
 	typeName = "literal"
 
 	badchr = re.compile(r'^[ \t]|[\x00-\x08\x0a-\x1f\x7f-\xff{}\[\],\$@"#\r\n' r"']|[ \t]$")
@@ -2734,6 +3765,7 @@ class RefString(String):
 	"""
 	String that contains references, replaced when requested.
 	"""
+	__slots__ = ()
 
 	typeName = "refstr"
 
@@ -2794,6 +3826,8 @@ class RefString(String):
 	def __unicode__(self):
 		return '@`' + String.binchr.sub(String.replOut, self.string()) + '`,'
 	#enddef
+
+	def ending(self): return u","
 #endclass
 
 class Path(Literal):
@@ -2808,6 +3842,8 @@ class Path(Literal):
 	If you use a system that doesn't use theses, that's fine, your system's
 	will be used in the return value. But you must enter it in the above form.
 	"""
+	__slots__ = ("startingSlash", "ext")
+
 	typeName = "path"
 
 	@staticmethod
@@ -2841,6 +3877,8 @@ class Number(RPLData):
 	"""
 	Number basic type.
 	"""
+	__slots__ = ()
+
 	typeName = "number"
 
 	def set(self, data):
@@ -2859,26 +3897,87 @@ class Number(RPLData):
 
 	def defaultSize(self): return 4
 
-	def serialize(self, **kwargs):
-		big, ander, ret = (kwargs["endian"] == "big"), 0xff, r''
-		for i in helper.range(kwargs["size"]):
-			c = chr((self.data & ander) >> (i*8))
-			if big: ret = c + ret
-			else: ret += c
-			ander <<= 8
-		#endfor
+	# Struct format characters of sizes which have one, see Number.codec.
+	formats = {1: "B", 2: "H", 4: "I", 8: "Q"}
+	# Codecs for single numbers, by (size, big, signed).
+	codecs = {}
+
+	@staticmethod
+	def codec(size, big=False, signed=False, count=1):
+		"""
+		Return a Struct for count numbers of the given size in bytes, or None
+		if the size has no struct format.
+		"""
+		if count == 1:
+			try: return Number.codecs[size, big, signed]
+			except KeyError: pass
+		#endif
+		try: fmt = Number.formats[size]
+		except KeyError: return None
+		ret = Struct("%s%i%s" % (">" if big else "<", count, fmt.lower() if signed else fmt))
+		if count == 1: Number.codecs[size, big, signed] = ret
 		return ret
 	#enddef
 
+	def serialize(self, **kwargs):
+		size = kwargs["size"]
+		# Numbers that don't fit are cut down, negative ones to two's complement.
+		value = self.data & ((1 << (size * 8)) - 1)
+		codec = Number.codec(size, kwargs["endian"] == "big")
+		if codec: return codec.pack(value)
+		return Number.serializeArray([value], size, kwargs["endian"])
+	#enddef
+
 	def unserialize(self, data, **kwargs):
-		big = (kwargs["endian"] == "big")
-		size = len(data)
-		self.data = 0
-		for i,x in enumerate(data):
-			if big: shift = size-i-1
-			else: shift = i
-			self.data |= ord(x) << (shift*8)
-		#endfor
+		size, big = len(data), (kwargs["endian"] == "big")
+		signed = kwargs.get("sign") == "signed"
+		codec = Number.codec(size, big, signed)
+		if codec: self.data = codec.unpack(data)[0]
+		elif size:
+			self.data = int(hexlify(data if big else data[::-1]), 16)
+			if signed and self.data >> (size * 8 - 1): self.data -= 1 << (size * 8)
+		else: self.data = 0
+	#enddef
+
+	@staticmethod
+	def serializeArray(values, size, endian="little", sign="unsigned"):
+		"""
+		Serialize a list of ints which are all the same size, in one go.
+		Like serialize, values are cut down to fit. Sign is only for symmetry
+		with unserializeArray, since two's complement is the same either way.
+		"""
+		if size <= 0 or not values: return ""
+		big, mask = (endian == "big"), (1 << (size * 8)) - 1
+		codec = Number.codec(size, big, count=len(values))
+		if codec: return codec.pack(*[x & mask for x in values])
+		# Sizes without a struct format are built as one big hex string.
+		# Reversing it all makes each number little endian, in reverse order.
+		fmt = "%%0%ix" % (size * 2)
+		if big: return unhexlify("".join([fmt % (x & mask) for x in values]))
+		return unhexlify("".join([fmt % (x & mask) for x in reversed(values)]))[::-1]
+	#enddef
+
+	@staticmethod
+	def unserializeArray(data, size, endian="little", sign="unsigned"):
+		"""
+		Return the list of ints in data, each being size bytes, in one go.
+		Any bytes left over at the end are ignored.
+		"""
+		count = len(data) // size if size > 0 else 0
+		if not count: return []
+		data, big, signed = data[:count * size], (endian == "big"), (sign == "signed")
+		codec = Number.codec(size, big, signed, count)
+		if codec: return list(codec.unpack(data))
+		step = size * 2
+		if big: data = hexlify(data)
+		else: data = hexlify(data[::-1])
+		ret = [int(data[i:i + step], 16) for i in xrange(0, len(data), step)]
+		if not big: ret.reverse()
+		if signed:
+			top, full = 1 << (size * 8 - 1), 1 << (size * 8)
+			ret = [x - full if x >= top else x for x in ret]
+		#endif
+		return ret
 	#enddef
 #endclass
 
@@ -2886,17 +3985,39 @@ class HexNum(Number):
 	"""
 	HexNum interpreted type.
 	"""
+	__slots__ = ()
+
 	typeName = "hexnum"
 
-	def __unicode__(self): return "$%x" % self.data
+	def __unicode__(self):
+		if self.data < 0: return "-$%x" % -self.data
+		else: return "$%x" % self.data
+	#enddef
 #endclass
 
 class List(RPLData):
 	"""
 	List basic type.
+	Lists of plain numbers and one character literals may be packed into
+	arrays, see List.pack. They're unpacked the first time data is used.
 	"""
+	__slots__ = ("packed",)
+
 	typeName = "list"
 
+	# Types that can be packed, indexed by their code in the array.
+	packable = ("number", "hexnum", "literal")
+
+	# Element objects made by unpacking, shared between all lists. They're
+	# keyed by (code, value) and must not be changed in place.
+	interned = {}
+	internLimit = 0x10000
+
+	def __init__(self, *args, **kwargs):
+		self.packed = None
+		RPLData.__init__(self, *args, **kwargs)
+	#enddef
+
 	def set(self, data):
 		if type(data) is not list:
 			raise RPLError(
@@ -2904,9 +4025,59 @@ class List(RPLData):
 				self.container, self.mykey, self.pos
 			)
 		#endif
+		self.packed = None
 		self.data = data
 	#enddef
 
+	def pack(self, items):
+		"""
+		Store a list of (type, value) pairs without making an object for each.
+		Only numbers, hexnums, and one character literals are accepted.
+		Returns False and changes nothing if there's anything else.
+		"""
+		try:
+			packable = List.packable
+			codes = array("B", [packable.index(t) for t, v in items])
+			values = array("l", [ord(v) if t == "literal" else v for t, v in items])
+		except (ValueError, TypeError, OverflowError): return False
+		self.packed = (codes, values)
+		RPLData.data.__set__(self, None)
+		return True
+	#enddef
+
+	@staticmethod
+	def element(code, value):
+		"""
+		Return the shared element object for a packed (code, value).
+		"""
+		key = (code, value)
+		try: return List.interned[key]
+		except KeyError:
+			x = (Number, HexNum, Literal)[code](unichr(value) if code == 2 else value)
+			if 0 <= value < List.internLimit: List.interned[key] = x
+			return x
+		#endtry
+	#enddef
+
+	def unpack(self):
+		codes, values = self.packed
+		element = List.element
+		self.setData([element(c, v) for c, v in izip(codes, values)])
+	#enddef
+
+	def getData(self):
+		if self.packed is not None: self.unpack()
+		return RPLData.data.__get__(self)
+	#enddef
+
+	def setData(self, data):
+		self.packed = None
+		RPLData.data.__set__(self, data)
+	#enddef
+
+	# Goes around the slot so that packed lists unpack when data is used.
+	data = property(getData, setData)
+
 	@staticmethod
 	def listOr(data, of):
 		# Try it without an of so that RPLBadType isn't raised for any of the
@@ -2925,6 +4096,10 @@ class List(RPLData):
 		return [List.listOr(x, of) for x in self.data]
 	#endif
 
+	def len(self): return len(self.data)
+	def at(self, idx): return self.data[idx]
+	def __iter__(self): return iter(self.data)
+
 	def __unicode__(self):
 		return "[ " + ", ".join(map(unicode, self.data)) + " ]"
 	#enddef
@@ -2934,9 +4109,121 @@ class Range(List):
 	"""
 	Range interpreted type.
 	It's a list of numbers and one character literals.
+	Parsed ranges are kept as segments of (type, start, step, count) and only
+	expanded when data is used. len, at, iteration, and spans don't need to
+	expand them.
 	"""
+	__slots__ = ()
+
 	typeName = "range"
 
+	@staticmethod
+	def expand(items):
+		"""
+		Yield the (type, value) pairs of a list of pairs and segments.
+		"""
+		for x in items:
+			if len(x) == 2: yield x
+			else:
+				t, start, step, count = x
+				for i in xrange(count): yield (t, start + step * i)
+			#endif
+		#endfor
+	#enddef
+
+	def pack(self, items):
+		"""
+		Store a list of (type, value) pairs or (type, start, step, count)
+		segments as segments, merging ones that continue each other.
+		Returns False and changes nothing if there's anything but numbers,
+		hexnums, and one character literals.
+		"""
+		packable, segments = List.packable, []
+		try:
+			for x in items:
+				if len(x) == 2: t, start, step, count = x[0], x[1], 0, 1
+				else: t, start, step, count = x
+				c = packable.index(t)
+				if c == 2: start = ord(start)
+				elif type(start) not in [int, long]: return False
+				if count <= 0: continue
+
+				if segments:
+					lc, lstart, lstep, lcount = segments[-1]
+					gap = start - (lstart + lstep * (lcount - 1))
+					if c == lc and (lcount == 1 or gap == lstep) and (count == 1 or gap == step):
+						segments[-1] = (c, lstart, gap, lcount + count)
+						continue
+					#endif
+				#endif
+				segments.append((c, start, step, count))
+			#endfor
+		except (ValueError, TypeError): return False
+
+		ends, end = [], 0
+		for x in segments:
+			end += x[3]
+			ends.append(end)
+		#endfor
+		self.packed = (segments, ends)
+		RPLData.data.__set__(self, None)
+		return True
+	#enddef
+
+	def unpack(self):
+		self.setData(list(self.iterSegments()))
+	#enddef
+
+	def iterSegments(self):
+		element = List.element
+		for c, start, step, count in self.packed[0]:
+			for i in xrange(count): yield element(c, start + step * i)
+		#endfor
+	#enddef
+
+	def len(self):
+		if self.packed is None: return len(self.data)
+		ends = self.packed[1]
+		return ends[-1] if ends else 0
+	#enddef
+
+	def at(self, idx):
+		if self.packed is None: return self.data[idx]
+		segments, ends = self.packed
+		if idx < 0: idx += self.len()
+		if not 0 <= idx < self.len(): raise IndexError("range index out of range")
+		i = bisect_right(ends, idx)
+		c, start, step, count = segments[i]
+		return List.element(c, start + step * (idx - (ends[i - 1] if i else 0)))
+	#enddef
+
+	def __iter__(self):
+		if self.packed is None: return iter(self.data)
+		return self.iterSegments()
+	#enddef
+
+	def spans(self):
+		"""
+		Return the contents as a list of (start, step, count) runs of numbers
+		and the strings of literals, without expanding anything.
+		"""
+		if self.packed is None:
+			ret = []
+			for x in self.data:
+				try: ret.append((x.number(), 0, 1))
+				except RPLBadType: ret.append(x.string())
+			#endfor
+			return ret
+		#endif
+
+		ret = []
+		for c, start, step, count in self.packed[0]:
+			if c == 2: ret += [unichr(start + step * i) for i in xrange(count)]
+			else: ret.append((start, step, count))
+		#endfor
+		return ret
+	#enddef
+
 	def set(self, data):
 		if type(data) is not list:
 			raise RPLError(
@@ -3019,6 +4306,8 @@ class Range(List):
 #endclass
 
 class Enum(RPLData):
+	__slots__ = ()
+
 	def set(self, data):
 		for x in self.enum:
 			if data in x[0]:
@@ -3063,6 +4352,8 @@ class Enum(RPLData):
 #endclass
 
 class Bool(Enum, Number):
+	__slots__ = ()
+
 	typeName = "bool"
 
 	enum = [
@@ -3101,6 +4392,8 @@ class Bool(Enum, Number):
 #endclass
 
 class Named(RPLData):
+	__slots__ = ()
+
 	def set(self, data, types=[]):
 		if type(data) in [str, unicode]:
 			data = data.lower()
@@ -3134,6 +4427,8 @@ class Size(Named, Number):
 	long:   4
 	double: 8
 	"""
+	__slots__ = ()
+
 	typeName = "size"
 
 	names = {
@@ -3196,6 +4491,27 @@ class Math(Literal, Number):
 
 	specification = re.compile(r'(\*\*|<<|>>|[()*/%+\-&^|])')
 
+	# Functions for each operator code used in the tree. See Math.set.
+	operations = {
+		0: operator.pos, 1: operator.neg,
+		2: operator.pow, 3: operator.mul, 4: lambda l, r: int(l // r),
+		5: operator.mod, 6: operator.add, 7: operator.sub,
+		8: operator.lshift, 9: operator.rshift,
+		10: operator.and_, 11: operator.xor, 12: operator.or_,
+		# Internal operators.
+		30: lambda l, r: float(l) / r,
+	}
+
+	__slots__ = ("refs", "constant", "program", "value")
+
+	nocopy = RPLData.nocopy + ("refs",)
+
+	def __init__(self, *args, **kwargs):
+		# RPLRefs for the references in the expression, see Math.ref.
+		self.refs = {}
+		Literal.__init__(self, *args, **kwargs)
+	#enddef
+
 	def set(self, data):
 		if type(data) in [int, long]: data = str(data)
 		Literal.set(self, data)
@@ -3293,6 +4609,63 @@ class Math(Literal, Number):
 		#enddef
 		idx = [0]
 		self.data = groupRight(idx, 10)
+		self.refs = {}
+		self.constant, self.program = self.compile(self.data)
+		# Result of a constant expression, once warnfloat has been through it.
+		self.value = None
+	#enddef
+
+	def compile(self, op):
+		"""
+		Compile an expression tree into a function of (math, var), folding
+		constant branches. Returns (True, value) for a constant branch,
+		otherwise (False, function). Errors are left for evaluation to raise.
+		"""
+		if type(op) in [int, long, float]: return True, op
+		elif type(op) is not tuple:
+			if op[0] == "@": return False, lambda math, var: math.ref(op).number()
+			try: return True, self.eval(op, {})
+			except RPLError:
+				# Variables can only be known at evaluation.
+				return False, lambda math, var: var[op] if op in var else math.eval(op, var)
+			#endtry
+		#endif
+
+		try: fn = Math.operations[op[0]]
+		except KeyError: return False, lambda math, var: math.eval(op, var)
+		branches = [self.compile(x) for x in op[1:]]
+
+		if all(x[0] for x in branches):
+			try: return True, fn(*[x[1] for x in branches])
+			except (ArithmeticError, ValueError, TypeError): pass
+		#endif
+		branches = [(lambda math, var, x=x: x) if const else x for const, x in branches]
+		if len(branches) == 1:
+			val = branches[0]
+			return False, lambda math, var: fn(val(math, var))
+		#endif
+		lval, rval = branches
+		return False, lambda math, var: fn(lval(math, var), rval(math, var))
+	#enddef
+
+	def ref(self, token):
+		"""
+		Return the RPLRef for a reference token in the expression.
+		"""
+		try: container, ref = self.refs[token]
+		except KeyError: container = ref = None
+		# Data may be moved to another struct after being made.
+		if container is not self.container or ref.mykey != self.mykey:
+			ref = RPLRef(token[1:], self.rpl, self.container, self.mykey, *self.pos)
+			self.refs[token] = (self.container, ref)
+		#endif
+		return ref
+	#enddef
+
+	def __deepcopy__(self, memo={}):
+		ret = Literal.__deepcopy__(self, memo)
+		ret.refs = {}
+		return ret
 	#enddef
 
 	def eval(self, op, var):
@@ -3444,8 +4817,15 @@ class Math(Literal, Number):
 		return value
 	#enddef
 
-	def get(self, var={}): return self.warnfloat(self.data, var)
-	def number(self, var={}): return self.warnfloat(self.data, var)
+	def number(self, var={}):
+		if self.constant:
+			if self.value is None: self.value = self.warnfloat(self.program)
+			return self.value
+		#endif
+		return self.warnfloat(self.program(self, var))
+	#enddef
+
+	def get(self, var={}): return self.number(var)
 	def string(self): RPLData.string(self)
 
 	def __unicode__(self, x=None):
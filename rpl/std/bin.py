@@ -67,6 +67,8 @@ class Bin(rpl.String):
 		return ret + "," + lastComment[1:]
 	#enddef
 
+	def ending(self): return u"#" if self.data else u","
+
 	def serialize(self, **kwargs): return self.data
 	def unserialize(self, data, **kwargs): self.data = data
 
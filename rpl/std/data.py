@@ -77,76 +77,121 @@ class DataStatic(rpl.Static):
 		return True
 	#enddef
 
+	@staticmethod
+	def breaksLine(data):
+		"""
+		Whether or not data written as a list entry spans multiple lines.
+		Values only break lines after comments, and know if they end in one,
+		so this doesn't need to write anything to find out.
+		"""
+		if type(data) is list:
+			for x in data:
+				if DataStatic.breaksLine(x): return True
+			#endfor
+			return False
+		elif data.data: return data.data.itervalues().next().ending() == "#"
+		else: return DataStatic.breaksLine(data.children.itervalues().next())
+	#enddef
+
 	lineEnd = re.compile(r'(?:\r?\n|\n\r?|\r)(?!\n|\r|$)')
-	def __unicode__(self, pretty=True, tabs=u"", isList=False):
+	def entry(self, key, value, tabs, isList):
+		"""
+		Return the written form of a key and whether or not it has a comma.
+		"""
+		v, ending = unicode(value), value.ending()
+		# A comment has to end the line.
+		if ending == "#":
+			end, hascomma = os.linesep if v[-len(os.linesep):] != os.linesep else u"", True
+		else: end, hascomma = u"", ending == ","
+		if isList: return v + end, hascomma
+		next = key + u": "
+		return next + DataStatic.lineEnd.sub(os.linesep + tabs + u" " * len(next), v) + end, hascomma
+	#enddef
+
+	def listChunks(self, key, data, pretty, tabs):
+		"""
+		Write a child as a list, see chunks.
+		"""
+		prefix = u"[" if key is None else u"%s: [" % key
+		sep = os.linesep + tabs + u"\t" if pretty else u", "
+		start = prefix + sep if pretty else prefix
+		for x in data if type(data) is list else [data]:
+			if x.data:
+				# Entries are usually just one value.
+				k, v = x.data.iteritems().next()
+				yield start + x.entry(k, v, tabs + u"\t", True)[0]
+			else:
+				yield start
+				for c in x.chunks(pretty, tabs + u"\t", True): yield c
+			#endif
+			start = sep
+		#endfor
+		if start != sep: yield prefix
+		yield os.linesep + tabs + u"]" if pretty else u"]"
+	#enddef
+
+	def chunks(self, pretty=True, tabs=u"", isList=False):
+		"""
+		Write this as RPL, piece by piece, so that the whole thing need not be
+		held in memory at once.
+		"""
+		if not self.data and not self.children: raise RPLError("Empty...?")
+		if isList:
+			if self.data:
+				key, value = self.data.iteritems().next()
+				yield self.entry(key, value, tabs, True)[0]
+			else:
+				for c in self.listChunks(None, self.children.itervalues().next(), pretty, tabs): yield c
+			#endif
+			return
+		#endif
+
 		if self.comment:
-			ret = tabs + u"# " + DataStatic.lineEnd.sub(
+			yield tabs + u"# " + DataStatic.lineEnd.sub(
 				os.linesep + tabs + u"# ", self.comment
 			) + os.linesep
-		else: ret = u""
+		#endif
 
 		# Create exported name.
 		if self.gennedName: name = u""
 		else: name = u" " + self.name
+		yield u"%sstatic%s {" % (tabs, name)
 
-		# Create list of keys.
-		keys = []
+		# Write keys, then children which can be written as lists. When not
+		# pretty, a comma is only written once it's known there's more.
+		comma, lastBreak = u"", False
 		for k, v in self.data.iteritems():
-			v = unicode(v)
-			# Check if it ends in a comment.
-			parsed = [x.group(0) for x in rpl.RPL.specification.finditer(v)]
-			if v.strip() and parsed[-1].lstrip()[0] == "#":
-				end, hascomma = os.linesep if v[-len(os.linesep):] != os.linesep else u"", True
-			else: end, hascomma = u"", parsed[-1].lstrip()[0] == ","
-			if isList: keys.append((v + end, hascomma))
+			x, hascomma = self.entry(k, v, tabs, False)
+			if pretty: yield os.linesep + tabs + u"\t" + x
 			else:
-				next = k + u": "
-				keys.append((next + DataStatic.lineEnd.sub(os.linesep + tabs + u" " * len(next), v) + end, hascomma))
+				if os.linesep in x and not lastBreak: yield comma + os.linesep + x
+				else: yield comma + x
+				comma, lastBreak = u"" if hascomma else u", ", x[-len(os.linesep):] == os.linesep
 			#endif
 		#endfor
 
-		# Create list of children.
 		children = []
 		for k, v in self.children.iteritems():
-			if isList or DataStatic.canBeList(v):
-				if isList: next = u""
-				else: next = u"%s: " % k
-				if type(v) is list: l = [x.__unicode__(pretty, tabs + u"\t", True) for x in v]
-				else: l = [v.__unicode__(pretty, tabs + u"\t", True)]
-				if pretty: next += u"[" + (os.linesep + tabs + u"\t").join([""] + l) + os.linesep + tabs + u"]"
-				else: next += u"[" + u", ".join(l) + u"]"
-				if isList: children.append(next)
-				else: keys.append((next, False))
-			else:
-				for x in (v if type(v) is list else [v]): children.append(x.__unicode__(pretty, tabs + u"\t"))
-			#endif
+			if DataStatic.canBeList(v):
+				if pretty: yield os.linesep + tabs + u"\t"
+				elif not lastBreak and DataStatic.breaksLine(v): yield comma + os.linesep
+				else: yield comma
+				comma, lastBreak = u", ", False
+				for c in self.listChunks(k, v, pretty, tabs): yield c
+			else: children += v if type(v) is list else [v]
 		#endfor
 
-		if keys: keys[-1] = (keys[-1][0], True)
-
-		if not keys and not children: raise RPLError("Empty...?")
-		if isList: return keys[0][0] if keys else children[0]
+		# Write other children.
+		if children: yield os.linesep * 2 if pretty else os.linesep
+		for i, x in enumerate(children):
+			if i: yield os.linesep
+			for c in x.chunks(pretty, tabs + u"\t"): yield c
+		#endfor
+		yield os.linesep + tabs + u"}" if pretty else u"}"
+	#enddef
 
-		if pretty:
-			ret += u"%sstatic%s {" % (tabs, name)
-			for x, c in keys: ret += os.linesep + tabs + u"\t" + x
-			return (
-				ret + (os.linesep * 2 if children else u"") +
-				os.linesep.join(children) + os.linesep + tabs + u"}"
-			)
-		else:
-			ret += u"%sstatic%s {" % (tabs, name)
-			last, n = "", -len(os.linesep)
-			for x, c in keys:
-				if os.linesep in x and last[n:] != os.linesep: ret += os.linesep
-				ret += x + (u"" if c else u", ")
-				last = x
-			#endfor
-			return (
-				ret + (os.linesep if children else u"") +
-				os.linesep.join(children) + u"}"
-			)
-		#endif
+	def __unicode__(self, pretty=True, tabs=u"", isList=False):
+		return u"".join(self.chunks(pretty, tabs, isList))
 	#enddef
 
 	def __getitem__(self, key):
@@ -200,7 +245,15 @@ class RPLDataFile(DataFile):
 		"""
 		Write data to a given file.
 		"""
-		helper.writeTo(self.path, self.base.__unicode__(self.pretty))
+		helper.writeTo(self.path, self.chunks())
+	#enddef
+
+	def chunks(self):
+		n = u"\n\n" if self.pretty else u""
+		for child in self.base:
+			for x in child.chunks(self.pretty): yield x
+			yield n
+		#endfor
 	#enddef
 
 	def addStruct(self, struct, to=None):
@@ -220,21 +273,27 @@ class RPLDataFile(DataFile):
 #endclass
 
 def JSONStringifyElement(v, pretty, tabs):
+	return u"".join(JSONChunks(v, pretty, tabs))
+#enddef
+
+def JSONChunks(v, pretty, tabs):
 #	tv = type(v)
-#	if   tv is dict: return JSONDict(v).stringify(pretty, tabs)
-#	elif tv is list: return JSONList(v).stringify(pretty, tabs)
-	try: return v.stringify(pretty, tabs)
+#	if   tv is dict: return JSONDict(v).chunks(pretty, tabs)
+#	elif tv is list: return JSONList(v).chunks(pretty, tabs)
+	try: chunks = v.chunks
 	except AttributeError:
 		# RPLData.__unicode__ may not always form valid JSON
 		# so this has to reinterpret that.
-		try: return JSONList(v.list()).stringify(pretty, tabs)
+		try: chunks = JSONList(v.list()).chunks
 		except RPLBadType:
-			try: return '"%s"' % v.string().replace('"', '\\"')
+			try: yield '"%s"' % v.string().replace('"', '\\"')
 			except RPLBadType:
-				return unicode(v.number())
+				yield unicode(v.number())
 			#endtry
+			return
 		#endtry
-	#endif
+	#endtry
+	for x in chunks(pretty, tabs): yield x
 #enddef
 
 class JSONDict(odict):
@@ -243,20 +302,30 @@ class JSONDict(odict):
 		odict.__init__(self, x)
 	#enddef
 
-	def stringify(self, pretty, tabs=u""):
+	def chunks(self, pretty, tabs=u""):
+		"""
+		Write this as JSON, piece by piece.
+		"""
 		if pretty:
-			ret, end = u"{" + os.linesep, os.linesep + tabs + u"}"
+			yield u"{" + os.linesep
+			end = os.linesep + tabs + u"}"
 			tabs += u"\t"
-			if self.comment: ret += u"%s// %s" % (tabs, self.comment)
-			entry, chop = tabs + u'"%s": %s,' + os.linesep, -(1 + len(os.linesep))
+			if self.comment: yield u"%s// %s" % (tabs, self.comment)
+			entry, comma = tabs + u'"%s": ', u"," + os.linesep
 		else:
-			ret = u"{ "
-			if self.comment: ret += u"/* %s */ " % (self.comment)
-			entry, end, chop = '"%s": %s, ', u" }", -2
+			yield u"{ "
+			if self.comment: yield u"/* %s */ " % (self.comment)
+			entry, comma, end = u'"%s": ', u", ", u" }"
 		#endif
-		for k, v in self.iteritems(): ret += entry % (k, JSONStringifyElement(v, pretty, tabs))
-		return ret[:chop] + end
+		for i, (k, v) in enumerate(self.iteritems()):
+			if i: yield comma
+			yield entry % k
+			for x in JSONChunks(v, pretty, tabs): yield x
+		#endfor
+		yield end
 	#enddef
+
+	def stringify(self, pretty, tabs=u""): return u"".join(self.chunks(pretty, tabs))
 #endclass
 
 class JSONList(list):
@@ -270,18 +339,29 @@ class JSONList(list):
 		return tmp
 	#enddef
 
-	def stringify(self, pretty, tabs=u""):
+	def chunks(self, pretty, tabs=u""):
+		"""
+		Write this as JSON, piece by piece.
+		"""
 		if pretty:
-			ret, end = u"[" + os.linesep, os.linesep + tabs + u"]"
+			yield u"[" + os.linesep
+			end = os.linesep + tabs + u"]"
 			tabs += u"\t"
-			entry, chop = tabs + u'%s,' + os.linesep, -(1 + len(os.linesep))
+			entry, comma = tabs, u"," + os.linesep
 		else:
-			ret, entry, end, chop = u"[ ", u'%s, ', u" ]", -2
+			yield u"[ "
+			entry, comma, end = u"", u", ", u" ]"
 		#endif
-		for v in self.oneUp(): ret += entry % (JSONStringifyElement(v, pretty, tabs))
-		return ret[:chop] + end
+		for i, v in enumerate(self.oneUp()):
+			if i: yield comma
+			yield entry
+			for x in JSONChunks(v, pretty, tabs): yield x
+		#endfor
+		yield end
 	#enddef
 
+	def stringify(self, pretty, tabs=u""): return u"".join(self.chunks(pretty, tabs))
+
 	def list(self): return self
 #endclass
 
@@ -323,7 +403,7 @@ class JSONFile(DataFile):
 		"""
 		# Needs to make the same assumption as RPLDataFile.
 		for x, v in self.base.iteritems(): self.base[x] = v[0]
-		helper.writeTo(self.path, self.base.stringify(self.pretty))
+		helper.writeTo(self.path, self.base.chunks(self.pretty))
 	#enddef
 
 	def addStruct(self, name, to=None):
@@ -409,12 +489,18 @@ class DataFormat(object):
 	def __init__(self, top, name, parent):
 		self.parentClass = rpl.Serializable if isinstance(self, rpl.Serializable) else rpl.RPLStruct
 		self.parentClass.__init__(self, top, name, parent)
-		self.format = odict()
-		self.command = {}
+		self.format = rpl.CopyOnWrite()
+		self.command = rpl.CopyOnWrite()
+		self.cow += ["format", "command"]
 		self._len = None
 		self.count = None
 		self.importing = False
 		self.onekey = None
+		# Set when this is one of many records read at once, see readRecords.
+		self.record = None
+		# Shared by clones, see recordLayout.
+		self.compiled = {}
+		self.nocopy += ["record", "compiled"]
 	#enddef
 
 	def register(self):
@@ -538,6 +624,19 @@ class DataFormat(object):
 		except RPLError:
 			if key[0] == "x":
 				# If the key doesn't exist yet, we should attempt to retrieve it
+				if self.record is not None and not self.importing and key in self.record[2]:
+					# Read from the buffer this record was read in with.
+					data, start, fields, columns = self.record
+					typeName, offset, size, opts = fields[key]
+					column, index = self.recordColumn(key), start // self._len
+					self.data[key] = self.rpl.wrap(typeName)
+					# Records cut short by the end of the ROM aren't in the column.
+					if column is None or index >= len(column):
+						start += offset
+						self.data[key].unserialize(data[start:start + size], **opts)
+					else: self.data[key].data = column[index]
+					return self.data[key]
+				#endif
 				fmt = self.parseFormat(key)
 				if self.importing:
 					if key in self.command:
@@ -572,7 +671,6 @@ class DataFormat(object):
 				else:
 					offset = self.offsetOf(key)
 					address = base = self.get("base") + offset
-					self.rpl.rom.seek(address)
 					size, expand = self.get(fmt["size"]), False
 					if size == "expand":
 						if fmt["end"]:
@@ -609,19 +707,31 @@ class DataFormat(object):
 							DataFormat.setLen(ref, fmt["size"])
 							address = tmpfunc(address, ref)
 						else:
+							# Records of a fixed size can all be read at once.
+							try: layout = ref.recordLayout()
+							except AttributeError: layout = None
+
 							if fmt["end"] or expand:
 								# Change this to end address to just use end's functionality
 								if expand: size += base
-								count = 0
-								while address < size:
-									address = tmpfunc(address, ref.clone())
-									count += 1
-								#endwhile
+								if layout:
+									count = max(0, -(-(size - address) // layout[0]))
+									address = ref.readRecords(address, count)
+								else:
+									count = 0
+									while address < size:
+										address = tmpfunc(address, ref.clone())
+										count += 1
+									#endwhile
+								#endif
 								if address > size:
 									raise RPLError("Couldn't fit %s.%s into the available space perfectly." % (self.name, key))
 								#endif
 								# Adjust to the actual value..
 								fmt["size"] = rpl.Number(count)
+							elif layout:
+								# Size is count.
+								address = ref.readRecords(address, size)
 							else:
 								# Size is count.
 								for i in helper.range(size): address = tmpfunc(address, ref.clone())
@@ -636,7 +746,7 @@ class DataFormat(object):
 						typeName = self.get(fmt["type"])
 						self.data[key] = self.rpl.wrap(typeName)
 						self.data[key].unserialize(
-							self.rpl.rom.read(size),
+							str(self.rpl.rom.view(address, size)),
 							**self.prepOpts(fmt)
 						)
 					#endif
@@ -807,12 +917,9 @@ class DataFormat(object):
 				# If this was len, it's currently the size of the serialized data.
 				# However, if the key it's for is end type, it needs to be adjusted
 				# to the ending address instead.
-				# TODO: This currently enforces that if one needs to reference
-				# something with the end tag, it needs to be done after that
-				# data struct, so that that data struct will be imported first.
-				# I don't like this, but moving all this to __getitem__ means
-				# that the data can't be changed.. There must be a nicer way to
-				# get around this but it might take severe redesigning.
+				# This requires that anything referencing something with the
+				# end tag is imported after that data struct. RPL.importData
+				# orders imports by reference with RPLGraph to ensure that.
 				if com[0] in ["len", "count"]:
 					fmtc1 = self.format[com[1]]
 					if com[0] == "len" and fmtc1["end"]:
@@ -990,6 +1097,85 @@ class DataFormat(object):
 		#endfor
 	#enddef
 
+	def recordLayout(self):
+		"""
+		If every field is a basic type of a fixed size, return the size of a
+		record and, for each key, its type name, offset, size and options to
+		unserialize with. Otherwise return None.
+		This only depends on the format, so it's worked out once and shared by
+		all clones.
+		"""
+		try: return self.compiled["layout"]
+		except KeyError: pass
+
+		fields, offset, total, layout = {}, 0, 0, None
+		for k in self.format:
+			# Offsets taken from other keys differ per record, and can't be
+			# parsed here besides.
+			fmt = self.format[k]
+			if type(fmt) is list and any(x.reference() for x in fmt[2:]): break
+			fmt = self.parseFormat(k)
+			size = fmt["size"]
+			if (k in self.command or fmt["end"] or fmt["offsetRefs"] or
+				size.reference() or DataFormat.isCounted(fmt["type"], True) or
+				type(size.get()) not in [int, long]
+			): break
+			# Fields placed elsewhere may reach past the record, whose size
+			# only adds up the fields'.
+			if fmt["offset"] is not None and fmt["offset"] != offset: break
+			fields[k] = (self.get(fmt["type"]), offset, size.get(), self.prepOpts(fmt))
+			offset += size.get()
+			total += size.get()
+		else:
+			if total: layout = (total, fields)
+		#endfor
+		self.compiled["layout"] = layout
+		return layout
+	#enddef
+
+	def readRecords(self, address, count):
+		"""
+		Read count records of this format from one buffer at address, making
+		a clone for each. Fields are only unserialized when they're accessed.
+		Requires recordLayout. Returns the address after the records.
+		"""
+		size, fields = self.recordLayout()
+		# Nothing in a fixed layout changes per record, so the records can
+		# all share this one parsed format rather than copying it. With it
+		# parsed, no commands are added, and records never get children.
+		for k in self.format: self.offsetOf(k)
+		data = str(self.rpl.rom.view(address, size * count))
+		columns = {}
+		for i in helper.range(count):
+			t = self.clone(["format", "command", "children"])
+			DataFormat.setBase(t, rpl.Number(address + i * size))
+			t._len, t.record = size, (data, i * size, fields, columns)
+		#endfor
+		return address + size * count
+	#enddef
+
+	def recordColumn(self, key):
+		"""
+		Return the value of the field key for every record read along with
+		this one, or None if its type isn't a plain number. Numbers are all
+		unserialized at once, the first time any of the records asks.
+		"""
+		data, start, fields, columns = self.record
+		try: return columns[key]
+		except KeyError: pass
+
+		typeName, offset, size, opts = fields[key]
+		ret, stride = None, self._len
+		if self.rpl.types[typeName].unserialize.im_func is rpl.Number.unserialize.im_func:
+			if size == stride: column = data
+			elif size == 1: column = data[offset::stride]
+			else: column = "".join([data[i:i + size] for i in helper.range(offset, len(data), stride)])
+			ret = rpl.Number.unserializeArray(column, size, opts["endian"], opts["sign"])
+		#endif
+		columns[key] = ret
+		return ret
+	#enddef
+
 	def len(self):
 		if self._len is not None: return self._len
 		size = 0
@@ -1118,6 +1304,7 @@ class Data(DataFormat, rpl.Serializable):
 	def importPrepare(self, rom, folder):
 		filename = self.open(folder, "rpl", True)
 		if self.shareByType(filename, False) == "bin":
+			self.rpl.uses(filename)
 			self.rpl.rom = newrom = helper.stream(filename)
 			self.exportPrepare(newrom, folder)
 			for k in self.format: self[k].get()
@@ -1135,6 +1322,7 @@ class Data(DataFormat, rpl.Serializable):
 		filename = self.open(folder, "rpl", True)
 		datafile = self.shareByType(filename, self.get("pretty"))
 		if datafile == "bin":
+			self.rpl.uses(filename)
 			try: os.unlink(filename)
 			except OSError as err:
 				if err.errno == 2: pass
@@ -21,7 +21,8 @@
 import os, re, Image
 from .. import rpl, helper
 from ..rpl import RPLError, RPLBadType
-from StringIO import StringIO
+from binascii import hexlify, unhexlify
+from fractions import gcd
 
 def register(rpl):
 	rpl.registerStruct(GenericGraphic)
@@ -252,6 +253,24 @@ class Graphic(rpl.Serializable):
 		image.addImage(self.image, offx, offy)
 	#enddef
 
+	def exportWork(self):
+		"""
+		Prepare the image, returning it in a picklable form.
+		This is run in a worker process when exporting with multiple jobs.
+		"""
+		if self.image is None: self.prepareImage()
+		return self.image.mode, self.image.size, list(self.image.getdata())
+	#enddef
+
+	def exportResult(self, result):
+		"""
+		Take the image prepared by exportWork in a worker process.
+		"""
+		mode, size, data = result
+		self.image = Image.new(mode, size)
+		self.image.putdata(data)
+	#enddef
+
 	def basic(self):
 		"""
 		This operates under the assumption that if something wants to edit
@@ -370,6 +389,8 @@ class GenericGraphic(Graphic):
 	def __init__(self, top, name, parent=None):
 		Graphic.__init__(self, top, name, parent)
 		self.image = None
+		# (key, length) for the last length calculated. See len.
+		self.lenCache = None
 	#enddef
 
 	def register(self):
@@ -381,101 +402,34 @@ class GenericGraphic(Graphic):
 		self.registerKey("reverse", "math", "0")
 	#enddef
 
-	def padfuncDef(self, width, height):
+	def codec(self, width, height, palette):
+		"""
+		Return a PixelCodec for this graphic's pixel formats and padding.
+		"""
 		padmethod, padmod = tuple(self.list("padding", "get"))
-		if self.rpl.importing:
-			if padmethod == "row":
-				widthmo = width - 1
-				def padfunc(i, prev, leftover, stream):
-					if i % width == widthmo:
-						tmpmod = (stream.tell() - prev) % padmod
-						#print "Skipping %i.%i bytes" % (padmod - tmpmod  if tmpmod else 0, 8 - leftover if leftover else 0)
-						return (padmod - tmpmod  if tmpmod else 0, 0)
-					#endif
-					return (None, leftover)
-				#enddef
-			elif padmethod == "column":
-				heightmo = height - 1
-				def padfunc(i, prev, leftover, stream):
-					if i % height == heightmo:
-						tmpmod = (stream.tell() - prev) % padmod
-						return (padmod - tmpmod  if tmpmod else 0, 0)
-					return (None, leftover)
-				#enddef
-			elif padmethod == "pixel":
-				def padfunc(i, prev, leftover, stream):
-					tmpmod = (stream.tell() - prev) % padmod
-					return (padmod - tmpmod  if tmpmod else 0, 0)
-				#enddef
-			else:
-				def padfunc(i, prev, leftover, stream): return (None, leftover)
-			#endif
-		else:
-			if padmethod == "row":
-				widthmo = width - 1
-				def padfunc(i, prev, leftovers, pos=None, stream=None):
-					if i % width == widthmo:
-						tmpmod = ((pos or stream.tell()) - prev) % padmod
-						leftovers[1] = 0
-						return padmod - tmpmod  if tmpmod else 0
-					#endif
-					return None
-				#enddef
-			elif padmethod == "column":
-				heightmo = height - 1
-				def padfunc(i, prev, leftovers, pos=None, stream=None):
-					if i % height == heightmo:
-						tmpmod = ((pos or stream.tell()) - prev) % padmod
-						leftovers[1] = 0
-						return padmod - tmpmod if tmpmod else 0
-					#endif
-					return None
-				#enddef
-			elif padmethod == "pixel":
-				def padfunc(i, prev, leftovers, pos=None, stream=None):
-					tmpmod = ((pos or stream.tell()) - prev) % padmod
-					leftovers[1] = 0
-					return padmod - tmpmod if tmpmod else 0
-				#enddef
-			else:
-				def padfunc(i, prev, leftovers, pos=None, stream=None): return None
-			#endif
-		#endif
-		return padfunc
+		segment = {"row": width, "column": height, "pixel": 1}.get(padmethod, 0)
+		return PixelCodec(self["pixel"].get(), palette, segment, padmod)
 	#enddef
 
 	def importData(self, rom, folder):
-		read = self["read"].get()
 		width, height = tuple(self.list("dimensions", "number"))
 
-		# Create padding function...
-		prev = 0
-		padfunc = self.padfuncDef(width, height)
-
 		# Prepare palette
 		self.definePalette(self.list("palette", "tuple"))
 
 		# Prepare data
-		leftover = 0
 		data = self.image.load()
-		pixels = self["pixel"].get()
-		stream = StringIO()
-		for idx, x, y in self["read"].rect(width, height):
-			leftover = pixels[idx % len(pixels)].write(stream, self, leftover, data[x, y])
-			skip, leftover = padfunc(idx, prev, leftover, stream)
-			if skip is not None:
-				if skip: stream.write("\x00" * skip)
-				prev = stream.tell()
-			#endif
-		#endfor
+		stream = self.codec(width, height, self).encode([
+			data[x, y] for idx, x, y in self["read"].rect(width, height)
+		])
 
 		# Commit to ROM
 		reverse = self["reverse"].get({
 			"w": width, "width": width,
 			"h": height, "height": height,
 		})
-		if reverse: rom.write(reverseEvery(stream.getvalue(), reverse))
-		else: rom.write(stream.getvalue())
+		if reverse: rom.write(reverseEvery(stream, reverse))
+		else: rom.write(stream)
 	#enddef
 
 	def prepareImage(self):
@@ -483,39 +437,20 @@ class GenericGraphic(Graphic):
 		width, height = tuple(self.list("dimensions", "number"))
 		numPixels = width * height
 
-		# Create padding function...
-		prev = 0
-		padfunc = self.padfuncDef(width, height)
-
-		# Collect size of data to read
-		pixels = self["pixel"].get()
-		bytes = self.len(numPixels, padfunc, pixels)
-
 		# Prepare palette
 		palette = self.list("palette", "tuple")
+		codec = self.codec(width, height, palette)
 
 		# Read pixels
-		self.rpl.rom.seek(self.number("base"))
 		reverse = self.resolve("reverse").get({
 			"w": width, "width": width,
 			"h": height, "height": height,
 		})
-		if reverse: stream = StringIO(reverseEvery(self.rpl.rom.read(bytes), reverse))
-		else: stream = StringIO(self.rpl.rom.read(bytes))
-
-		leftovers, data, prev = ["", 0], [], 0
-		for i in helper.range(numPixels):
-			data.append(pixels[i % len(pixels)].read(stream, palette, leftovers))
-			tmp = padfunc(i, prev, leftovers, stream=stream)
-			if tmp is not None:
-				#print "Skipping %i bytes." % tmp
-				stream.seek(tmp, 1)
-				prev = stream.tell()
-			#endif
-		#endfor
+		bytes = self.rpl.rom.view(self.number("base"), codec.size(numPixels))
+		if reverse: bytes = reverseEvery(bytes, reverse)
 
 		# Paste to image
-		self.image.putdata(data)
+		self.image.putdata(codec.decode(bytes, numPixels))
 
 		# Transform resultant image by read.
 		# Since this is confusing, here's a full readout:
@@ -540,31 +475,13 @@ class GenericGraphic(Graphic):
 		elif primary - secondary == 2: self.image = self.image.transpose(Image.FLIP_TOP_BOTTOM)
 	#enddef
 
-	def len(self, numPixels=None, padfunc=None, pixels=None):
-		if numPixels is None or padfunc is None:
-			width, height = tuple(self.list("dimensions", "number"))
-			numPixels = width * height
-			padfunc = self.padfuncDef(width, height)
+	def len(self):
+		width, height = tuple(self.list("dimensions", "number"))
+		key = (width, height, tuple(self.list("padding", "get")), tuple(self.list("pixel", "get")))
+		if self.lenCache is None or self.lenCache[0] != key:
+			self.lenCache = (key, self.codec(width, height, None).size(width * height))
 		#endif
-		prev, bytes, leftovers = 0, 0, ["", 0]
-		pixels = pixels or self.list("pixel")
-		# TODO: Make more efficient for repeated rows or uniform pixel size...
-		for i in helper.range(numPixels):
-			pixel = pixels[i % len(pixels)]
-			bytes += pixel.bytes
-			leftovers[1] += pixel.extraBits
-			if leftovers[1] >= 8:
-				bytes += 1
-				leftovers[1] -= 8
-			#endif
-			tmp = padfunc(i, prev, leftovers, bytes)
-			if tmp is not None:
-				bytes += tmp
-				prev = bytes
-			#endif
-		#endfor
-		#bytes = bytes * numPixels + int(ceil(extraBits * numPixels / 8))
-		return bytes
+		return self.lenCache[1]
 	#enddef
 #endclass
 
@@ -653,11 +570,10 @@ class Pixel(rpl.String):
 		) + self.format
 	#enddef
 
-	def write(self, stream, palette, leftovers, pixel):
+	def values(self, pixel, palette):
 		"""
-		leftovers: number of bits
+		Return the values of each channel, as stored, for the given color.
 		"""
-		#global PIXEL
 		r, g, b, a = pixel
 		val  = {
 			"R": int(round(r * self.max["R"] / 255)) if self.max["R"] else 0,
@@ -678,6 +594,15 @@ class Pixel(rpl.String):
 				#endtry
 			#endtry
 		else: val["I"] = 0
+		return val
+	#enddef
+
+	def write(self, stream, palette, leftovers, pixel):
+		"""
+		leftovers: number of bits
+		"""
+		#global PIXEL
+		val = self.values(pixel, palette)
 
 		mask = {}
 		for k, x in self.max.iteritems(): mask[k] = (x + 1) >> 1
@@ -768,6 +693,13 @@ class Pixel(rpl.String):
 			}[mask]
 		#endif
 
+		return self.color(values, palette)
+	#enddef
+
+	def color(self, values, palette):
+		"""
+		Return the (r, g, b, a) color for the values of each channel.
+		"""
 		# Make them relative to max values
 		for x in "RGBHSLWA":
 			if self.max[x]: values[x] = int(round(values[x] * 255 / self.max[x]))
@@ -783,6 +715,236 @@ class Pixel(rpl.String):
 		#print "#%02x%02x%02x.%i%%" % (r, g, b, a * 100 / 255)
 		return (r, g, b, a)
 	#enddef
+
+	def unpack(self, code, palette):
+		"""
+		Return the color of a pixel from its raw value, that is the bits of
+		the pixel read as a big endian number.
+		"""
+		values = dict.fromkeys("RGBHSLWAI", 0)
+		shift = len(self.expanded)
+		for x in self.expanded:
+			shift -= 1
+			if x != "0":
+				bit = (code >> shift) & 1
+				if x in "rgbhslwa": bit ^= 1
+				x = x.upper()
+				values[x] = values[x] << 1 | bit
+			#endif
+		#endfor
+		return self.color(values, palette)
+	#enddef
+
+	def pack(self, pixel, palette):
+		"""
+		Return the raw value of a pixel from its color. This is the inverse
+		of unpack.
+		"""
+		val, code = self.values(pixel, palette), 0
+		left = dict([(k, x.bit_length()) for k, x in self.max.iteritems()])
+		for x in self.expanded:
+			code <<= 1
+			if x != "0":
+				u = x.upper()
+				left[u] -= 1
+				code |= ((val[u] >> left[u]) & 1) ^ (1 if x in "rgbhslwa" else 0)
+			#endif
+		#endfor
+		return code
+	#enddef
+
+	def decoder(self, palette):
+		"""
+		Return a table of raw values to colors for this format.
+		"""
+		return PixelTable(lambda code: self.unpack(code, palette))
+	#enddef
+
+	def encoder(self, palette):
+		"""
+		Return a table of colors to raw values for this format.
+		"""
+		return PixelTable(lambda pixel: self.pack(pixel, palette))
+	#enddef
+#endclass
+
+class PixelTable(dict):
+	"""
+	Lookup table which fills itself in with func as keys are requested.
+	Images rarely use many colors, so this is only ever a small subset of
+	what the format can represent.
+	"""
+	def __init__(self, func):
+		dict.__init__(self)
+		self.func = func
+	#enddef
+
+	def __missing__(self, key):
+		ret = self[key] = self.func(key)
+		return ret
+	#enddef
+#endclass
+
+class PixelCodec(object):
+	"""
+	Converts whole runs of pixels between colors and binary at once.
+	Rather than working bit by bit, runs of data are treated as one big
+	number and each pixel's raw value is shifted out of or into it, then
+	looked up in a table.
+	pixels:  List of pixel formats to loop through.
+	palette: Palette as passed to Pixel.read when decoding, or Pixel.write
+	         when encoding.
+	segment: Number of pixels to pad after, 0 for no padding.
+	padmod:  Pad segments to a multiple of this many bytes.
+	"""
+	# Roughly how many bits to convert to a number at once. Keeping this
+	# small keeps the shifts cheap.
+	chunkBits = 2048
+
+	def __init__(self, pixels, palette, segment=0, padmod=0):
+		self.pixels, self.palette = pixels, palette
+		self.segment, self.padmod = segment, padmod
+		self.widths = [len(x.expanded) for x in pixels]
+		self.masks = [(1 << x) - 1 for x in self.widths]
+		self.cycleBits = cycleBits = sum(self.widths)
+		# Chunks must be a whole number of loops through the formats that
+		# also ends on a byte boundary.
+		cycles = 8 / gcd(cycleBits, 8)
+		self.chunk = len(pixels) * cycles * max(1, self.chunkBits / (cycles * cycleBits))
+		self.layouts, self.decoders, self.encoders = {}, None, None
+	#enddef
+
+	def layout(self, offset, count):
+		"""
+		Return the number of bytes used by count pixels, starting from the
+		format at index offset, along with the format index of each pixel and
+		its shift from the end of those bytes.
+		"""
+		key = (offset, count)
+		try: return self.layouts[key]
+		except KeyError: pass
+
+		fmts = [(offset + i) % len(self.pixels) for i in helper.range(count)]
+		size = (sum([self.widths[x] for x in fmts]) + 7) >> 3
+		shift, shifts = size << 3, []
+		for x in fmts:
+			shift -= self.widths[x]
+			shifts.append(shift)
+		#endfor
+		ret = self.layouts[key] = (size, fmts, shifts)
+		return ret
+	#enddef
+
+	def chunks(self, count):
+		"""
+		Generator returning (index, count) for each chunk of pixels, and
+		(None, size) at the end of each whole segment where size is the number
+		of bytes used by that segment. Without a segment nothing is padded.
+		"""
+		segment = self.segment or count
+		for start in helper.range(0, count, segment):
+			end, size = min(start + segment, count), 0
+			for i in helper.range(start, end, self.chunk):
+				n = min(self.chunk, end - i)
+				yield i, n
+				size += self.layout(i % len(self.pixels), n)[0]
+			#endfor
+			if self.segment and end - start == segment: yield None, size
+		#endfor
+	#enddef
+
+	def padding(self, size):
+		if not self.padmod: return 0
+		tmpmod = size % self.padmod
+		return self.padmod - tmpmod if tmpmod else 0
+	#enddef
+
+	def bits(self, offset, count):
+		"""
+		Return the number of bits used by count pixels, starting from the
+		format at index offset.
+		"""
+		loops, rest = divmod(count, len(self.widths))
+		ret = loops * self.cycleBits
+		for i in helper.range(offset, offset + rest):
+			ret += self.widths[i % len(self.widths)]
+		#endfor
+		return ret
+	#enddef
+
+	def size(self, count):
+		"""
+		Return the number of bytes count pixels use.
+		"""
+		if not self.segment: return (self.bits(0, count) + 7) >> 3
+
+		# Segments start on different formats when the number of formats
+		# doesn't divide the segment, but this repeats every period segments.
+		segments, rest = divmod(count, self.segment)
+		period = len(self.widths) / gcd(self.segment, len(self.widths))
+		sizes = []
+		for i in helper.range(min(period, segments)):
+			size = (self.bits(i * self.segment, self.segment) + 7) >> 3
+			sizes.append(size + self.padding(size))
+		#endfor
+		loops, extra = divmod(segments, period)
+		return (loops * sum(sizes) + sum(sizes[:extra]) +
+			((self.bits(segments * self.segment, rest) + 7) >> 3))
+	#enddef
+
+	def decode(self, data, count):
+		"""
+		Return a list of count colors read from the binary data.
+		"""
+		if self.decoders is None:
+			self.decoders = [x.decoder(self.palette) for x in self.pixels]
+		#endif
+		decoders, masks, ret, pos = self.decoders, self.masks, [], 0
+		for i, n in self.chunks(count):
+			if i is None:
+				pos += self.padding(n)
+				continue
+			#endif
+
+			size, fmts, shifts = self.layout(i % len(self.pixels), n)
+			chunk = data[pos:pos + size]
+			# Treat data beyond the end as zeros.
+			if len(chunk) < size: chunk += "\x00" * (size - len(chunk))
+			big = int(hexlify(chunk), 16)
+			if len(decoders) == 1:
+				table, mask = decoders[0], masks[0]
+				ret += [table[(big >> x) & mask] for x in shifts]
+			else:
+				ret += [decoders[f][(big >> x) & masks[f]] for f, x in zip(fmts, shifts)]
+			#endif
+			pos += size
+		#endfor
+		return ret
+	#enddef
+
+	def encode(self, colors):
+		"""
+		Return the binary form of the given list of colors.
+		"""
+		if self.encoders is None:
+			self.encoders = [x.encoder(self.palette) for x in self.pixels]
+		#endif
+		encoders, ret = self.encoders, []
+		for i, n in self.chunks(len(colors)):
+			if i is None:
+				ret.append("\x00" * self.padding(n))
+				continue
+			#endif
+
+			size, fmts, shifts = self.layout(i % len(self.pixels), n)
+			big = 0
+			for f, x, color in zip(fmts, shifts, colors[i:i + n]):
+				big |= encoders[f][color] << x
+			#endfor
+			ret.append(unhexlify("%0*x" % (size * 2, big)))
+		#endfor
+		return "".join(ret)
+	#enddef
 #endclass
 
 class Color(rpl.Named, rpl.Number):
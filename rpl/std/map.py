@@ -65,6 +65,9 @@ class Map(rpl.RPLStruct):
 	def __init__(self, top, name, parent=None):
 		rpl.RPLStruct.__init__(self, top, name, parent)
 		self.base, self.size, self.myData = None, None, None
+		# Results of prepare by options, see prepare. Clones share this.
+		self.prepared = {}
+		self.nocopy += ["prepared"]
 	#enddef
 
 	def register(self):
@@ -78,8 +81,17 @@ class Map(rpl.RPLStruct):
 	#enddef
 
 	def serializePacked(self, options):
+		items = self["packed"].get()
+
+		# Plain numbers, such as from ranges, can be serialized all at once.
+		size = options.get("size")
+		if size and items and not [x for x in items if type(x) not in [rpl.Number, rpl.HexNum]]:
+			data = rpl.Number.serializeArray([x.number() for x in items], size, options["endian"])
+			return [data[i:i + size] for i in helper.range(0, len(data), size)]
+		#endif
+
 		packed = []
-		for x in self["packed"].get():
+		for x in items:
 			try: x.serialize
 			except AttributeError: packed.append(rpl.String(x).serialize(**options))
 			else: packed.append(x.serialize(**options))
@@ -88,6 +100,17 @@ class Map(rpl.RPLStruct):
 	#enddef
 
 	def prepare(self, callers):
+		"""
+		Return the serialized mappings and settings for mapping data for the
+		given callers. Since a map's mappings don't change, this is only done
+		once for each set of options, and is shared by all of a map's clones.
+		The last value is a dict of lookup tables:
+		mapped:  Each unpacked value and its type, see unpackedValue.
+		forward: Index in packed of each packed value.
+		prefix:  See prefixIndex.
+		reverse: Packed value of each unpacked value.
+		lengths: Lengths of strings in reverse, longest first.
+		"""
 		# Retrieve mappings and set mode.
 		try: packed, unpacked, mode, utype = self["packed"].list(), self["unpacked"].list(), 0, 0
 		except rpl.RPLBadType:
@@ -113,6 +136,10 @@ class Map(rpl.RPLStruct):
 		if width == "all": options["size"] = self.size.number()
 		elif width != "dynamic": options["size"] = width
 
+		key = (width, tuple(sorted(options.items())))
+		try: return self.prepared[key]
+		except KeyError: pass
+
 		# Serialize packed values.
 		packed = self.serializePacked(options)
 
@@ -146,11 +173,51 @@ class Map(rpl.RPLStruct):
 			#endfor
 		#endif
 
+		# Build lookup tables. The first of any repeated values wins.
+		tables = {
+			"mapped": [Map.unpackedValue(u) for u in unpacked],
+			"forward": {}, "prefix": Map.prefixIndex(packed), "reverse": {},
+		}
+		for i, p in enumerate(packed): tables["forward"].setdefault(p, i)
+		try: unpacked[0].get
+		except AttributeError: keys = list(unpacked)
+		else: keys = [x.get() for x in unpacked]
+		for u, p in zip(keys, packed): tables["reverse"].setdefault(u, p)
+		tables["lengths"] = sorted(set([
+			len(u) for u in keys if isinstance(u, basestring) and u
+		]), reverse=True)
+
 		# Back these up for speed.
-		return (
+		ret = self.prepared[key] = (
 			options, packed, unpacked, mode, self["cast"].string(),
-			self["string"].string(), self["number"].string(), width, types
+			self["string"].string(), self["number"].string(), width, types, tables
 		)
+		return ret
+	#enddef
+
+	@staticmethod
+	def unpackedValue(u):
+		"""
+		Return an unpacked value and its type, 0 for numbers or 1 for strings.
+		"""
+		try: return u.number(), 0
+		except rpl.RPLBadType: return u.string(), 1
+		# unpacked is a unicode string
+		except AttributeError: return u, 1
+	#enddef
+
+	@staticmethod
+	def prefixIndex(packed):
+		"""
+		Index packed values by their first byte, for matching the start of
+		some data against them. Each bucket keeps the order of packed, so the
+		first value that matches is the same one a scan of packed would find.
+		"""
+		index = {}
+		for i, p in enumerate(packed):
+			if p: index.setdefault(p[0], []).append((i, p))
+		#endfor
+		return index
 	#enddef
 
 	def importPrepare(self, rom, folder, filename=None, data=None, callers=[]):
@@ -162,46 +229,19 @@ class Map(rpl.RPLStruct):
 		# This can only be used as a data's type.
 		if not callers: return
 
-		options, packed, unpacked, mode, cast, string, number, width, types = self.prepare(callers)
+		options, packed, unpacked, mode, cast, string, number, width, types, tables = self.prepare(callers)
+		mapped = tables["mapped"]
 
 		# Read data from ROM.
-		self.rpl.rom.seek(self.base.number())
-		bindata = self.rpl.rom.read(self.size.number())
-
-		def tmpfunc(data, expand):
-			# Loop through packed and attempt unserialize to the respective type.
-			for i, p in enumerate(packed):
-				if expand:
-					if len(p) > len(data): continue
-					d = data[:len(p)]
-				else: d = data
-				if p == d:
-					# Match found!
-					u = unpacked[i]
-					try: d, t = u.number(), 0
-					except rpl.RPLBadType:
-						# String type.
-						d, t = u.string(), 1
-					except AttributeError:
-						# unpacked is a unicode string
-						d, t = u, 1
-					#endtry
-
-					if expand:
-						# Chop off what was actually used from data.
-						return d, t, data[len(p):]
-					else: return d, t
-				#endif
-			#endfor
+		bindata = str(self.rpl.rom.view(self.base.number(), self.size.number()))
 
-			# If we arrive here, no match was found.
-			if expand: raise RPLError("Impossible to continue mapping dynamically sized map on bad match.")
+		def unmappedValue(data):
 			action = self["unmapped"].get()[0:6] # Hack for normalizing addstr/num.
 			stringInterp = self.rpl.wrap("string").unserialize(data, **options).string()
 			numberInterp = self.rpl.wrap("number").unserialize(data, **options).number()
 			if action == "drop": return None
-			elif action == "addstr": d = stringInterp
-			elif action == "addnum": d = numberInterp
+			elif action == "addstr": d, t = stringInterp, 1
+			elif action == "addnum": d, t = numberInterp, 0
 			elif len(types) == 1:
 				# Has to be the only base type interpreted.
 				d, t = (stringInterp, 1) if types[0] == "string" else (numberInterp, 0)
@@ -221,37 +261,49 @@ class Map(rpl.RPLStruct):
 		#enddef
 
 		# Interpret.
-		if width == "all": myData, typ = tmpfunc(bindata, False)
-		elif width == "dynamic":
+		if width == "dynamic":
 			# Read until exhausted. Assumes string map.
-			ret = u""
-			while bindata:
-				tmp, typ, bindata = tmpfunc(bindata, True)
-				if tmp is not None: ret += tmp
+			index, ret, pos, end = tables["prefix"], [], 0, len(bindata)
+			while pos < end:
+				for i, p in index.get(bindata[pos], ()):
+					if bindata.startswith(p, pos): break
+				else: raise RPLError("Impossible to continue mapping dynamically sized map on bad match.")
+				tmp, typ = mapped[i]
+				ret.append(tmp)
+				pos += len(p)
 			#endwhile
-			myData = ret
+			myData = u"".join(ret)
 		else:
-			# Chunk and map. Assumes string map.
-			ret = u""
-			for i in helper.range(0, len(bindata), width):
-				tmp, typ = tmpfunc(bindata[i:i + width], False)
-				if tmp is not None: ret += tmp
-			#endfor
-			myData = ret
+			index = tables["forward"]
+			def tmpfunc(data):
+				try: return mapped[index[data]]
+				except KeyError: return unmappedValue(data)
+			#enddef
+
+			if width == "all": myData, typ = tmpfunc(bindata)
+			else:
+				# Chunk and map. Assumes string map.
+				ret = []
+				for i in helper.range(0, len(bindata), width):
+					tmp = tmpfunc(bindata[i:i + width])
+					if tmp is not None:
+						ret.append(tmp[0])
+						typ = tmp[1]
+					#endif
+				#endfor
+				myData = u"".join(ret)
+			#endif
 		#endif
 		self.myData = self.rpl.wrap((number or cast or "number") if typ == 0 else (string or cast or "string"), myData)
 	#enddef
 
 	def importDataLoop(self, rom, folder, base=None, callers=[]):
-		options, packed, unpacked, mode, cast, string, number, width, types = self.prepare(callers)
-
-		try: unpacked[0].get
-		except AttributeError: unpacked = list(unpacked)
-		else: unpacked = [x.get() for x in unpacked]
+		options, packed, unpacked, mode, cast, string, number, width, types, tables = self.prepare(callers)
+		reverse = tables["reverse"]
 
 		def tmpfunc(data):
-			try: return packed[unpacked.index(data)]
-			except IndexError:
+			try: return reverse[data]
+			except KeyError:
 				# No match
 				action = self["unmapped"].get()[0:6] # Hack for normalizing addstr/num.
 				try: stringInterp = self.rpl.wrap(string or cast or "string", data)
@@ -288,14 +340,21 @@ class Map(rpl.RPLStruct):
 			if tmp is not None: self.rpl.rom.write(tmp)
 		else:
 			# Writes until exhausted. Assumes string map.
-			ret = r""
-			for x in self.myData.string():
+			# Unpacked values may be several characters long, so take the
+			# longest one at each point, or else a single character.
+			text, lengths, ret, pos = self.myData.string(), tables["lengths"], [], 0
+			while pos < len(text):
+				for n in lengths:
+					x = text[pos:pos + n]
+					if x in reverse: break
+				else: x = text[pos]
 				tmp = tmpfunc(x)
-				if tmp is not None: ret += tmp
+				if tmp is not None: ret.append(tmp)
+				pos += len(x)
 			#endwhile
-			self.rpl.rom.write(ret)
+			self.rpl.rom.write("".join(ret))
 		#endif
-	#endif
+	#enddef
 
 	def exportDataLoop(self, rom, folder, datafile, to, key, callers=[]):
 		datafile.add(key, self.myData, to)
@@ -348,6 +348,7 @@ class TypeSet(std.graphic.Graphic):
 		else:
 			# Load a font file..
 			filename = self["font"].string()
+			self.rpl.uses(filename)
 			ext = os.path.splitext(filename)[1][1:].lower()
 			try: self.font = ImageFont.load(filename)
 			except IOError as err1:
@@ -390,7 +391,9 @@ class Text(TypeSet):
 	#enddef
 
 	def basic(self):
-		if self.get("textfile"): return rpl.String(helper.readFrom(self.get("textfile")))
+		if self.get("textfile"):
+			self.rpl.uses(self.get("textfile"))
+			return rpl.String(helper.readFrom(self.get("textfile")))
 		elif self.get("text"): return rpl.String(self.get("text"))
 		else: raise RPLError("%s has no text write." % self.name)
 	#enddef
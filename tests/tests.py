@@ -27,7 +27,10 @@ Usage: python -m tests.tests [tests...]
 For a list of tests see python -m tests.tests --help
 """
 
-import os, sys, Image, codecs, unittest, shutil
+import os, sys, gc, copy, Image, codecs, unittest, shutil, tempfile
+from array import array
+from zlib import crc32
+from cStringIO import StringIO
 from rpl import rpl, helper
 from time import time
 
@@ -403,6 +406,24 @@ class TestCalc(RPLTestCase):
 		self.check(x, "test15", "math", 0b11001100)
 		self.check(x, "test16", "math", int("butts", 36))
 	#enddef
+
+	def testCompiled(self):
+		x = TestCalc.refers.child("tests")
+		self.assertTrue(x["test7"].constant)
+		self.assertFalse(x["test8"].constant)
+
+		# References are read on every evaluation.
+		test1 = x["test1"]
+		x["test1"] = rpl.Number(5)
+		self.assertEqual(x["test8"].number(), 4)
+		x["test1"] = test1
+
+		# As are variables.
+		math = TestCalc.refers.wrap("math", "2 * (x + 1) - 3")
+		self.assertFalse(math.constant)
+		self.assertEqual(math.number({"x": 4}), 7)
+		self.assertEqual(math.number({"x": 9}), 17)
+	#enddef
 #endclass
 
 class TestRPL(RPLTestCase):
@@ -433,6 +454,214 @@ class TestRPL(RPLTestCase):
 			'Expected checkme2.doiwork to be "yes"'
 		)
 	#enddef
+	def testCache(self):
+		# Parse twice, the second time everything should come from the cache.
+		folder = tempfile.mkdtemp()
+		try:
+			for i in helper.range(2):
+				arpl = rpl.RPL()
+				arpl.cacheFolder = folder
+				arpl.parse(os.path.join("tests", "rpls", "rplstruct.rpl"))
+				self.assertTrue("data" in arpl.structs)
+				self.assertEqual(arpl.child("checkme2")["doiwork"].get(), "yes")
+				# One for the main file and one for each include.
+				self.assertEqual(len(os.listdir(folder)), 3)
+			#endfor
+
+			# Broken cache files are compiled again.
+			for x in os.listdir(folder):
+				with open(os.path.join(folder, x), "wb") as f: f.write("\x80\x02c__nothing__\nhere\n")
+			#endfor
+			arpl = rpl.RPL()
+			arpl.cacheFolder = folder
+			arpl.parse(os.path.join("tests", "rpls", "rplstruct.rpl"))
+			self.assertEqual(arpl.child("checkme2")["doiwork"].get(), "yes")
+
+			# And a different parser doesn't use the old ones.
+			parserHash = rpl.RPL.parserHash
+			self.assertEqual(len(parserHash), 40)
+			rpl.RPL.parserHash = "0" * 40
+			try:
+				arpl = rpl.RPL()
+				arpl.cacheFolder = folder
+				arpl.parse(os.path.join("tests", "rpls", "rplstruct.rpl"))
+				self.assertEqual(len(os.listdir(folder)), 6)
+			finally: rpl.RPL.parserHash = parserHash
+		finally: shutil.rmtree(folder)
+	#enddef
+
+	def testGraph(self):
+		arpl = rpl.RPL()
+		arpl.parse(
+			"RPL { lib: std }\n"
+			"calc A { x: +@B.y, z: 1 }\n"
+			"calc B { y: +@C.x + 1 }\n"
+			"static C { x: @`@D` }\n"
+			"static D { }\n",
+			string=True
+		)
+		graph = rpl.RPLGraph(arpl)
+		graph.check()
+		self.assertEqual([x.name for x in graph.order()][1:], ["D", "C", "B", "A"])
+
+		arpl = rpl.RPL()
+		arpl.parse("RPL { lib: std }\ncalc A { x: +@B.y }\ncalc B { y: +@A.x * 2 }\n", string=True)
+		self.assertRaises(rpl.RPLError, rpl.RPLGraph(arpl).check)
+	#enddef
+
+	def testParallel(self):
+		class Work(object):
+			def __init__(self, work): self.work, self.result = work, None
+			def exportWork(self): return self.work()
+			def exportResult(self, result): self.result = result
+		#endclass
+		def fail(): raise rpl.RPLError("Redone serially.")
+
+		arpl = rpl.RPL()
+		arpl.independentStructs = lambda structs: structs
+		works = [Work(lambda: 1), Work(fail), Work(lambda: 3)]
+		arpl.exportParallel(works, 2)
+		self.assertEqual([x.result for x in works], [1, None, 3])
+
+		# Bugs aren't hidden by falling back to a serial export.
+		self.assertRaises(ZeroDivisionError, arpl.exportParallel, [Work(lambda: 1), Work(lambda: 1 // 0)], 2)
+
+		# Results that can't be sent back leave everything to be redone.
+		stderr, helper.stderr = helper.stderr, StringIO()
+		try:
+			works = [Work(lambda: 1), Work(lambda: lambda: 2)]
+			arpl.exportParallel(works, 2)
+			self.assertIn("exporting serially", helper.stderr.getvalue())
+		finally: helper.stderr = stderr
+		self.assertEqual([x.result for x in works], [None, None])
+	#enddef
+
+	def testKeyCache(self):
+		arpl = rpl.RPL()
+		arpl.parse("RPL { lib: std }\ngraphic A { dimensions: [1, 1] }\ngraphic B { dimensions: [1, 1] }\n", string=True)
+		a, b = arpl.child("A"), arpl.child("B")
+
+		# Defaults are shared rather than copied into each struct.
+		self.assertIs(a["export"], b["export"])
+		self.assertFalse("export" in a.data)
+
+		hits = arpl.keyStats["hits"]
+		a["export"]
+		self.assertEqual(arpl.keyStats["hits"], hits + 1)
+
+		# Writing to one struct leaves the others' caches alone.
+		a["export"] = rpl.Literal("false")
+		b["export"]
+		self.assertEqual(arpl.keyStats["hits"], hits + 2)
+		self.assertEqual(a["export"].string(), "false")
+		self.assertEqual(b["export"].string(), "true")
+
+		# But children see changes to their parents, and parents see clones.
+		arpl = rpl.RPL()
+		arpl.parse("RPL { lib: std }\nstatic P { base: $10\n graphic C { dimensions: [1, 1] } }", string=True)
+		p = arpl.child("P")
+		c = p.child("C")
+		self.assertEqual(c.number("base"), 0x10)
+		p["base"] = rpl.Number(0x20)
+		self.assertEqual(c.number("base"), 0x20)
+		clone = p.clone()
+		stamp = c.keyStamp()
+		clone["base"] = rpl.Number(0x30)
+		self.assertNotEqual(c.keyStamp(), stamp)
+		p.clones = []
+
+		# Defaults inherited through a parent needn't pass their own type.
+		arpl = rpl.RPL()
+		arpl.parse("RPL { lib: typeset }\ntypeset T { font: f.png\n text { text: hi } }", string=True)
+		self.assertEqual(arpl.child("T").children.values()[0]["padleft"].get(), u"")
+	#enddef
+
+	def testClone(self):
+		arpl = rpl.RPL()
+		arpl.parse(
+			"RPL { lib: std }\n"
+			"format Record { endian: big, xlen: [number, 1], xname: [string, @this.xlen] }\n",
+			string=True
+		)
+		record = arpl.child("Record")
+		record.parseFormat("xname")
+		clone = record.clone()
+
+		# Plain data is shared until it's replaced.
+		self.assertIs(clone.data["endian"], record.data["endian"])
+		clone["endian"] = rpl.Literal("little")
+		self.assertEqual(record.data["endian"].string(), "big")
+
+		# But anything that may refer to the struct is copied when used.
+		size = clone.parseFormat("xname")["size"]
+		self.assertIs(size.container, clone)
+		self.assertIs(record.format["xname"]["size"].container, record)
+	#enddef
+
+	def testPacked(self):
+		arpl = rpl.RPL()
+		arpl.parse("RPL { lib: std }\nstatic A { r: 1-3:$10:a, l: [1, $2], m: [1, abc] }", string=True)
+		a = arpl.child("A")
+
+		# Copies stay packed.
+		l = copy.deepcopy(a["l"], {"parent": a})
+		self.assertIsNotNone(l.packed)
+		self.assertEqual(l.list("number"), [1, 2])
+
+		r = a["r"]
+		self.assertIsNotNone(r.packed)
+		self.assertEqual(unicode(r), u"1-3:$10:a")
+		self.assertIsNone(r.packed)
+		self.assertEqual(r.list("get"), [1, 2, 3, 16, u"a"])
+		# Elements are shared between lists.
+		self.assertIs(r.list()[0], a["l"].list()[0])
+		self.assertEqual(a["l"].list()[1].typeName, "hexnum")
+
+		# Anything else isn't packed.
+		self.assertIsNone(a["m"].packed)
+	#enddef
+
+	def testRange(self):
+		big = rpl.RPL().parseData("$ff-0:x:x:x:1+4000000")
+		self.assertEqual(big.len(), 4000259)
+		self.assertEqual(big.at(0).typeName, "hexnum")
+		self.assertEqual(big.at(1).typeName, "number")
+		self.assertEqual([big.at(i).get() for i in [255, 256, 258, 259, -1]], [0, u"x", u"x", 1, 4000000])
+		self.assertEqual(big.spans(), [(0xff, 0, 1), (0xfe, -1, 255), u"x", u"x", u"x", (1, 1, 4000000)])
+		self.assertIsNotNone(big.packed)
+	#enddef
+
+	def testNumber(self):
+		arpl = rpl.RPL()
+		self.assertEqual(arpl.parseData("-5").get(), -5)
+		self.assertEqual(unicode(arpl.parseData("-$1f")), u"-$1f")
+		self.assertEqual(arpl.parseData("-x").get(), u"-x")
+		# Ranges can't be negative, so these are still literals.
+		for x in ["-1-5", "-3:4", "-$1f*2"]:
+			self.assertEqual((arpl.parseData(x).typeName, arpl.parseData(x).get()), ("literal", x))
+		#endfor
+
+		num = rpl.Number(-2)
+		self.assertEqual(num.serialize(size=2, endian="big"), "\xff\xfe")
+		self.assertEqual(num.serialize(size=3, endian="little"), "\xfe\xff\xff")
+		num.unserialize("\xfe\xff\xff", endian="little")
+		self.assertEqual(num.get(), 0xfffffe)
+		num.unserialize("\xfe\xff\xff", endian="little", sign="signed")
+		self.assertEqual(num.get(), -2)
+
+		for size in [1, 2, 3, 4, 5, 8]:
+			for endian in ["little", "big"]:
+				values = [0, 1, -1, 0x7f, 0x80, -0x80, 0x1234 % (1 << size * 8)]
+				data = rpl.Number.serializeArray(values, size, endian)
+				self.assertEqual(data, "".join([rpl.Number(x).serialize(size=size, endian=endian) for x in values]))
+				unsigned = rpl.Number.unserializeArray(data, size, endian)
+				self.assertEqual(unsigned, [x % (1 << size * 8) for x in values])
+				self.assertEqual(rpl.Number.unserializeArray(data, size, endian, "signed"), [
+					x - (1 << size * 8) if x >> (size * 8 - 1) else x for x in unsigned
+				])
+			#endfor
+		#endfor
+	#enddef
 #endclass
 
 class TestROM(RPLTestCase):
@@ -443,6 +672,171 @@ class TestROM(RPLTestCase):
 		folder = os.path.join("tests", "rpls", "rom")
 		arpl.importData(os.path.join(folder, "test.bin"), folder, nocreate=True)
 	#enddef
+
+	def testStream(self):
+		# Writing past the end must grow the file, like a regular file.
+		fn = os.path.join("tests", "rpls", "rom", "test.stream.bin")
+		try: os.unlink(fn)
+		except OSError: pass
+		stream = helper.stream(fn)
+		stream.write("abc")
+		stream.seek(6)
+		stream.write("def")
+		self.assertEqual(stream.tell(), 9)
+		self.assertEqual(str(stream.view(2, 5)), "c\x00\x00\x00d")
+		stream.seek(1)
+		self.assertEqual(stream.read(3), "bc\x00")
+		# Reads stop at the end of what was written, not of the mapping.
+		self.assertEqual(str(stream.view(7)), "ef")
+		self.assertEqual(stream.read(), "\x00\x00def")
+
+		# Writing piece by piece only grows the mapping now and then.
+		capacities = set()
+		for i in helper.range(0x4000):
+			stream.write("ghij")
+			capacities.add(stream.capacity)
+		#endfor
+		self.assertTrue(len(capacities) < 4)
+		self.assertEqual(helper.streamSize(stream), 9 + 0x10000)
+
+		# And the file is cut down to size when closed.
+		stream.close()
+		self.assertEqual(read(fn, "rb"), "abc\x00\x00\x00def" + "ghij" * 0x4000)
+
+		# Or when it's forgotten about.
+		stream = helper.stream(fn)
+		stream.seek(0, 2)
+		stream.write("klmn")
+		del stream
+		gc.collect()
+		self.assertEqual(os.path.getsize(fn), 9 + 0x10004)
+		os.unlink(fn)
+
+		# Views to the end of a fake stream are empty too.
+		self.assertEqual(helper.FakeStream().view(0), "")
+		self.assertEqual(helper.FakeStream().view(0, 2), "\x00\x00")
+	#enddef
+
+	def testImportError(self):
+		# A ROM grown by an import that then fails is still cut down to size.
+		class Broken(rpl.RPLStruct):
+			typeName = "broken"
+			def importData(self, rom, folder):
+				rom.seek(110)
+				rom.write("\xff" * 10)
+				raise rpl.RPLError("Broken.")
+			#enddef
+		#endclass
+
+		fd, fn = tempfile.mkstemp(".bin")
+		os.write(fd, "\x00" * 110)
+		os.close(fd)
+		try:
+			arpl = rpl.RPL()
+			arpl.registerStruct(Broken)
+			arpl.parse("broken B {}", string=True)
+			self.assertRaises(rpl.RPLError, arpl.importData, fn, "")
+			self.assertEqual(os.path.getsize(fn), 120)
+		finally: os.unlink(fn)
+	#enddef
+
+	def testScanner(self):
+		from imperial import ROMScanner
+		folder = tempfile.mkdtemp()
+		files = [os.path.join(folder, "rom%i.bin" % i) for i in helper.range(4)]
+		for i, x in enumerate(files):
+			with open(x, "wb") as f: f.write(chr(i) * 16)
+		#endfor
+
+		# The first file fails a check, the second can't be validated at all,
+		# and the last two pass everything.
+		class ROM(object):
+			def __getitem__(self, key): return None
+			def plausible(self, stream): return True
+			def validate(self, stream):
+				idx = files.index(stream.name)
+				if idx == 1: raise ValueError("Not a ROM.")
+				return (1, ["crc32"]) if idx == 0 else (2, [])
+			#enddef
+		#endclass
+
+		try:
+			ROMScanner.cache.clear()
+			scanner = ROMScanner([ROM()], files, 1)
+			results = [scanner.check(i, x) for i, x in enumerate(files)]
+			# Every file gets a result, even the one that raised.
+			self.assertEqual(results, [(0, 1, 1), (1, 0, 0), (2, 2, 0), (3, 2, 0)])
+
+			# The earliest file to pass everything wins, whatever order the
+			# results come in.
+			for x in reversed(results):
+				scanner.queue.put(x)
+				done = scanner.results()
+				self.assertEqual(done, x[0] == 0)
+			#endfor
+			self.assertEqual(scanner.romfile(), files[2])
+			self.assertTrue(scanner.results())
+			self.assertEqual(scanner.checked, len(files))
+		finally:
+			ROMScanner.cache.clear()
+			shutil.rmtree(folder)
+		#endtry
+	#enddef
+
+	def testCRC(self):
+		arpl, data = rpl.RPL(), "".join(map(chr, helper.range(256))) * 4
+		stream = StringIO(data)
+		for rang, expect in [
+			("$10", data[0x10:]),
+			("$10-$1f:$30~4", data[0x10:0x20] + data[0x30:0x2c:-1]),
+			("$3fe:e", data[0x3fe] + data[0x3fe:]),
+			("e:b", data[::-1]),
+			("b:$10:x:$20*3", data[0:0x11] + data[0x20] * 3),
+		]:
+			crc = rpl.ROM.getCRC(stream, arpl.parseData(rang))
+			self.assertEqual(crc, crc32(expect) & 0xFFFFFFFF, "Wrong CRC for %s" % rang)
+		#endfor
+
+		# Several forward runs share a pass, read in chunks smaller than them.
+		jobs = [rpl.ROM.addressRuns(stream, arpl.parseData(x)) for x in [
+			"$10", "$10-$1f:$30~4", "0-$ff:$80-$2ff", "$100+$180:$300+8", "$3fe:e", "e:b", "$20+$40:$60+$40",
+		]]
+		chunk, helper.crcChunkSize = helper.crcChunkSize, 0x40
+		try: self.assertEqual(helper.crcMany(stream, jobs), [helper.crcRuns(stream, x) & 0xFFFFFFFF for x in jobs])
+		finally: helper.crcChunkSize = chunk
+		self.assertEqual(helper.crcMany(stream, jobs[3:4]), [crc32(data[0x100:0x280] + data[0x300:0x308]) & 0xFFFFFFFF])
+	#enddef
+
+	def testValidate(self):
+		data = "".join(map(chr, helper.range(256))) * 4
+		fn = os.path.join("tests", "rpls", "rom", "test.validate.bin")
+		with open(fn, "wb") as f: f.write(data)
+		arpl = rpl.RPL()
+		arpl.parse("\n".join([
+			"ROM Whole { crc32: $%08x }" % (crc32(data) & 0xFFFFFFFF),
+			'ROM Wrong { id: "zz", crc32: $0 }',
+			'ROM Short { text: [["$00$01", $3ff]] }',
+			'ROM Header { id: "$00$01", text: [["$03", $3]] }',
+			"ROM Parts { crc32: [[$%08x, $10-$1f:$30~4], [$%08x, $100:e], [$%08x, 0+8]] }" % tuple(
+				crc32(x) & 0xFFFFFFFF for x in [data[0x10:0x20] + data[0x30:0x2c:-1], data[0x100] + data[0x100:], "x"]
+			),
+		]), string=True)
+
+		stream = helper.MappedStream(fn, "rb")
+		try:
+			self.assertEqual(arpl.child("Whole").validate(stream), (1, []))
+			self.assertEqual(arpl.child("Parts").validate(stream), (2, [("crc32", 2)]))
+			# Whether it's worth checking at all, by size and header.
+			self.assertTrue(arpl.child("Header").plausible(stream))
+			self.assertFalse(arpl.child("Wrong").plausible(stream))
+			self.assertFalse(arpl.child("Short").plausible(stream))
+			# The whole file's CRC is remembered.
+			self.assertIn(os.path.realpath(fn), helper.fileCRCs)
+		finally:
+			stream.close()
+			os.unlink(fn)
+		#endtry
+	#enddef
 #endclass
 
 # Uhg, can't do this yet cause it'll only return the right data during the process.
@@ -467,7 +861,7 @@ class IOTest(RPLTestCase):
 	compares: Tuples of (expected data, result data) order is important because
 	          the result data is deleted before the tests.
 	"""
-	def _xxport(self, direction, name, ext, what, compares, defs={}):
+	def _xxport(self, direction, name, ext, what, compares, defs={}, jobs=1):
 		if type(what) is not list:
 			compares = [what] + list(compares)
 			what = None
@@ -492,7 +886,7 @@ class IOTest(RPLTestCase):
 		#endif
 
 		if direction == 0:   arpl.importData(os.path.join(folder, "test." + name + ext), folder, what)
-		elif direction == 1: arpl.exportData(os.path.join(folder, name + ext), folder, what)
+		elif direction == 1: arpl.exportData(os.path.join(folder, name + ext), folder, what, jobs=jobs)
 		elif direction == 2: arpl.run(folder, what)
 
 		self.time = time()
@@ -524,7 +918,7 @@ class IOTest(RPLTestCase):
 	#enddef
 
 	def _import(self, name, ext, what=None, *compares, **kwargs): return self._xxport(0, name, ext, what, compares, defs=kwargs.get("defs", {}))
-	def _export(self, name, ext, what=None, *compares, **kwargs): return self._xxport(1, name, ext, what, compares, defs=kwargs.get("defs", {}))
+	def _export(self, name, ext, what=None, *compares, **kwargs): return self._xxport(1, name, ext, what, compares, defs=kwargs.get("defs", {}), jobs=kwargs.get("jobs", 1))
 	def _run(self, name, what=None, *compares): return self._xxport(2, name, "", what, compares)
 #enddef
 
@@ -546,6 +940,151 @@ class TestData(IOTest):
 
 	@timedTest
 	def testExportBIN(self): self._export("data", ".bin", ("data.bin", "test.data.bin"), defs={"ext": "bin"})
+
+	def _incremental(self, folder, manifest):
+		arpl = rpl.RPL()
+		arpl.addDef("ext", "bin")
+		arpl.manifest = manifest
+		arpl.parse(os.path.join("tests", "rpls", "data.rpl"))
+		return arpl
+	#enddef
+
+	def testImportIncremental(self):
+		folder = tempfile.mkdtemp()
+		try:
+			shutil.copy(os.path.join("tests", "rpls", "data", "data.bin"), folder)
+			rom, manifest = os.path.join(folder, "test.data.bin"), os.path.join(folder, "test.manifest")
+			for i in helper.range(3):
+				# Edited bin resources must be imported again.
+				if i == 2:
+					f = open(os.path.join(folder, "data.bin"), "r+b")
+					f.seek(0x18)
+					f.write("z")
+					f.close()
+				#endif
+				# None asks for everything, the same as an empty list.
+				self._incremental(folder, manifest).importData(rom, folder, None)
+			#endfor
+			full = os.path.join(folder, "full.bin")
+			self._incremental(folder, None).importData(full, folder)
+			self.assertEqual(read(rom, "rb"), read(full, "rb"))
+			self.assertIn("azcdefgh", read(rom, "rb"))
+		finally: shutil.rmtree(folder)
+	#enddef
+
+	def testExportIncremental(self):
+		folder = tempfile.mkdtemp()
+		try:
+			rom, manifest = os.path.join("tests", "rpls", "data", "data.bin"), os.path.join(folder, "test.manifest")
+			out = os.path.join(folder, "test.data.bin")
+			for i in helper.range(3):
+				# Output files that went missing must be exported again.
+				if i == 2: os.unlink(out)
+				self._incremental(folder, manifest).exportData(rom, folder)
+				self.assertTrue(os.path.exists(out))
+				self.assertEqual(read(rom, "rb"), read(out, "rb"))
+			#endfor
+		finally: shutil.rmtree(folder)
+	#enddef
+
+	def testRecords(self):
+		fd, fn = tempfile.mkstemp(".bin")
+		os.write(fd, "\x02\x1d\x00\x00\x00" + "\xff\xfeabc\x01" * 3 + "\x00\x01xyz\x02" + "\x01A\x01E\x01I" + "\x00" * 14 + "-RwB")
+		os.close(fd)
+		arpl = rpl.RPL()
+		arpl.parse("\n".join([
+			"RPL { lib: std }",
+			"format Rec { endian: little, sign: unsigned, xa: [number, 2, big], xb: [string, 3], xc: [number, 1] }",
+			"format Ref { xp: [number, 1], xv: [string, 1, @this.xp] }",
+			"data Data { endian: little, sign: unsigned, xn: [number, 1], xend: [number, 4], xrecs: [@Rec, @this.xn], xtail: [@Rec, @this.xend, end] }",
+			"data Refs { base: $1d, xrefs: [@Ref, 3] }",
+			"format B { xa: [number, 1], xb: [number, 2, 5], xc: [string, 2] }",
+			"data Bs { base: $1d, xbs: [@B, 4] }",
+			"data Short { base: $27, xs: [@Rec, 3] }",
+		]), string=True)
+		arpl.rom, arpl.requested = helper.MappedStream(fn, "rb"), []
+		try:
+			data = arpl.child("Data")
+			self.assertEqual(arpl.child("Rec").recordLayout()[0], 6)
+
+			recs = data["xrecs"].clones
+			self.assertEqual(len(recs), 2)
+			# Fields are only read once they're asked for.
+			self.assertNotIn("xb", recs[1].data)
+			self.assertEqual([r["xa"].get() for r in recs], [0xfffe, 0xfffe])
+			self.assertEqual(recs[1]["xb"].get(), "abc")
+			# Numbers are read for all the records at once, other types aren't.
+			self.assertEqual(recs[0].record[3], {"xa": [0xfffe, 0xfffe], "xb": None})
+			self.assertEqual([r["xc"].get() for r in recs], [1, 1])
+			self.assertEqual(recs[1]["base"].get(), 11)
+
+			tail = data["xtail"].clones
+			self.assertEqual(len(tail), 2)
+			self.assertEqual((tail[1]["xa"].get(), tail[1]["xb"].get(), tail[1]["xc"].get()), (1, "xyz", 2))
+
+			# Offsets from other keys are read record by record.
+			self.assertIsNone(arpl.child("Ref").recordLayout())
+			self.assertEqual([(r["xp"].get(), r["xv"].get()) for r in arpl.child("Refs")["xrefs"].clones], [(1, "A"), (1, "E"), (1, "I")])
+
+			# So are offsets elsewhere, which may reach past the records.
+			self.assertIsNone(arpl.child("B").recordLayout())
+			last = arpl.child("Bs")["xbs"].clones[-1]
+			self.assertEqual((last["xb"].get(), last["xc"].get()), (0x522d, "wB"))
+
+			# Records that run past the end of the ROM are read as far as they go.
+			recs = arpl.child("Short")["xs"].clones
+			self.assertEqual([(r["xa"].get(), r["xc"].get()) for r in recs], [(0, 0), (0, 0x52), (0x7742, 0)])
+		finally:
+			arpl.rom.close()
+			os.unlink(fn)
+		#endtry
+	#enddef
+
+	def testWrite(self):
+		from rpl.std.data import RPLDataFile, JSONDict, JSONList
+		from rpl.std.bin import Bin
+		datafile = RPLDataFile(False)
+		top = datafile.addStruct("Top")
+		datafile.add("xnum", rpl.Number(1), top)
+		for x in ["6162", "63"]: datafile.add("xbin", Bin(x), datafile.addStruct("xbins", top))
+		datafile.add("xref", rpl.RefString(u"a"), datafile.addStruct("xrec", top))
+
+		# Values know how they end without being parsed.
+		self.assertEqual([x.ending() for x in [Bin("63"), Bin(""), rpl.RefString(u"a"), rpl.String(u"#")]], ["#", ",", ",", ""])
+
+		# Written in small batches, it should come out the same as all at once.
+		batch, helper.writeBatch = helper.writeBatch, 8
+		try:
+			out = StringIO()
+			helper.writeTo(out, datafile.chunks())
+			self.assertEqual(out.getvalue(), (
+				"static Top {xnum: 1, \n"
+				"xbins: [`61 62`,                                           # ab\n"
+				", `63`,                                              # c\n"
+				"], xrec: [@`a`,]}"
+			).replace("\n", os.linesep))
+			self.assertEqual(out.getvalue(), datafile.base.children["Top"].__unicode__(False))
+
+			out = StringIO()
+			json = JSONDict([("a", JSONList([rpl.Number(1), rpl.String(u"x")])), ("b", rpl.Number(2))])
+			helper.writeTo(out, json.chunks(False))
+			self.assertEqual(out.getvalue(), '{ "a": [ 1, "x" ], "b": 2 }')
+		finally: helper.writeBatch = batch
+
+		# A file is left as it was if writing to it fails partway.
+		folder = tempfile.mkdtemp()
+		try:
+			fn = os.path.join(folder, "test.rpl")
+			helper.writeTo(fn, iter([u"old"]))
+			def chunks():
+				yield u"new" * 10
+				raise rpl.RPLError("Empty...?")
+			#enddef
+			self.assertRaises(rpl.RPLError, helper.writeTo, fn, chunks())
+			self.assertEqual(read(fn, "rb"), "old")
+			self.assertEqual(os.listdir(folder), ["test.rpl"])
+		finally: shutil.rmtree(folder)
+	#enddef
 #endclass
 
 class TestMapString(IOTest):
@@ -554,6 +1093,54 @@ class TestMapString(IOTest):
 
 	@timedTest
 	def testExport(self): self._export("map_string", ".bin", ("map_string.rpl", "test.map_string.rpl"))
+
+	def testDynamic(self):
+		fd, fn = tempfile.mkstemp(".bin")
+		os.write(fd, "\x01\x02\x03\x03\x01\x04")
+		os.close(fd)
+		arpl = rpl.RPL()
+		arpl.parse("\n".join([
+			"RPL { lib: std }",
+			'map Script { packed: ["$01", "$01$02", "$02$03", "$03"], unpacked: [a, b, c, d], width: dynamic }',
+			"data Data { x: [number, 1] }",
+		]), string=True)
+		arpl.rom = helper.MappedStream(fn, "rb")
+		try:
+			script = arpl.child("Script")
+			# The first packed value that matches wins, even if a later one is longer.
+			script.base, script.size = rpl.Number(0), rpl.Number(5)
+			script.exportPrepare(arpl.rom, "", [arpl.child("Data")])
+			self.assertEqual(script.myData.get(), "acda")
+
+			script.size = rpl.Number(6)
+			self.assertRaises(rpl.RPLError, script.exportPrepare, arpl.rom, "", [arpl.child("Data")])
+		finally:
+			arpl.rom.close()
+			os.unlink(fn)
+		#endtry
+	#enddef
+
+	def testLongest(self):
+		arpl = rpl.RPL()
+		arpl.parse("\n".join([
+			"RPL { lib: std }",
+			'map Script { packed: ["$01", "$02", "$03"], unpacked: [a, ab, "<end>"], width: dynamic }',
+			"data Data { x: [number, 1] }",
+		]), string=True)
+		script, callers = arpl.child("Script").clone(), [arpl.child("Data")]
+		script.base, script.myData = rpl.Number(0), rpl.String("aab<end>a")
+
+		# Clones share what's been prepared.
+		self.assertIs(arpl.child("Script").clone().prepare(callers), script.prepare(callers))
+
+		# The longest unpacked value is taken at each point.
+		arpl.rom = StringIO()
+		script.importDataLoop(arpl.rom, "", callers=callers)
+		self.assertEqual(arpl.rom.getvalue(), "\x01\x02\x03\x01")
+
+		script.myData = rpl.String("abc")
+		self.assertRaises(rpl.RPLError, script.importDataLoop, arpl.rom, "", callers=callers)
+	#enddef
 #endclass
 
 class TestMapList(IOTest):
@@ -580,6 +1167,72 @@ class TestGraphic(IOTest):
 	@timedTest
 	def testImport24b(self): self._import("graphic", "24b.bmp", ["Header", "BMP24b"], ("graphic24b.bmp", "test.graphic24b.bmp"))
 
+	def testImportIncremental(self):
+		folder = os.path.join("tests", "rpls", "graphic")
+		rom, manifest = os.path.join(folder, "test.graphic16.bmp"), os.path.join(folder, "test.manifest")
+		for x in [rom, manifest]:
+			try: os.unlink(x)
+			except OSError: pass
+		#endfor
+
+		for i, damage in enumerate([None, None, 200]):
+			if damage:
+				f = open(rom, "r+b")
+				f.seek(damage)
+				f.write("\xff" * 16)
+				f.close()
+			#endif
+			arpl = rpl.RPL()
+			arpl.manifest = manifest
+			arpl.parse(os.path.join("tests", "rpls", "graphic.rpl"))
+			arpl.importData(rom, folder, ["Header", "BMP16"])
+			self.assertEqual(read([folder, "graphic16.bmp"], "rb"), read([folder, "test.graphic16.bmp"], "rb"))
+			# Only the second import has nothing to do.
+			self.assertEqual(arpl.structsByName["Image16"].image is None, i == 1)
+		#endfor
+	#enddef
+
+	def testExportIncremental(self):
+		folder = os.path.join("tests", "rpls", "graphic")
+		png, manifest = os.path.join(folder, "test.graphic16.png"), os.path.join(folder, "test.manifest")
+		for x in [png, manifest]:
+			try: os.unlink(x)
+			except OSError: pass
+		#endfor
+
+		for i in helper.range(3):
+			# Output files that went missing must be exported again.
+			if i == 2: os.unlink(png)
+			arpl = rpl.RPL()
+			arpl.manifest = manifest
+			arpl.parse(os.path.join("tests", "rpls", "graphic.rpl"))
+			arpl.exportData(os.path.join(folder, "graphic16.bmp"), folder, ["Header", "BMP16"])
+			self.assertTrue(os.path.exists(png))
+			# Only the second export has nothing to do.
+			self.assertEqual(arpl.structsByName["Image16"].image is None, i == 1)
+		#endfor
+	#enddef
+
+	def testPadding(self):
+		arpl = rpl.RPL()
+		arpl.parse("\n".join([
+			"RPL { lib: std }",
+			"graphic None { base: $0, dimensions: [3, 1], pixel: '8bi', padding: [none, 4] }",
+			"graphic Row { base: $0, dimensions: [3, 1], pixel: '8bi', padding: [row, 4] }",
+		]), string=True)
+		colors = [(x, x, x, 255) for x in helper.range(3)]
+		class Palette(object):
+			def indexOf(self, color): return colors.index(color)
+		#endclass
+		for name, size in [("None", 3), ("Row", 4)]:
+			struct = arpl.child(name)
+			codec = struct.codec(3, 1, Palette())
+			self.assertEqual(codec.size(3), size)
+			self.assertEqual(struct.len(), size)
+			self.assertEqual(len(codec.encode(colors)), size)
+		#endfor
+	#enddef
+
 	@timedTest
 	def testExport16(self): self._export("graphic", "16.bmp", ["Header", "BMP16"], ("graphic.png", "test.graphic16.png"), ("graphic16.rpl", "test.graphic16.rpl"))
 	@timedTest
@@ -594,6 +1247,85 @@ class TestMin(IOTest):
 
 	@timedTest
 	def testExport(self): self._export("min", ".bin", ("tile.bmp", "test.tile.bmp"), ("tilemap1.bmp", "test.tilemap1.bmp"), ("tilemap2.bmp", "test.tilemap2.bmp"))
+
+	@timedTest
+	def testExportJobs(self): self._export("min", ".bin", ("tile.bmp", "test.tile.bmp"), ("tilemap1.bmp", "test.tilemap1.bmp"), ("tilemap2.bmp", "test.tilemap2.bmp"), jobs=2)
+
+	def testDecode(self):
+		from rpl import min as pm
+		pixels = lambda *x: dict([(i, v) for i, v in enumerate(x) if v])
+
+		# Columns are bytes, rows are bits from the top.
+		self.assertEqual(pixels(*pm.Tile.prepareTile("\x01\x80" + "\x00" * 6, [0, 1])), {0: 1, 57: 1})
+		self.assertEqual(pixels(*pm.Tile3.prepareTile(
+			"\x03" + "\x00" * 7, "\x05" + "\x00" * 7, [0, 1, 2]
+		)), {0: 1, 8: 2, 16: 2})
+
+		# Quadrants are UL, BL, UR, BR, each a mask then a draw 16 bytes later.
+		bank = ["\x00"] * 64
+		bank[0] = bank[16] = "\x01"
+		bank[49] = "\x80"
+		self.assertEqual(pixels(*pm.Sprite.prepareSprite("".join(bank), [0, 1, 2, 3])), {0: 3, 121: 1})
+		bank1, bank2 = ["\x00"] * 64, ["\x00"] * 64
+		bank1[0], bank2[0], bank1[16], bank2[16] = "\x03", "\x01", "\x06", "\x02"
+		self.assertEqual(pixels(*pm.Sprite3.prepareSprite(
+			"".join(bank1), "".join(bank2), [0, 1, 2, 3, 4]
+		)), {0: 2, 16: 1, 32: 4})
+
+		# Decoding a bank is the same as decoding each tile in it.
+		bank = "".join([chr((x * 37) & 0xff) for x in helper.range(64)])
+		rows = pm.Tile.decodeTiles(bank)
+		for t in helper.range(0, 64, 8):
+			self.assertEqual(
+				pm.gatherCells(rows, [[t]], pm.Tile.cellLayout),
+				"".join(map(chr, pm.Tile.prepareTile(bank[t:t + 8], [0, 1])))
+			)
+		#endfor
+	#enddef
+
+	def testEncode(self):
+		from rpl import min as pm
+		class ROM(object):
+			def __init__(self, data):
+				self.stream, self.writes = StringIO(), 0
+				self.stream.write(data)
+			#enddef
+			def seek(self, pos): self.stream.seek(pos)
+			def write(self, data):
+				self.writes += 1
+				self.stream.write(data)
+			#enddef
+		#endclass
+
+		arpl = rpl.RPL()
+		arpl.parse("\n".join([
+			"RPL { lib: [std, min] }",
+			"tilemap3 Tiles { base1: $0, base2: $100, dimensions: [2, 2], map: 3:2:x:1:0 }",
+			"spritemap3 Sprites { base1: $0, base2: $100, dimensions: [2, 2], map: 3~4 }",
+		]), string=True)
+		for name, bank, size in [("Tiles", pm.Tile3.decodeTiles, 8), ("Sprites", pm.Sprite3.decodeSprites, 64)]:
+			struct = arpl.child(name)
+			palette = struct.getPalette()
+			width, height = struct.dimensions()
+			struct.image = Image.new("RGBA", (width, height))
+			struct.image.putdata([palette[(x * 7 + x // 5) % len(palette)] for x in helper.range(width * height)])
+			rom = ROM("\x00" * 0x200)
+
+			# Each base gets its used cells in a single write.
+			struct.importData(rom, "")
+			self.assertEqual(rom.writes, 2)
+
+			# Every palette color, dithered gray included, reads back the same.
+			data = rom.stream.getvalue()
+			rows = bank(data[:0x100], data[0x100:])
+			cells = pm.mapCells(struct, size)
+			indexes = pm.gatherCells(rows, cells, struct.cellLayout, {"x": "\xff" * 8})
+			expected = list(struct.image.getdata())
+			for i, x in enumerate(bytearray(indexes)):
+				if x != 0xff: self.assertEqual(palette[x], expected[i])
+			#endfor
+		#endfor
+	#enddef
 #endclass
 
 class TestTypeset(IOTest):
@@ -610,6 +1342,421 @@ class TestTypeset(IOTest):
 	#enddef
 #endclass
 
+# Benchmarks. These aren't part of "all", run them with: python -m tests.tests bench
+def synthRPL(lines):
+	"""
+	Generate an RPL of roughly the given number of lines, mixing the
+	value types a real descriptor uses.
+	"""
+	ret = []
+	for i in helper.range(0, lines // 8):
+		ret += [
+			"static Struct%i {" % i,
+			"\tname: \"struct %i\"" % i,
+			"\tnum: %i" % i,
+			"\thex: $%x" % i,
+			"\tlst: [1, 2, [a, b], 'lit']",
+			"\trng: 1-4:2*3",
+			"\tref: @Struct0.num",
+			"}",
+		]
+	#endfor
+	return "\n".join(ret)
+#enddef
+
+class BenchParse(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.raw = synthRPL(50000)
+	#enddef
+
+	@timedTest
+	def testParse50k(self):
+		arpl = rpl.RPL()
+		arpl.parse(self.raw, string=True)
+		self.assertEqual(len(arpl.structsByName), 50000 // 8)
+	#enddef
+#endclass
+
+class BenchGraphic(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		from rpl.std import graphic
+		cls.graphic = graphic
+		cls.palette = [(x * 17, x * 17, x * 17, 255) for x in helper.range(16)]
+		# A 256x256 4bpp sheet.
+		cls.data = "".join([chr((x * 7) & 0xff) for x in helper.range(256 * 128)])
+	#enddef
+
+	def codec(self):
+		return self.graphic.PixelCodec([self.graphic.Pixel("4bi", rpl.RPL())], self.palette)
+	#enddef
+
+	@timedTest
+	def testDecode(self):
+		self.assertEqual(len(self.codec().decode(self.data, 256 * 256)), 256 * 256)
+	#enddef
+
+	@timedTest
+	def testEncode(self):
+		colors = self.codec().decode(self.data, 256 * 256)
+		palette = self.palette
+		class Palette(object):
+			def indexOf(self, color): return palette.index(color)
+		#endclass
+		codec = self.codec()
+		codec.palette = Palette()
+		self.assertEqual(codec.encode(colors), self.data)
+	#enddef
+#endclass
+
+class BenchTypeCheck(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.rpl = rpl.RPL()
+		cls.rpl.parse("RPL { lib: std }", string=True)
+	#enddef
+
+	def verify(self, syntax, data, times=20000):
+		check = rpl.RPLTypeCheck(self.rpl, "bench", syntax)
+		for i in helper.range(times): check.verify(data)
+	#enddef
+
+	@timedTest
+	def testDimensions(self):
+		self.verify("[number, number]", RL(rpl.Number(8), rpl.Number(16)))
+	#enddef
+
+	@timedTest
+	def testPalette(self):
+		palette = RL(*[self.rpl.wrap("color", x * 0x111111) for x in helper.range(16)])
+		self.verify("[color]+", palette, 2000)
+	#enddef
+
+	@timedTest
+	def testCRC(self):
+		self.verify("hexnum|[[hexnum, hexnum|range]*0]*", rpl.HexNum(0xdeadbeef))
+		self.verify("hexnum|[[hexnum, hexnum|range]*0]*", RL(
+			RL(rpl.HexNum(0xdeadbeef), rpl.Range([rpl.Number(0), rpl.Number(0x100)])),
+			RL(rpl.HexNum(0xbeadbabe), rpl.HexNum(0x200)),
+		), 5000)
+	#enddef
+#endclass
+
+class BenchClone(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.rpl = rpl.RPL()
+		cls.rpl.parse("\n".join(["RPL { lib: std }", "format Record {"] + [
+			"\tx%i: [number, %i]" % (i, i % 4 + 1) for i in helper.range(8)
+		] + ["\txname: [string, @this.x0]", "}"]), string=True)
+		cls.record = cls.rpl.child("Record")
+		for k in cls.record.format: cls.record.parseFormat(k)
+	#enddef
+
+	@timedTest
+	def testClone5k(self):
+		try:
+			for i in helper.range(5000): self.record.clone().parseFormat("x1")
+		finally: self.record.clones = []
+	#enddef
+#endclass
+
+class BenchCRC(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		# 16 MiB ROM.
+		cls.rom = StringIO(os.urandom(0x1000000))
+		cls.rpl = rpl.RPL()
+
+		# Eight overlapping quarters, and what each comes to on its own.
+		cls.jobs = [
+			rpl.ROM.addressRuns(cls.rom, cls.rpl.parseData("$%x+$400000" % (i * 0x180000)))
+			for i in helper.range(8)
+		]
+		cls.crcs = [helper.crcRuns(cls.rom, x) & 0xFFFFFFFF for x in cls.jobs]
+	#enddef
+
+	@timedTest
+	def testWhole(self):
+		rpl.ROM.getCRC(self.rom, self.rpl.parseData("0-$ffffff"))
+	#enddef
+
+	@timedTest
+	def testReversed(self):
+		rpl.ROM.getCRC(self.rom, self.rpl.parseData("e:b"))
+	#enddef
+
+	@timedTest
+	def testMany(self):
+		# All eight in one pass.
+		self.assertEqual(helper.crcMany(self.rom, self.jobs), self.crcs)
+	#enddef
+#endclass
+
+def dataMemory():
+	"""
+	Return the bytes held by all live RPLData, counting their attribute
+	dicts and element lists.
+	"""
+	total = 0
+	for x in gc.get_objects():
+		if isinstance(x, rpl.RPLData):
+			total += sys.getsizeof(x)
+			for y in getattr(x, "__dict__", {}).values() + [getattr(x, "__dict__", None)]:
+				if type(y) in [list, dict]: total += sys.getsizeof(y)
+			#endfor
+			for k, slot in x.slots():
+				# Read the slots directly so packed lists stay packed.
+				try: y = slot.__get__(x)
+				except AttributeError: continue
+				if type(y) is tuple: total += sum(map(sys.getsizeof, y))
+				elif type(y) in [list, array]: total += sys.getsizeof(y)
+			#endfor
+		#endif
+	#endfor
+	return total
+#enddef
+
+class BenchMemory(RPLTestCase):
+	@timedTest
+	def testTilemaps(self):
+		# 64 tilemaps of 64x64 tiles.
+		raw = "RPL { lib: [std, min] }\n" + "\n".join([
+			"tilemap Map%i { base: $%x, dimensions: [64, 64], map: 0-4095 }" % (i, i * 0x10000)
+			for i in helper.range(64)
+		])
+		gc.collect()
+		before = dataMemory()
+		arpl = rpl.RPL()
+		arpl.parse(raw, string=True)
+		parsed = dataMemory() - before
+		for x in arpl.childrenByType("tilemap"): x["map"].list()
+		used = dataMemory() - before
+		print "Data after parsing: %i KiB, after reading maps: %i KiB" % (parsed // 1024, used // 1024)
+	#enddef
+#endclass
+
+class BenchTiles(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		fd, cls.fn = tempfile.mkstemp(".bin")
+		os.write(fd, "".join([chr((x * 7 + (x >> 8)) & 0xff) for x in helper.range(0x40000)]))
+		os.close(fd)
+		cls.rpl = rpl.RPL()
+		cls.rpl.parse("\n".join([
+			"RPL { lib: [std, min] }",
+			"tilemap Tiles { base: $0, dimensions: [64, 64], map: 0-4095 }",
+			"spritemap3 Sprites { base1: $0, base2: $20000, dimensions: [32, 32], map: 0-1023 }",
+		]), string=True)
+		cls.rpl.rom = helper.MappedStream(cls.fn, "rb")
+	#enddef
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.rpl.rom.close()
+		os.unlink(cls.fn)
+	#enddef
+
+	@timedTest
+	def testTilemap(self):
+		tilemap = self.rpl.child("Tiles")
+		tilemap.prepareImage()
+		self.assertEqual(tilemap.image.size, (512, 512))
+	#enddef
+
+	@timedTest
+	def testSpritemap3(self):
+		spritemap = self.rpl.child("Sprites")
+		spritemap.prepareImage()
+		self.assertEqual(spritemap.image.size, (512, 512))
+	#enddef
+
+	@timedTest
+	def testImportTilemap(self):
+		tilemap = self.rpl.child("Tiles")
+		tilemap.prepareImage()
+		rom = StringIO()
+		tilemap.importData(rom, "")
+		self.assertEqual(rom.getvalue(), str(self.rpl.rom.view(0, 0x8000)))
+	#enddef
+
+	@timedTest
+	def testImportSpritemap3(self):
+		spritemap = self.rpl.child("Sprites")
+		spritemap.prepareImage()
+		spritemap.importData(StringIO(), "")
+	#enddef
+#endclass
+
+class BenchMap(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		# A 300 entry script table of one to three byte codes, where codes
+		# may share their first bytes. These are kept to ASCII since strings
+		# in RPL are UTF8.
+		packed = []
+		for i in helper.range(300):
+			packed.append("".join([chr((i * 7 + x * 31) % 0x60 + 0x20) for x in helper.range(i % 3 + 1)]))
+		#endfor
+
+		# Only use codes which a scan would read back as themselves.
+		tokens = [i for i, p in enumerate(packed) if not [
+			q for q in packed[:i] if p.startswith(q) or q.startswith(p)
+		]]
+		script = [tokens[(x * 13) % len(tokens)] for x in helper.range(400000)]
+		cls.text = "".join([packed[i] for i in script])
+		cls.script = u"".join([u"<%i>" % i for i in script])
+
+		fd, cls.fn = tempfile.mkstemp(".bin")
+		os.write(fd, cls.text)
+		os.close(fd)
+		cls.rpl = rpl.RPL()
+		cls.rpl.parse("\n".join([
+			"RPL { lib: std }",
+			"map Script { packed: [%s], unpacked: [%s], width: dynamic }" % (
+				", ".join(['"%s"' % "".join(["$%02x" % ord(c) for c in p]) for p in packed]),
+				", ".join(['"<%i>"' % i for i in helper.range(300)]),
+			),
+			"data Data { x: [number, 1] }",
+		]), string=True)
+		cls.rpl.rom = helper.MappedStream(cls.fn, "rb")
+	#enddef
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.rpl.rom.close()
+		os.unlink(cls.fn)
+	#enddef
+
+	@timedTest
+	def testDynamic(self):
+		script = self.rpl.child("Script")
+		script.base, script.size = rpl.Number(0), rpl.Number(len(self.text))
+		script.exportPrepare(self.rpl.rom, "", [self.rpl.child("Data")])
+		self.assertEqual(script.myData.get(), self.script)
+	#enddef
+
+	@timedTest
+	def testImport(self):
+		script = self.rpl.child("Script")
+		script.base, script.myData = rpl.Number(0), rpl.String(self.script)
+		rom, self.rpl.rom = self.rpl.rom, StringIO()
+		try:
+			script.importDataLoop(self.rpl.rom, "", callers=[self.rpl.child("Data")])
+			self.assertEqual(self.rpl.rom.getvalue(), self.text)
+		finally: self.rpl.rom = rom
+	#enddef
+#endclass
+
+class BenchData(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		# 20000 records of fixed size fields.
+		cls.count = 20000
+		fd, cls.fn = tempfile.mkstemp(".bin")
+		os.write(fd, chr(cls.count & 0xff) + chr(cls.count >> 8) + "".join([
+			chr(i & 0xff) + chr(i >> 8 & 0xff) + "rec" + chr(i % 251) for i in helper.range(cls.count)
+		]))
+		os.close(fd)
+	#enddef
+
+	@classmethod
+	def tearDownClass(cls):
+		os.unlink(cls.fn)
+	#enddef
+
+	def setUp(self):
+		self.rpl = rpl.RPL()
+		self.rpl.parse("\n".join([
+			"RPL { lib: std }",
+			"format Rec { endian: little, sign: unsigned, xid: [number, 2], xname: [string, 3], xlevel: [number, 1] }",
+			"data Data { endian: little, sign: unsigned, xamt: [number, 2], xrecs: [@Rec, @this.xamt] }",
+		]), string=True)
+		self.rpl.rom, self.rpl.requested = helper.MappedStream(self.fn, "rb"), []
+	#enddef
+
+	def tearDown(self):
+		self.rpl.rom.close()
+	#enddef
+
+	@timedTest
+	def testRead(self):
+		recs = self.rpl.child("Data")["xrecs"].clones
+		self.assertEqual(len(recs), self.count)
+		self.assertEqual(recs[-1]["xid"].get(), self.count - 1)
+	#enddef
+
+	@timedTest
+	def testReadAll(self):
+		recs = self.rpl.child("Data")["xrecs"].clones
+		self.assertEqual(sum([r["xlevel"].get() for r in recs]), sum([i % 251 for i in helper.range(self.count)]))
+	#enddef
+#endclass
+
+class BenchNumber(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.values = [(x * 2654435761) & 0xffffffff for x in helper.range(200000)]
+		cls.data = rpl.Number.serializeArray(cls.values, 4, "big")
+	#enddef
+
+	@timedTest
+	def testSerialize(self):
+		num = rpl.Number(0)
+		for x in self.values:
+			num.data = x
+			num.serialize(size=4, endian="big")
+		#endfor
+	#enddef
+
+	@timedTest
+	def testUnserialize(self):
+		num, data = rpl.Number(0), self.data
+		for i in helper.range(0, len(data), 4): num.unserialize(data[i:i + 4], endian="big", sign="signed")
+	#enddef
+
+	@timedTest
+	def testArray(self):
+		self.assertEqual(rpl.Number.unserializeArray(self.data, 4, "big"), self.values)
+		self.assertEqual(rpl.Number.serializeArray(self.values, 4, "big"), self.data)
+	#enddef
+#endclass
+
+class BenchWrite(RPLTestCase):
+	@classmethod
+	def setUpClass(cls):
+		from rpl.std.data import RPLDataFile, JSONDict, JSONList
+		# 50000 records of a few keys each, as both RPL and JSON.
+		cls.datafile = RPLDataFile(False)
+		top = cls.datafile.addStruct("Data")
+		for i in helper.range(50000):
+			rec = cls.datafile.addStruct("xrecs", top)
+			cls.datafile.add("xid", rpl.Number(i), rec)
+			cls.datafile.add("xname", rpl.String(u"record %i" % i), rec)
+			cls.datafile.add("xtag", rpl.String(u"t%i" % i), cls.datafile.addStruct("xtags", rec))
+		#endfor
+		cls.json = JSONDict([("Data", JSONDict([("xrecs", JSONList([
+			JSONDict([("xid", rpl.Number(i)), ("xname", rpl.String(u"record %i" % i))])
+			for i in helper.range(50000)
+		]))]))])
+	#enddef
+
+	@timedTest
+	def testRPL(self):
+		out = StringIO()
+		helper.writeTo(out, self.datafile.chunks())
+		self.assertTrue(out.getvalue().endswith("}"))
+	#enddef
+
+	@timedTest
+	def testJSON(self):
+		out = StringIO()
+		helper.writeTo(out, self.json.chunks(False))
+		self.assertTrue(out.getvalue().endswith("}"))
+	#enddef
+#endclass
+
 if __name__ == "__main__":
 	run = sys.argv[1:]
 	if not run: run = ["all"]
@@ -630,6 +1777,7 @@ if __name__ == "__main__":
 			"maplist    - Run only map's list-type test.",
 			"mapstring  - Run only map's string-type test.",
 			"table      - Run table struct tests.",
+			"bench      - Run benchmarks (not included in all).",
 		))
 		sys.exit(0)
 	#endif
@@ -648,6 +1796,17 @@ if __name__ == "__main__":
 	if helper.oneOfIn(["all", "std", "calc"], run): suite.append(TestCalc)
 	if helper.oneOfIn(["all", "min"], run): suite.append(TestMin)
 	if helper.oneOfIn(["all", "typeset"], run): suite.append(TestTypeset)
+	if helper.oneOfIn(["bench", "parsebench"], run): suite.append(BenchParse)
+	if helper.oneOfIn(["bench", "graphicbench"], run): suite.append(BenchGraphic)
+	if helper.oneOfIn(["bench", "typecheckbench"], run): suite.append(BenchTypeCheck)
+	if helper.oneOfIn(["bench", "clonebench"], run): suite.append(BenchClone)
+	if helper.oneOfIn(["bench", "memorybench"], run): suite.append(BenchMemory)
+	if helper.oneOfIn(["bench", "crcbench"], run): suite.append(BenchCRC)
+	if helper.oneOfIn(["bench", "tilebench"], run): suite.append(BenchTiles)
+	if helper.oneOfIn(["bench", "mapbench"], run): suite.append(BenchMap)
+	if helper.oneOfIn(["bench", "databench"], run): suite.append(BenchData)
+	if helper.oneOfIn(["bench", "numberbench"], run): suite.append(BenchNumber)
+	if helper.oneOfIn(["bench", "writebench"], run): suite.append(BenchWrite)
 	try:
 		errors = {}
 		if suite:
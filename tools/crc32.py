@@ -22,9 +22,8 @@
 
 import sys
 import argparse
-from zlib import crc32
 from rpl.rpl import RPL, RPLError, RPLTypeCheck, ROM, List, HexNum
-from rpl.helper import err
+from rpl.helper import err, MappedStream, fileCRC, crcMany
 
 def main():
 	parser = argparse.ArgumentParser(
@@ -65,29 +64,30 @@ def main():
 		parser.error("File argument required.")
 	#endif
 
-	f = open(args.file, "rb")
+	f = MappedStream(args.file, "rb")
 
 	# Checksum entire file
 	if not args.ranges:
-		print u"crc32: %s" % unicode(HexNum(crc32(f.read()) & 0xFFFFFFFF))
+		print u"crc32: %s" % unicode(HexNum(fileCRC(f)))
 		return 0
 	#endif
 
 	rpl = RPL()
 	check = RPLTypeCheck(rpl, "check", "range")
-	out = []
-	# Checksum all ranges
+	runs = []
 	for x in args.ranges:
 		try: data = check.verify(rpl.parseData(x))
 		except RPLError:
 			err("Ranges should be RPL range type.")
 			return 1
 		#endtry
-
-		# Since nothing's going to process this list, we can leave x as is
-		out.append(List([x, HexNum(ROM.getCRC(f, data))]))
+		runs.append(ROM.addressRuns(f, data))
 	#endfor
 
+	# Checksum all ranges in one go.
+	# Since nothing's going to process this list, we can leave x as is
+	out = [List([x, HexNum(crc)]) for x, crc in zip(args.ranges, crcMany(f, runs))]
+
 	if len(out) == 1: print u"crc32: %s" % unicode(out[0])
 	else: print u"crc32: %s" % unicode(List(out))
 	return 0